@@ -0,0 +1,166 @@
+"""
+Runs the IR solution against several AWS Organizations from a manifest.  Each
+organization is handled by IRManager in its own process so credentials and
+failures are isolated per organization.
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import common
+import ir_setup
+
+
+DEFAULT_WORKERS = 4
+BATCH_ACTIONS = ["create", "destroy"]
+
+
+def run_manifest(manifest, action, workers=None):
+    """
+    Runs the IR action for every organization entry in the manifest using a
+    pool of worker processes.
+    Args:
+    manifest - list of dictionaries with the keys target_account, role,
+               external_id and config.  config is either an IR config
+               dictionary or the filename of an IR config json file.
+    action - "create" or "destroy"
+    Kargs:
+    workers - Number of worker processes (DEFAULT=DEFAULT_WORKERS)
+
+    Returns dictionary summarizing the results for every organization
+    """
+    if action not in BATCH_ACTIONS:
+        raise ValueError(f"Unsupported batch action {action}")
+
+    if not workers:
+        workers = DEFAULT_WORKERS
+
+    start_time = time.monotonic()
+    result_list = []
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(manifest), 1))) as executor:
+        future_list = [(entry, executor.submit(run_org, entry, action)) for entry in manifest]
+        for entry, future in future_list:
+            try:
+                result = future.result()
+
+            except Exception as err:
+                # Raised when the worker process itself failed, e.g. was killed
+                result = _org_result(entry, "FAILED", 0, {}, str(err))
+
+            logging.info("Organization %s %s in %ss", result["target_account"],
+                         result["status"], result["duration"])
+            result_list.append(result)
+
+    return {
+        "action": action,
+        "org_count": len(result_list),
+        "succeeded": len([result for result in result_list if result["status"] == "SUCCEEDED"]),
+        "failed": len([result for result in result_list if result["status"] == "FAILED"]),
+        "duration": round(time.monotonic() - start_time, 3),
+        "api_calls": sum(result["api_calls"] for result in result_list),
+        "orgs": result_list
+    }
+
+
+def run_org(entry, action):
+    """
+    Runs the IR action for a single organization manifest entry.  Called in a
+    worker process; any exception is captured in the returned result.
+    Args:
+    entry - manifest entry dictionary
+    action - "create" or "destroy"
+
+    Returns dictionary with the status, duration and API call counts for the
+    organization
+    """
+    common.reset_api_call_counts()
+    start_time = time.monotonic()
+    status = "SUCCEEDED"
+    error = None
+
+    try:
+        config_dict = entry["config"]
+        if isinstance(config_dict, str):
+            config_dict = common.load_json(config_dict)
+
+        ir_object = ir_setup.IRManager(target_account=entry.get("target_account"),
+                                       assume_role_name=entry.get("role"),
+                                       external_id=entry.get("external_id"))
+        if action == "create":
+            ir_object.ir_create(config_dict)
+        else:
+            ir_object.ir_destroy(config_dict)
+
+    except Exception as err:
+        logging.exception("IR %s failed for organization %s", action, entry.get("target_account"))
+        status = "FAILED"
+        error = str(err)
+
+    return _org_result(entry, status, time.monotonic() - start_time,
+                       common.get_api_call_counts(), error, common.get_open_circuits())
+
+
+def _org_result(entry, status, duration, api_call_counts, error, open_circuits=None):
+    """
+    Builds the result dictionary for a single organization.
+    Args:
+    entry - manifest entry dictionary
+    status - SUCCEEDED or FAILED
+    duration - seconds taken
+    api_call_counts - dictionary of "service.operation" to call count
+    error - error string or None
+    Kargs:
+    open_circuits - list of "service:region" circuits open at the end of the run
+
+    Returns dictionary
+    """
+    return {
+        "target_account": entry.get("target_account"),
+        "status": status,
+        "duration": round(duration, 3),
+        "api_calls": sum(api_call_counts.values()),
+        "api_call_counts": api_call_counts,
+        "open_circuits": open_circuits or [],
+        "error": error
+    }
+
+
+if __name__ == "__main__":
+    arg_dict = {
+        "--manifest": {"help": "Json file containing a list of organizations to configure",
+                       "required": True},
+        "--workers": {"help": "Number of organizations to run at the same time",
+                      "type": int,
+                      "default": min(DEFAULT_WORKERS, os.cpu_count() or 1)},
+        "--create": {"help": "Enable or update IR services.",
+                     "action": "store_true"},
+        "--destroy": {"help": "Remove the services defined in the config files",
+                      "action": "store_true"},
+        "--output": {"help": "File to write the json result summary to"},
+        "--debug": {"help": "Set logging level to debug",
+                    "action": "store_true"}
+    }
+
+    args = common.parse_args(arg_dict)
+
+    if args.debug:
+        LOG_LEVEL=logging.DEBUG
+    else:
+        LOG_LEVEL=logging.INFO
+
+    common.setup_logging(log_level=LOG_LEVEL)
+
+    if args.create == args.destroy:
+        raise SystemExit("Must request exactly one of --create or --destroy")
+
+    summary = run_manifest(common.load_json(args.manifest),
+                           "create" if args.create else "destroy",
+                           workers=args.workers)
+
+    summary_json = json.dumps(summary, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(summary_json)
+    print(summary_json)
@@ -3,14 +3,100 @@ Module that contains general helper and wrapper functions to help with the
 management of general python and boto3 objects.
 """
 import argparse
+import base64
 import importlib
 import logging
 import os
 import sys
 import json
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from functools import partial
 from uuid import uuid4
 
 import boto3
+import botocore.config
+import botocore.exceptions
+
+
+DEFAULT_MAX_WORKERS = 8
+
+# Count of API calls made by clients created in this process keyed by
+# "service.operation"
+_API_CALL_COUNTS = Counter()
+_API_CALL_LOCK = threading.Lock()
+
+# Circuit breaker state keyed by "service:region".  A circuit opens after
+# threshold consecutive failed calls and then fails calls fast.  Open circuits
+# become half open on the next run, where one success closes the circuit and
+# one failure opens it again.
+DEFAULT_CIRCUIT_THRESHOLD = 3
+_CIRCUITS = {}
+_CIRCUIT_LOCK = threading.Lock()
+_CIRCUIT_SETTINGS = {"threshold": int(os.environ.get("IR_CIRCUIT_THRESHOLD", DEFAULT_CIRCUIT_THRESHOLD))}
+
+# Adaptive (AIMD) concurrency of the fan-outs to a service region, see
+# AdaptiveLimiter.  The limit grows by one for every limit calls that succeed
+# and is halved when a call is throttled or its latency spikes above
+# LATENCY_SPIKE_FACTOR times the usual latency of the service region.
+AIMD_INITIAL_LIMIT = 4
+AIMD_MAX_LIMIT = 64
+LATENCY_SPIKE_FACTOR = 3
+# Calls measured before latency spikes are detected
+LATENCY_BASELINE_CALLS = 10
+THROTTLING_ERROR_CODES = {"Throttling", "ThrottlingException", "ThrottledException", "RequestThrottledException",
+                          "TooManyRequestsException", "RequestLimitExceeded", "LimitExceededException",
+                          "RequestThrottled", "SlowDown"}
+_LIMITERS = {}
+_LIMITER_LOCK = threading.Lock()
+
+# Client read timeouts used when a run deadline is set.  The largest tier
+# below half of the remaining time is used so a call always leaves time for
+# the response to Cloudformation.
+TIMEOUT_TIERS = [60, 30, 15, 5, 2, 1]
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_MAX_ATTEMPTS = 3
+_DEADLINE_SETTINGS = {"deadline": None}
+
+# Record and replay of the API calls made by clients created in this module,
+# see Cassette.  Values of the keys below are replaced in the cassette: secrets,
+# personal data and values that change on every run.
+CASSETTE_MODES = ["record", "replay"]
+CASSETTE_REDACTED_KEYS = {"accesskeyid", "secretaccesskey", "sessiontoken", "externalid",
+                          "email", "rolesessionname", "clienttoken"}
+CASSETTE_REDACTED_VALUE = "REDACTED"
+_CASSETTE_SETTINGS = {"cassette": None}
+
+# Endpoint used by every client instead of the AWS endpoints, e.g. the
+# fake_aws.py server used for load tests.  Clients of a custom endpoint get
+# placeholder credentials when no credentials are configured.
+_ENDPOINT_SETTINGS = {"endpoint_url": os.environ.get("IR_ENDPOINT_URL")}
+ENDPOINT_PLACEHOLDER_CREDENTIALS = {"aws_access_key_id": "placeholder",
+                                    "aws_secret_access_key": "placeholder"}
+
+# boto3 session shared by every client created in this process so service
+# models and endpoint rules are only loaded once
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+_LOADED_SERVICES = set()
+
+LOG_FORMATS = ["text", "json"]
+# full - one record per account event
+# sample - one record for every sample rate account events
+# summary - only the per region summaries from flush_account_events
+ACCOUNT_LOG_DETAILS = ["full", "sample", "summary"]
+DEFAULT_LOG_SAMPLE_RATE = 100
+
+# Count of per account events keyed by (service, region, action) waiting to
+# be logged as a summary by flush_account_events
+_ACCOUNT_EVENT_COUNTS = Counter()
+_ACCOUNT_EVENT_LOCK = threading.Lock()
+_ACCOUNT_LOG_SETTINGS = {"detail": "full", "sample_rate": DEFAULT_LOG_SAMPLE_RATE}
+# Attributes of every log record, anything else was passed with extra
+_LOG_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
 
 
 class ClientManager:
@@ -18,15 +104,18 @@ class ClientManager:
     Class to help with the management of boto3 clients for a multi service
     multi region use.
     """
-    def __init__(self, access_key=None, secret_key=None, token=None, region=None):
+    def __init__(self, access_key=None, secret_key=None, token=None, region=None, endpoint_url=None):
         self.access_key = access_key
         self.secret_key = secret_key
         self.token = token
+        # Endpoint of every client, the endpoint set with set_endpoint_url when not provided
+        self.endpoint_url = endpoint_url
         self.default_region = region
         if not self.default_region:
             self.default_region = "us-east-1"
 
         self.__boto3_clients = {}
+        self.__client_lock = threading.Lock()
 
     def client(self, service_name, region_name=None):
         """
@@ -39,21 +128,88 @@ class ClientManager:
 
         Returns a boto3 client for the service and region requested.
         """
-        if service_name not in self.__boto3_clients:
-            self.__boto3_clients[service_name] = {}
-
         if not region_name:
             region_name = self.default_region
 
-        if region_name not in self.__boto3_clients[service_name]:
-            self.__boto3_clients[service_name][region_name] = \
-                boto3.client(
-                service_name,
-                aws_access_key_id=self.access_key,
-                aws_secret_access_key=self.secret_key,
-                aws_session_token=self.token, region_name=region_name)
+        # Clients are rebuilt with shorter timeouts as the run deadline approaches
+        timeout_tier, client_config = deadline_client_config()
+        cached_tier, client_object = self.__boto3_clients.get((service_name, region_name), (None, None))
+        if client_object and (timeout_tier is None or (cached_tier or TIMEOUT_TIERS[0]) <= timeout_tier):
+            return client_object
 
-        return self.__boto3_clients[service_name][region_name]
+        client_params = {"config": pool_client_config(client_config)}
+        endpoint_url = self.endpoint_url or get_endpoint_url()
+        if endpoint_url:
+            client_params["endpoint_url"] = endpoint_url
+        client_object = register_client_hooks(create_session_client(
+            service_name,
+            aws_access_key_id=self.access_key,
+            aws_secret_access_key=self.secret_key,
+            aws_session_token=self.token, region_name=region_name, **client_params))
+
+        # Keep the client if another thread created one at the same time
+        with self.__client_lock:
+            cached_tier, cached_client = self.__boto3_clients.get((service_name, region_name), (None, None))
+            if cached_client and cached_tier == timeout_tier:
+                return cached_client
+            self.__boto3_clients[(service_name, region_name)] = (timeout_tier, client_object)
+            return client_object
+
+    def warm_up(self, service_list, region_list, max_workers=None):
+        """
+        Creates the clients for every service and region concurrently so they
+        are ready before they are needed.
+        Args:
+        service_list - list of AWS service names
+        region_list - list of AWS region names
+        Kargs:
+        max_workers - Maximum number of threads to use
+
+        Returns None
+        """
+        key_list = [(service_name, region_name.strip())
+                    for service_name in service_list for region_name in region_list]
+        thread_map(lambda key: self.client(*key), key_list, max_workers=max_workers)
+
+
+def get_session():
+    """
+    Returns the boto3 session shared by every client created in this process.
+    Loaded service models and endpoint rules are cached by the session and
+    reused by every client created from it.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if not _SESSION:
+            _SESSION = boto3.session.Session()
+        return _SESSION
+
+
+def create_session_client(service_name, **client_params):
+    """
+    Creates a boto3 client from the shared session.
+    Args:
+    service_name - Name of AWS service
+    Kargs:
+    client_params - Parameters passed to the session client method
+
+    Returns boto3 client
+    """
+    session_object = get_session()
+    if client_params.get("endpoint_url") and not client_params.get("aws_access_key_id") \
+            and not session_object.get_credentials():
+        client_params.update(ENDPOINT_PLACEHOLDER_CREDENTIALS)
+
+    if service_name in _LOADED_SERVICES:
+        return session_object.client(service_name, **client_params)
+
+    # The first client of a service loads its models and initializes shared
+    # session components, which is not thread safe
+    with _SESSION_LOCK:
+        client_object = session_object.client(service_name, **client_params)
+        _LOADED_SERVICES.add(service_name)
+
+    return client_object
 
 
 def get_client(service_name, session_object=None,
@@ -81,11 +237,13 @@ def get_client(service_name, session_object=None,
         logging.debug("Using provided boto3 session object for client creation")
         create_client_function = session_object.client
     else:
-        create_client_function = boto3.client
+        create_client_function = create_session_client
 
-    client_params = {"region_name": region}
+    client_params = {"region_name": region, "config": pool_client_config(deadline_client_config()[1])}
+    endpoint_params = {"endpoint_url": get_endpoint_url()} if get_endpoint_url() else {}
+    client_params.update(endpoint_params)
     if target_account and assume_role_name:
-        sts_client = create_client_function("sts")
+        sts_client = register_client_hooks(create_client_function("sts", **endpoint_params))
         client_params["aws_access_key_id"], \
         client_params["aws_secret_access_key"], \
         client_params["aws_session_token"] = assume_role(
@@ -94,7 +252,762 @@ def get_client(service_name, session_object=None,
             assume_role_name=assume_role_name,
             external_id=external_id)
 
-    return create_client_function(service_name, **client_params)
+    return register_client_hooks(create_client_function(service_name, **client_params))
+
+
+def set_endpoint_url(endpoint_url):
+    """
+    Sets the endpoint used by every client created in this module instead of
+    the AWS endpoints.
+    Args:
+    endpoint_url - Url of the endpoint, e.g. a fake_aws.py server, or None
+                   for the AWS endpoints
+
+    Returns None
+    """
+    _ENDPOINT_SETTINGS["endpoint_url"] = endpoint_url
+
+
+def get_endpoint_url():
+    """
+    Returns the endpoint url set with set_endpoint_url or the IR_ENDPOINT_URL
+    environment variable, None for the AWS endpoints.
+    """
+    return _ENDPOINT_SETTINGS["endpoint_url"]
+
+
+def register_api_counter(client_object):
+    """
+    Registers a handler on the boto3 client that counts every API call made
+    with it.  Counts are kept per process and read with get_api_call_counts.
+    Args:
+    client_object - boto3 client object
+
+    Returns the client object
+    """
+    client_object.meta.events.register("before-call", _count_api_call)
+    return client_object
+
+
+def _count_api_call(event_name, **kwargs):
+    # Event names have the form before-call.<service>.<operation>
+    with _API_CALL_LOCK:
+        _API_CALL_COUNTS[event_name.split(".", 1)[-1]] += 1
+
+
+def get_api_call_counts():
+    """
+    Returns a copy of the API call counts for this process.
+
+    Returns dictionary of "service.operation" to call count
+    """
+    with _API_CALL_LOCK:
+        return dict(_API_CALL_COUNTS)
+
+
+def reset_api_call_counts():
+    """
+    Resets the API call counts for this process.
+
+    Returns None
+    """
+    with _API_CALL_LOCK:
+        _API_CALL_COUNTS.clear()
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when the run deadline is reached.
+    """
+
+
+class Deadline:
+    """
+    Point in time by which a run must complete.  The deadline of the current
+    run is set with set_deadline and checked before every API call made by
+    clients created by this module.
+    """
+    def __init__(self, seconds=None):
+        """
+        Kargs:
+        seconds - Seconds from now until the deadline, None for no deadline
+        """
+        self.expires = None if seconds is None else time.monotonic() + seconds
+
+    @classmethod
+    def from_lambda_context(cls, context, margin=0):
+        """
+        Creates a deadline margin seconds before the Lambda invocation times out.
+        Args:
+        context - AWS context object
+        Kargs:
+        margin - Seconds kept in reserve to respond before the timeout
+
+        Returns Deadline
+        """
+        return cls(context.get_remaining_time_in_millis() / 1000 - margin)
+
+    def remaining(self):
+        """
+        Returns the seconds left before the deadline or None if there is no deadline.
+        """
+        if self.expires is None:
+            return None
+        return max(self.expires - time.monotonic(), 0)
+
+    def expired(self):
+        """
+        Returns True if the deadline has been reached.
+        """
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def check(self, operation="Run"):
+        """
+        Raises DeadlineExceeded if the deadline has been reached.
+        Kargs:
+        operation - Description of the work being checked, used in the error
+
+        Returns None
+        """
+        if self.expired():
+            raise DeadlineExceeded(f"{operation} stopped, the run deadline was reached")
+
+
+def set_deadline(deadline):
+    """
+    Sets the deadline of the current run.
+    Args:
+    deadline - Deadline object or None to remove the deadline
+
+    Returns None
+    """
+    _DEADLINE_SETTINGS["deadline"] = deadline
+
+
+def get_deadline():
+    """
+    Returns the Deadline of the current run or None.
+    """
+    return _DEADLINE_SETTINGS["deadline"]
+
+
+def check_deadline(operation="Run"):
+    """
+    Raises DeadlineExceeded if the deadline of the current run has been reached.
+    Kargs:
+    operation - Description of the work being checked, used in the error
+
+    Returns None
+    """
+    deadline = get_deadline()
+    if deadline:
+        deadline.check(operation)
+
+
+def pool_client_config(client_config=None):
+    """
+    Returns the client configuration with a connection pool large enough for
+    AIMD_MAX_LIMIT concurrent calls, so adaptive_map fan-outs do not discard
+    connections beyond the botocore default of 10.
+    Kargs:
+    client_config - botocore Config to merge the pool size into
+
+    Returns botocore Config
+    """
+    pool_config = botocore.config.Config(max_pool_connections=AIMD_MAX_LIMIT)
+    return pool_config.merge(client_config) if client_config else pool_config
+
+
+def deadline_client_config():
+    """
+    Returns the client configuration for the time left before the run
+    deadline.  The read timeout is the largest of TIMEOUT_TIERS below half
+    of the remaining time and the attempts are limited to the number of
+    read timeouts that fit in the remaining time.
+
+    Returns tuple of (read timeout tier, botocore Config), both None when
+    there is no deadline
+    """
+    deadline = get_deadline()
+    remaining = deadline.remaining() if deadline else None
+    if remaining is None:
+        return None, None
+
+    read_timeout = next((tier for tier in TIMEOUT_TIERS if tier <= remaining / 2), TIMEOUT_TIERS[-1])
+    return read_timeout, botocore.config.Config(
+        connect_timeout=min(DEFAULT_CONNECT_TIMEOUT, read_timeout),
+        read_timeout=read_timeout,
+        retries={"total_max_attempts": max(1, min(DEFAULT_MAX_ATTEMPTS, int(remaining // read_timeout)))})
+
+
+def register_client_hooks(client_object):
+    """
+    Registers the API call counter, circuit breaker, run deadline,
+    concurrency feedback and cassette handlers on the boto3 client.
+    Args:
+    client_object - boto3 client object
+
+    Returns the client object
+    """
+    client_object.meta.events.register("before-call", _check_call_deadline)
+    client_object.meta.events.register_first("needs-retry", partial(_check_retry_deadline,
+                                                                    client_object.meta.config.read_timeout))
+    register_circuit_breaker(client_object)
+    register_concurrency_feedback(client_object)
+
+    # Registered last so the other before-call handlers run for replayed calls
+    client_object.meta.events.register("provide-client-params", _cassette_params)
+    client_object.meta.events.register("before-call", _cassette_replay)
+    client_object.meta.events.register("before-send", _cassette_replay_error)
+    client_object.meta.events.register("after-call", _cassette_record)
+    client_object.meta.events.register("after-call-error", _cassette_record_error)
+    return client_object
+
+
+def _check_call_deadline(event_name, **kwargs):
+    check_deadline(event_name.split(".", 1)[-1])
+
+
+def _check_retry_deadline(read_timeout, event_name, response=None, caught_exception=None, **kwargs):
+    # Called after every attempt, only failed attempts would be retried
+    deadline = get_deadline()
+    if not deadline or (caught_exception is None and response and response[0].status_code < 400):
+        return
+
+    # A retry that could not complete before the deadline is not attempted
+    if deadline.remaining() < read_timeout:
+        raise DeadlineExceeded(f"Retry of {event_name.split('.', 1)[-1]} stopped, "
+                               "the run deadline is too close")
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making an API call to a service region whose circuit
+    is open.
+    """
+
+
+def register_circuit_breaker(client_object):
+    """
+    Registers the API call counter and the circuit breaker handlers on the
+    boto3 client.  The circuit of the client's service and region is
+    checked before every call and updated with the outcome of every call.
+    Args:
+    client_object - boto3 client object
+
+    Returns the client object
+    """
+    circuit_key = f"{client_object.meta.service_model.service_name}:{client_object.meta.region_name}"
+    # Registered before the API call counter so calls failed fast are not counted
+    client_object.meta.events.register("before-call", partial(_check_circuit, circuit_key))
+    register_api_counter(client_object)
+    client_object.meta.events.register("after-call", partial(_record_call, circuit_key))
+    client_object.meta.events.register("after-call-error", partial(_record_call_error, circuit_key))
+    return client_object
+
+
+def is_region_failure(err):
+    """
+    Returns True if the exception indicates the service region itself is
+    failing or unreachable, rather than an error for the request made:
+    connection errors, timeouts, server errors and open circuits.
+    Args:
+    err - Exception raised by a boto3 client call
+    """
+    if isinstance(err, (CircuitOpenError, botocore.exceptions.ConnectionError,
+                        botocore.exceptions.HTTPClientError)):
+        return True
+
+    if isinstance(err, botocore.exceptions.ClientError):
+        return err.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+
+    return False
+
+
+def _check_circuit(circuit_key, **kwargs):
+    with _CIRCUIT_LOCK:
+        circuit = _CIRCUITS.get(circuit_key)
+        if circuit and circuit["state"] == "OPEN":
+            raise CircuitOpenError(f"Circuit for {circuit_key} is open after "
+                                   f"{circuit['failures']} consecutive failures")
+
+
+def _record_call(circuit_key, http_response, **kwargs):
+    if http_response.status_code >= 500:
+        _record_failure(circuit_key)
+    else:
+        _record_success(circuit_key)
+
+
+def _record_call_error(circuit_key, exception, **kwargs):
+    if is_region_failure(exception):
+        _record_failure(circuit_key)
+
+
+def _record_success(circuit_key):
+    with _CIRCUIT_LOCK:
+        circuit = _CIRCUITS.pop(circuit_key, None)
+    if circuit and circuit["state"] != "CLOSED":
+        logging.info("Circuit for %s closed", circuit_key)
+
+
+def _record_failure(circuit_key):
+    deadline = get_deadline()
+    if deadline and deadline.expired():
+        # Calls cut short by the deadline say nothing about the region
+        return
+
+    with _CIRCUIT_LOCK:
+        circuit = _CIRCUITS.setdefault(circuit_key, {"state": "CLOSED", "failures": 0})
+        circuit["failures"] += 1
+        if circuit["state"] == "OPEN":
+            return
+        if circuit["state"] == "HALF_OPEN" or circuit["failures"] >= _CIRCUIT_SETTINGS["threshold"]:
+            circuit["state"] = "OPEN"
+            logging.error("Circuit for %s opened after %d consecutive failures",
+                          circuit_key, circuit["failures"])
+
+
+def configure_circuit_breaker(threshold):
+    """
+    Sets the number of consecutive failed calls that open a circuit.
+    Args:
+    threshold - Number of consecutive failures
+
+    Returns None
+    """
+    with _CIRCUIT_LOCK:
+        _CIRCUIT_SETTINGS["threshold"] = max(int(threshold), 1)
+
+
+def get_open_circuits():
+    """
+    Returns the sorted list of "service:region" circuits that are open.
+    """
+    with _CIRCUIT_LOCK:
+        return sorted(key for key, circuit in _CIRCUITS.items() if circuit["state"] == "OPEN")
+
+
+def half_open_circuits():
+    """
+    Moves every open circuit to half open so the next call to the region is
+    made as a probe.  Called at the start of each run.
+
+    Returns None
+    """
+    with _CIRCUIT_LOCK:
+        for circuit_key, circuit in _CIRCUITS.items():
+            if circuit["state"] == "OPEN":
+                logging.info("Circuit for %s half open, probing the region", circuit_key)
+                circuit["state"] = "HALF_OPEN"
+
+
+class AdaptiveLimiter:
+    """
+    Additive increase, multiplicative decrease (AIMD) limit of the work items
+    run concurrently against a single service region.  The limit grows by
+    one for every limit successful calls and is halved when a call is
+    throttled or its latency spikes.  Only calls started after the last
+    decrease can decrease the limit again, so a burst of throttled calls
+    halves the limit once.  Used as a context manager around a work item.
+    """
+    def __init__(self, key, initial_limit=AIMD_INITIAL_LIMIT, max_limit=AIMD_MAX_LIMIT):
+        """
+        Args:
+        key - "service:region" of the limiter
+        Kargs:
+        initial_limit - Concurrency of the first work items
+        max_limit - Largest concurrency allowed
+        """
+        self.key = key
+        self.max_limit = max_limit
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.metrics = Counter()
+        self.peak_in_flight = 0
+        self.latency = None
+        self.__last_decrease = 0
+        self.__condition = threading.Condition()
+
+    def __enter__(self):
+        with self.__condition:
+            while self.in_flight >= int(self.limit):
+                self.__condition.wait()
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return self
+
+    def __exit__(self, *args):
+        with self.__condition:
+            self.in_flight -= 1
+            self.__condition.notify()
+
+    def record_success(self, latency, started):
+        """
+        Records a successful call, increasing the limit unless its latency
+        is a spike.
+        Args:
+        latency - Seconds taken by the call including retries
+        started - time.monotonic() when the call started
+
+        Returns None
+        """
+        with self.__condition:
+            self.metrics["calls"] += 1
+            spike = self.metrics["calls"] > LATENCY_BASELINE_CALLS and \
+                latency > self.latency * LATENCY_SPIKE_FACTOR
+            self.latency = latency if self.latency is None else self.latency * 0.95 + latency * 0.05
+            if spike:
+                self.metrics["latency_spikes"] += 1
+                self._decrease(started)
+                return
+
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.__condition.notify_all()
+
+    def record_throttle(self, started):
+        """
+        Records a throttled call attempt, halving the limit.
+        Args:
+        started - time.monotonic() when the call started
+
+        Returns None
+        """
+        with self.__condition:
+            self.metrics["throttles"] += 1
+            self._decrease(started)
+
+    def _decrease(self, started):
+        # Called with the condition held
+        if started < self.__last_decrease:
+            return
+        self.limit = max(self.limit / 2, 1)
+        self.metrics["decreases"] += 1
+        self.__last_decrease = time.monotonic()
+
+    def get_metrics(self):
+        """
+        Returns a dictionary with the current limit, the peak number of calls
+        in flight, the smoothed latency in milliseconds and the counts of
+        successful calls, throttled attempts, latency spikes and limit
+        decreases.
+        """
+        with self.__condition:
+            return {
+                "limit": int(self.limit),
+                "peak_in_flight": self.peak_in_flight,
+                "in_flight": self.in_flight,
+                "latency_ms": round((self.latency or 0) * 1000, 1),
+                "calls": self.metrics["calls"],
+                "throttles": self.metrics["throttles"],
+                "latency_spikes": self.metrics["latency_spikes"],
+                "decreases": self.metrics["decreases"]
+            }
+
+
+def get_limiter(service_name, region_name):
+    """
+    Returns the AdaptiveLimiter of a service region, created on first use
+    and kept for the life of the process.
+    Args:
+    service_name - AWS service name
+    region_name - AWS region name
+    """
+    key = f"{service_name}:{region_name}"
+    with _LIMITER_LOCK:
+        if key not in _LIMITERS:
+            _LIMITERS[key] = AdaptiveLimiter(key)
+        return _LIMITERS[key]
+
+
+def adaptive_map(function, items, limiter_key, return_exceptions=False):
+    """
+    thread_map where the number of items run at the same time against a
+    service region is set by its AdaptiveLimiter instead of a fixed number
+    of workers.
+    Args:
+    function - Callable that accepts a single item as its argument
+    items - Iterable of hashable items
+    limiter_key - (service, region) tuple of the limiter to use, or a
+                  callable returning the tuple for an item when the items
+                  are in different regions
+    Kargs:
+    return_exceptions - When True an exception raised for an item is returned as
+                        the result for that item instead of being raised
+
+    Returns a dictionary of item to function result
+    """
+    key_function = limiter_key if callable(limiter_key) else lambda item: limiter_key
+
+    def run_item(item):
+        with get_limiter(*key_function(item)):
+            return function(item)
+
+    return thread_map(run_item, items, max_workers=AIMD_MAX_LIMIT, return_exceptions=return_exceptions)
+
+
+def register_concurrency_feedback(client_object):
+    """
+    Registers the handlers reporting the latency of successful calls and
+    the throttled attempts of the boto3 client to the AdaptiveLimiter of its
+    service and region.
+    Args:
+    client_object - boto3 client object
+
+    Returns the client object
+    """
+    limiter = get_limiter(client_object.meta.service_model.service_name, client_object.meta.region_name)
+    client_object.meta.events.register("before-call", _start_call_timer)
+    # Registered first as the botocore retry handler stops the event
+    client_object.meta.events.register_first("needs-retry", partial(_record_throttle, limiter))
+    client_object.meta.events.register("after-call", partial(_record_latency, limiter))
+    return client_object
+
+
+def _start_call_timer(context, **kwargs):
+    context["limiter_start"] = time.monotonic()
+
+
+def _record_throttle(limiter, request_dict, response=None, **kwargs):
+    if not response:
+        return
+    http_response, parsed = response
+    error_code = parsed.get("Error", {}).get("Code")
+    if http_response.status_code == 429 or error_code in THROTTLING_ERROR_CODES:
+        limiter.record_throttle(request_dict["context"].get("limiter_start", 0))
+
+
+def _record_latency(limiter, http_response, context, **kwargs):
+    if http_response.status_code < 400 and "limiter_start" in context:
+        limiter.record_success(time.monotonic() - context["limiter_start"], context["limiter_start"])
+
+
+def get_concurrency_metrics():
+    """
+    Returns a dictionary of "service:region" to the metrics of its
+    AdaptiveLimiter, see AdaptiveLimiter.get_metrics.
+    """
+    with _LIMITER_LOCK:
+        limiter_list = list(_LIMITERS.values())
+    return {limiter.key: limiter.get_metrics() for limiter in sorted(limiter_list, key=lambda item: item.key)}
+
+
+def log_concurrency_metrics():
+    """
+    Logs the metrics of every service region limiter that made calls, with
+    the metrics as separate fields in the JSON log format.
+
+    Returns None
+    """
+    for key, metrics in get_concurrency_metrics().items():
+        if metrics["calls"] or metrics["throttles"]:
+            logging.info("Concurrency for %s: limit %d (peak %d in flight), %d calls, %d throttled, "
+                         "%d latency spikes, %.1fms latency", key, metrics["limit"], metrics["peak_in_flight"],
+                         metrics["calls"], metrics["throttles"], metrics["latency_spikes"],
+                         metrics["latency_ms"], extra=dict(metrics, limiter=key))
+
+
+class CassetteResponse:
+    """
+    HTTP response of a replayed API call, only the status code is used by
+    botocore and the handlers in this module.
+    """
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b""
+
+
+class Cassette:
+    """
+    JSON Lines file of the API calls made by clients created in this module.
+    In record mode every call is written with its redacted parameters, its
+    response or error and its latency.  In replay mode the recorded
+    responses are returned instead of calling AWS.  Calls with the same
+    service, region, operation and parameters are replayed in the order
+    they were recorded and the last one is repeated once they run out.
+    """
+    def __init__(self, filename, mode, speed=0):
+        """
+        Args:
+        filename - Cassette filename
+        mode - One of CASSETTE_MODES
+        Kargs:
+        speed - Replay speed relative to the recorded latencies, e.g. 1 for
+                the original speed and 10 for ten times faster.  0 replays
+                without any delay
+        """
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unsupported cassette mode {mode}")
+
+        self.filename = filename
+        self.mode = mode
+        self.speed = speed
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__entries = {}
+
+        if self.mode == "record":
+            self.__file = open(self.filename, "w", encoding="utf-8")
+        else:
+            with open(self.filename, encoding="utf-8") as cassette_file:
+                for line in cassette_file:
+                    entry = json.loads(line, object_hook=_cassette_decode)
+                    self.__entries.setdefault(self.key(entry), deque()).append(entry)
+
+    @staticmethod
+    def key(entry):
+        """
+        Returns the string used to match a call with its recorded entries.
+        Args:
+        entry - dictionary with the service, region, operation and params
+        """
+        return json.dumps([entry["service"], entry["region"], entry["operation"], entry["params"]],
+                          sort_keys=True, default=_cassette_encode)
+
+    def record(self, entry):
+        """
+        Writes an API call entry to the cassette.
+        Args:
+        entry - dictionary with the service, region, operation, params,
+                latency and either the status and response or the error
+
+        Returns None
+        """
+        line = json.dumps(entry, separators=(",", ":"), default=_cassette_encode)
+        with self.__lock:
+            self.__file.write(line + "\n")
+
+    def replay(self, entry):
+        """
+        Returns the recorded entry for an API call.
+        Args:
+        entry - dictionary with the service, region, operation and params
+
+        Returns dictionary
+        """
+        with self.__lock:
+            entry_queue = self.__entries.get(self.key(entry))
+            if not entry_queue:
+                raise ValueError(f"No recorded response for {entry['service']}.{entry['operation']} "
+                                 f"in {entry['region']} with {entry['params']}")
+            if len(entry_queue) > 1:
+                return entry_queue.popleft()
+            return entry_queue[0]
+
+    def close(self):
+        """
+        Closes the cassette file of a recording.
+
+        Returns None
+        """
+        if self.__file:
+            with self.__lock:
+                self.__file.close()
+                self.__file = None
+
+
+def set_cassette(cassette):
+    """
+    Sets the cassette used by every client created in this module.
+    Args:
+    cassette - Cassette object or None to call AWS without recording
+
+    Returns None
+    """
+    _CASSETTE_SETTINGS["cassette"] = cassette
+
+
+def get_cassette():
+    """
+    Returns the Cassette object in use or None.
+    """
+    return _CASSETTE_SETTINGS["cassette"]
+
+
+def redact(value):
+    """
+    Returns a copy of value with the values of CASSETTE_REDACTED_KEYS
+    replaced by CASSETTE_REDACTED_VALUE.
+    Args:
+    value - API parameters or response
+    """
+    if isinstance(value, dict):
+        return {key: CASSETTE_REDACTED_VALUE if key.lower() in CASSETTE_REDACTED_KEYS else redact(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def _cassette_encode(value):
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode()}
+    raise TypeError(f"{type(value).__name__} is not serializable in a cassette")
+
+
+def _cassette_decode(value):
+    if len(value) == 1 and "$datetime" in value:
+        return datetime.fromisoformat(value["$datetime"])
+    if len(value) == 1 and "$bytes" in value:
+        return base64.b64decode(value["$bytes"])
+    return value
+
+
+def _cassette_params(params, model, context, **kwargs):
+    # The parameters are kept before botocore adds idempotency tokens
+    if get_cassette():
+        context["cassette_entry"] = {
+            "service": model.service_model.service_name,
+            "region": context["client_region"],
+            "operation": model.name,
+            "params": redact(params)
+        }
+        context["cassette_start"] = time.monotonic()
+
+
+def _cassette_replay(context, **kwargs):
+    cassette = get_cassette()
+    if not cassette or cassette.mode != "replay":
+        return None
+
+    entry = cassette.replay(context["cassette_entry"])
+    if cassette.speed:
+        time.sleep(entry["latency"] / cassette.speed)
+
+    if "error" in entry:
+        # Raised when the request is sent, where a live call fails, so the
+        # retry, circuit breaker and after-call-error handlers see the error
+        context["cassette_error"] = entry["error"]
+        return None
+
+    response = dict(entry["response"], ResponseMetadata={"HTTPStatusCode": entry["status"],
+                                                         "HTTPHeaders": {}, "RetryAttempts": 0})
+    return CassetteResponse(entry["status"]), response
+
+
+def _cassette_replay_error(request, **kwargs):
+    error = (request.context or {}).get("cassette_error")
+    if error is not None:
+        raise botocore.exceptions.ConnectionError(error=error)
+
+
+def _cassette_record(http_response, parsed, context, **kwargs):
+    cassette = get_cassette()
+    if cassette and cassette.mode == "record":
+        response = {key: value for key, value in parsed.items() if key != "ResponseMetadata"}
+        cassette.record(dict(context["cassette_entry"], status=http_response.status_code,
+                             response=redact(response),
+                             latency=round(time.monotonic() - context["cassette_start"], 4)))
+
+
+def _cassette_record_error(exception, context, **kwargs):
+    cassette = get_cassette()
+    if cassette and cassette.mode == "record":
+        cassette.record(dict(context["cassette_entry"], error=str(exception),
+                             latency=round(time.monotonic() - context["cassette_start"], 4)))
 
 
 def assume_role(sts_client, target_account, assume_role_name, external_id=None):
@@ -124,6 +1037,84 @@ def assume_role(sts_client, target_account, assume_role_name, external_id=None):
            response["Credentials"]["SessionToken"]
 
 
+def thread_map(function, items, max_workers=None, return_exceptions=False, timeout=None):
+    """
+    Runs function once for every item in items using a pool of threads and
+    returns the results keyed by item.
+    Args:
+    function - Callable that accepts a single item as its argument
+    items - Iterable of hashable items
+    Kargs:
+    max_workers - Maximum number of threads to use (DEFAULT=DEFAULT_MAX_WORKERS)
+    return_exceptions - When True an exception raised for an item is returned as
+                        the result for that item instead of being raised
+    timeout - Seconds to wait for all items to complete.  Items that have not
+              completed in time are given a TimeoutError result and the
+              threads still running them are not waited for.
+
+    Returns a dictionary of item to function result
+    """
+    items = list(items)
+    if not items:
+        return {}
+
+    if not max_workers:
+        max_workers = DEFAULT_MAX_WORKERS
+
+    return_dict = {}
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    try:
+        future_dict = {item: executor.submit(function, item) for item in items}
+        wait(future_dict.values(), timeout=timeout)
+
+        for item, future in future_dict.items():
+            try:
+                if not future.done():
+                    raise TimeoutError(f"Not completed within {timeout:.1f} seconds")
+                return_dict[item] = future.result()
+
+            except Exception as err:
+                if not return_exceptions:
+                    raise err from None
+                return_dict[item] = err
+
+    finally:
+        executor.shutdown(wait=timeout is None, cancel_futures=True)
+
+    return return_dict
+
+
+def paginate(client_object, operation_name, result_key, page_size=None, **param_dict):
+    """
+    Generator that yields every item of a paginated boto3 operation.  The
+    next page is requested in a background thread while the items of the
+    current page are being processed, so the caller only waits on the API
+    when it processes items faster than the pages arrive.
+    Args:
+    client_object - boto3 client
+    operation_name - Name of the client method to paginate, e.g. "list_members"
+    result_key - Key of the list of items in each response page
+    Kargs:
+    page_size - Number of items requested per page
+    param_dict - Parameters passed to the operation
+
+    Yields the items of every page in order
+    """
+    if page_size:
+        param_dict["PaginationConfig"] = {"PageSize": page_size}
+    page_iterator = iter(client_object.get_paginator(operation_name).paginate(**param_dict))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(next, page_iterator, None)
+        while True:
+            page = next_page.result()
+            if page is None:
+                break
+
+            next_page = executor.submit(next, page_iterator, None)
+            yield from page.get(result_key, [])
+
+
 def parse_args(arg_dict):
     """
     Helper function for creating a argparser.
@@ -154,16 +1145,37 @@ def load_json(filename):
         return json.load(file_handle)
 
 
-def setup_logging(log_filename=None, log_level=None):
+def setup_logging(log_filename=None, log_level=None, log_format=None,
+                  account_detail=None, sample_rate=None):
     """
     Helper that configures base logging for the root log object.  If logging
     level is not set to logging.DEBUG botocore logging level is set to logging.WARNING.
+    When not provided the format, account detail and sample rate are read
+    from the IR_LOG_FORMAT, IR_LOG_ACCOUNT_DETAIL and IR_LOG_SAMPLE_RATE
+    environment variables.
     Kargs:
     log_filename - Filname to use for the log output of the logger
     log_level - Logging level to use for the logging object (DEFAULT=logging.INFO)
+    log_format - "text" or "json" (DEFAULT=text)
+    account_detail - Logging of per account events, one of ACCOUNT_LOG_DETAILS
+                     (DEFAULT=full)
+    sample_rate - Account events per logged event when account_detail is
+                  "sample" (DEFAULT=DEFAULT_LOG_SAMPLE_RATE)
 
     Returns None
     """
+    log_format = log_format or os.environ.get("IR_LOG_FORMAT", "text")
+    account_detail = account_detail or os.environ.get("IR_LOG_ACCOUNT_DETAIL", "full")
+    sample_rate = sample_rate or int(os.environ.get("IR_LOG_SAMPLE_RATE", DEFAULT_LOG_SAMPLE_RATE))
+    if log_format not in LOG_FORMATS:
+        raise ValueError(f"Unsupported log format {log_format}")
+    if account_detail not in ACCOUNT_LOG_DETAILS:
+        raise ValueError(f"Unsupported account log detail {account_detail}")
+
+    with _ACCOUNT_EVENT_LOCK:
+        _ACCOUNT_LOG_SETTINGS["detail"] = account_detail
+        _ACCOUNT_LOG_SETTINGS["sample_rate"] = max(sample_rate, 1)
+
     param_dict = {
         "encoding": "utf-8",
         "format": '%(asctime)s | %(levelname)s:%(message)s',
@@ -179,9 +1191,88 @@ def setup_logging(log_filename=None, log_level=None):
     if param_dict["level"] != logging.DEBUG:
         logging.getLogger('botocore').setLevel(logging.WARNING)
 
+    if log_format == "json":
+        if log_filename:
+            handler = logging.FileHandler(log_filename, encoding="utf-8")
+        else:
+            handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        # Replaces any handler already installed, such as the Lambda runtime's
+        param_dict = {"level": param_dict["level"], "handlers": [handler], "force": True}
+
     logging.basicConfig(**param_dict)
 
 
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as single line json documents.  Values passed to the
+    logging call with extra are added as fields of the document.
+    """
+    def format(self, record):
+        log_dict = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        log_dict.update({key: value for key, value in vars(record).items()
+                         if key not in _LOG_RECORD_ATTRIBUTES})
+        if record.exc_info:
+            log_dict["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(log_dict, default=str)
+
+
+def log_account_event(service, region, action, account_id):
+    """
+    Records a per account event, such as an account being added as a member.
+    The event is counted for the per region summary logged by
+    flush_account_events and, depending on the account detail set by
+    setup_logging, logged as its own record.  Formatting is deferred to the
+    logging module so dropped records cost no formatting.
+    Args:
+    service - AWS service name
+    region - AWS region string
+    action - Action taken for the account, e.g. "added"
+    account_id - AWS account id
+
+    Returns None
+    """
+    with _ACCOUNT_EVENT_LOCK:
+        _ACCOUNT_EVENT_COUNTS[(service, region, action)] += 1
+        count = _ACCOUNT_EVENT_COUNTS[(service, region, action)]
+        detail = _ACCOUNT_LOG_SETTINGS["detail"]
+        sample_rate = _ACCOUNT_LOG_SETTINGS["sample_rate"]
+
+    if detail == "full" or (detail == "sample" and count % sample_rate == 1 % sample_rate):
+        logging.info("Account %s %s as %s member in %s", account_id, action, service, region,
+                     extra={"service": service, "region": region, "action": action,
+                            "account": account_id})
+
+
+def flush_account_events(service=None, region=None):
+    """
+    Logs one summary record for every (service, region, action) with account
+    events recorded by log_account_event and resets their counts.
+    Kargs:
+    service - Only flush events for this AWS service name
+    region - Only flush events for this AWS region
+
+    Returns dictionary of (service, region, action) to the number of events
+    """
+    with _ACCOUNT_EVENT_LOCK:
+        key_list = [key for key in _ACCOUNT_EVENT_COUNTS
+                    if service in [None, key[0]] and region in [None, key[1]]]
+        return_dict = {key: _ACCOUNT_EVENT_COUNTS.pop(key) for key in key_list}
+
+    for (event_service, event_region, action), count in sorted(return_dict.items()):
+        logging.info("%d accounts %s as %s members in %s", count, action, event_service, event_region,
+                     extra={"service": event_service, "region": event_region, "action": action,
+                            "count": count})
+
+    return return_dict
+
+
 def import_module(module_filename):
     """
     Helper function that performs a dynamic import of the python module
@@ -0,0 +1,311 @@
+"""
+Module containing the FindingIndex class, an in memory index that correlates
+the findings reported for the same resource by GuardDuty, Inspector and
+Security Hub and merges their duplicates.  The findings of the three
+services are read in the AWS Security Finding Format from Security Hub,
+which receives the GuardDuty and Inspector findings through its product
+integrations, either from the files of a findings export or pulled live
+from the delegated admin account (see findings.py).
+"""
+import heapq
+import threading
+from array import array
+from datetime import datetime, timedelta, timezone
+
+import findings
+
+
+# Finding fields duplicates are identified by, together with the resource
+DEDUP_KEYS = ["generator", "types"]
+SEVERITY_INDEX = {label: index for index, label in enumerate(findings.SEVERITY_LABELS)}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class _StringTable:
+    """
+    Interns strings, or any hashable value, to consecutive integer indexes.
+    """
+    __slots__ = ("index_dict", "value_list")
+
+    def __init__(self):
+        self.index_dict = {}
+        self.value_list = []
+
+    def __len__(self):
+        return len(self.value_list)
+
+    def intern(self, value):
+        """
+        Returns the index of the value, adding the value if it is new.
+        """
+        index = self.index_dict.get(value)
+        if index is None:
+            index = self.index_dict[value] = len(self.value_list)
+            self.value_list.append(value)
+        return index
+
+
+class FindingIndex:
+    """
+    Deduplicated findings keyed by resource, account, region and severity.
+    Findings for the same resource with the same GeneratorId (or the same
+    Types) are merged into one row that keeps the highest severity, the
+    latest update, the number of findings merged and the set of products
+    that reported them.  A finding with several resources is found from any
+    of them, duplicates are found from the resources of the first finding
+    of their row.
+
+    Rows are stored column by column in typed arrays of interned indexes,
+    with integer row lists per resource, account and severity and a running
+    count of rows per account and severity.  Memory grows by a few dozen
+    bytes per row plus the finding id and the (resource, rule) key of the
+    row, and the lookups only compare the rows of one row list.
+    """
+    def __init__(self, dedup_by="generator"):
+        """
+        Kargs:
+        dedup_by - One of DEDUP_KEYS
+        """
+        if dedup_by not in DEDUP_KEYS:
+            raise ValueError(f"Unsupported dedup key {dedup_by}")
+        self.dedup_by = dedup_by
+        # Findings added, including the duplicates merged into a row
+        self.findings = 0
+
+        self.__resources = _StringTable()
+        self.__accounts = _StringTable()
+        self.__regions = _StringTable()
+        self.__rules = _StringTable()
+        self.__titles = _StringTable()
+        self.__products = _StringTable()
+        # Sorted tuples of product indexes
+        self.__product_sets = _StringTable()
+
+        # Columns, one entry per row
+        self.__id_column = []
+        self.__resource_column = array("I")
+        self.__account_column = array("I")
+        self.__region_column = array("H")
+        self.__rule_column = array("I")
+        self.__title_column = array("I")
+        self.__severity_column = array("B")
+        self.__product_column = array("H")
+        # Microseconds since the epoch
+        self.__updated_column = array("q")
+        self.__count_column = array("I")
+
+        # Row of every (resource, rule), as resource << 32 | rule
+        self.__row_dict = {}
+        self.__resource_rows = {}
+        self.__account_rows = {}
+        self.__severity_rows = [array("I") for _ in findings.SEVERITY_LABELS]
+        # Rows per account index for every severity
+        self.__severity_counts = [array("I") for _ in findings.SEVERITY_LABELS]
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__id_column)
+
+    def add(self, finding):
+        """
+        Adds a finding, merging it into the row of its resource and rule when
+        there is one.
+        Args:
+        finding - Finding dictionary in the AWS Security Finding Format
+
+        Returns None
+        """
+        with self.__lock:
+            self._add(finding)
+
+    def add_page(self, shard, page):
+        """
+        Adds a page of findings.  Accepts the arguments of the page_function
+        of findings.pull_findings so findings can be indexed as they are
+        pulled.
+        Args:
+        shard - (region, shard name) tuple of the page
+        page - list of finding dictionaries
+
+        Returns None
+        """
+        with self.__lock:
+            for finding in page:
+                self._add(finding)
+
+    def _add(self, finding):
+        account_id = finding["AwsAccountId"]
+        resource_list = [resource["Id"] for resource in finding.get("Resources") or [] if resource.get("Id")]
+        if not resource_list:
+            resource_list = [f"AWS::::Account:{account_id}"]
+
+        if self.dedup_by == "types" and finding.get("Types"):
+            rule = ",".join(sorted(finding["Types"]))
+        else:
+            rule = finding["GeneratorId"]
+
+        self.findings += 1
+        resource_index = self.__resources.intern(resource_list[0])
+        rule_index = self.__rules.intern(rule)
+        product_index = self.__products.intern(finding.get("ProductName") or finding.get("ProductArn"))
+        severity = SEVERITY_INDEX.get((finding.get("Severity") or {}).get("Label"), 0)
+        updated = _epoch(finding.get("UpdatedAt"))
+
+        row = self.__row_dict.get(resource_index << 32 | rule_index)
+        if row is None:
+            row = self.__row_dict[resource_index << 32 | rule_index] = len(self.__id_column)
+            account_index = self.__accounts.intern(account_id)
+            if account_index == len(self.__severity_counts[0]):
+                for count_list in self.__severity_counts:
+                    count_list.append(0)
+
+            self.__id_column.append(finding["Id"])
+            self.__resource_column.append(resource_index)
+            self.__account_column.append(account_index)
+            self.__region_column.append(self.__regions.intern(finding.get("Region") or ""))
+            self.__rule_column.append(rule_index)
+            self.__title_column.append(self.__titles.intern(finding.get("Title") or ""))
+            self.__severity_column.append(severity)
+            self.__product_column.append(self.__product_sets.intern((product_index,)))
+            self.__updated_column.append(updated)
+            self.__count_column.append(1)
+
+            self.__account_rows.setdefault(account_index, array("I")).append(row)
+            self.__severity_rows[severity].append(row)
+            self.__severity_counts[severity][account_index] += 1
+            for resource_id in resource_list:
+                self.__resource_rows.setdefault(self.__resources.intern(resource_id), array("I")).append(row)
+            return
+
+        self.__count_column[row] += 1
+        product_set = self.__product_sets.value_list[self.__product_column[row]]
+        if product_index not in product_set:
+            self.__product_column[row] = self.__product_sets.intern(tuple(sorted(product_set + (product_index,))))
+
+        if updated >= self.__updated_column[row]:
+            self.__id_column[row] = finding["Id"]
+            self.__title_column[row] = self.__titles.intern(finding.get("Title") or "")
+            self.__updated_column[row] = updated
+
+        if severity > self.__severity_column[row]:
+            account_index = self.__account_column[row]
+            self.__severity_counts[self.__severity_column[row]][account_index] -= 1
+            self.__severity_counts[severity][account_index] += 1
+            self.__severity_column[row] = severity
+            # The row stays in the list of its old severity, select checks the column
+            self.__severity_rows[severity].append(row)
+
+    def resource_findings(self, resource_id):
+        """
+        Returns the rows of every finding touching the resource, highest
+        severity and latest update first.
+        Args:
+        resource_id - Resource ARN or id, as in the Resources of the findings
+        """
+        return self.select(resource_id=resource_id)
+
+    def select(self, resource_id=None, account_id=None, region=None, severity=None, limit=None):
+        """
+        Returns the rows matching every criteria given, highest severity and
+        latest update first.  The rows are looked up in the row list of the
+        resource, account or severity and only the rows of that list are
+        compared.
+        Kargs:
+        resource_id - Resource ARN or id
+        account_id - AWS account id
+        region - AWS region
+        severity - Severity label
+        limit - Maximum number of rows returned
+
+        Returns list of row dictionaries, see row
+        """
+        with self.__lock:
+            severity_index = None if severity is None else SEVERITY_INDEX[severity]
+            account_index = self.__accounts.index_dict.get(account_id, -1) if account_id else None
+            region_index = self.__regions.index_dict.get(region, -1) if region else None
+
+            if resource_id:
+                row_list = self.__resource_rows.get(self.__resources.index_dict.get(resource_id), ())
+            elif account_id:
+                row_list = self.__account_rows.get(account_index, ())
+            elif severity_index is not None:
+                row_list = self.__severity_rows[severity_index]
+            else:
+                row_list = range(len(self.__id_column))
+
+            match_list = [row for row in row_list
+                          if (account_index is None or self.__account_column[row] == account_index)
+                          and (region_index is None or self.__region_column[row] == region_index)
+                          and (severity_index is None or self.__severity_column[row] == severity_index)]
+            # A row is listed again under the severity it was raised to
+            match_list = list(dict.fromkeys(match_list))
+
+            def sort_key(row):
+                return self.__severity_column[row], self.__updated_column[row]
+
+            if limit is None:
+                match_list.sort(key=sort_key, reverse=True)
+            else:
+                match_list = heapq.nlargest(limit, match_list, key=sort_key)
+            return [self._row(row) for row in match_list]
+
+    def top_accounts(self, count=10, severity="CRITICAL"):
+        """
+        Returns the accounts with the most rows of a severity.
+        Kargs:
+        count - Number of accounts returned
+        severity - Severity label
+
+        Returns list of (aws account id, number of rows) tuples, most rows first
+        """
+        with self.__lock:
+            count_list = self.__severity_counts[SEVERITY_INDEX[severity]]
+            top_list = heapq.nlargest(count, range(len(count_list)), key=count_list.__getitem__)
+            return [(self.__accounts.value_list[index], count_list[index]) for index in top_list
+                    if count_list[index]]
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of findings added, rows,
+        duplicates merged, resources, accounts and rows per severity.
+        """
+        with self.__lock:
+            return {
+                "findings": self.findings,
+                "rows": len(self.__id_column),
+                "duplicates": self.findings - len(self.__id_column),
+                "resources": len(self.__resource_rows),
+                "accounts": len(self.__accounts),
+                "severity": {label: sum(self.__severity_counts[index])
+                             for label, index in SEVERITY_INDEX.items()}
+            }
+
+    def _row(self, row):
+        """
+        Returns the dictionary of a row.
+        """
+        return {
+            "id": self.__id_column[row],
+            "resource": self.__resources.value_list[self.__resource_column[row]],
+            "account": self.__accounts.value_list[self.__account_column[row]],
+            "region": self.__regions.value_list[self.__region_column[row]],
+            "rule": self.__rules.value_list[self.__rule_column[row]],
+            "title": self.__titles.value_list[self.__title_column[row]],
+            "severity": findings.SEVERITY_LABELS[self.__severity_column[row]],
+            "products": [self.__products.value_list[index]
+                         for index in self.__product_sets.value_list[self.__product_column[row]]],
+            "updated": (EPOCH + timedelta(microseconds=self.__updated_column[row])).isoformat(),
+            "count": self.__count_column[row]
+        }
+
+
+def _epoch(timestamp):
+    """
+    Returns the microseconds since the epoch of an ASFF timestamp, 0 when it
+    is missing or cannot be parsed, so findings updated in the same second
+    are still ordered.
+    """
+    value = findings.parse_time(timestamp)
+    if value is None:
+        return 0
+    return (value - EPOCH) // timedelta(microseconds=1)
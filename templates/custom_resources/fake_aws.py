@@ -0,0 +1,1354 @@
+"""
+Local stand-in for the AWS endpoints called by the IR solution, used to load
+test IRManager at organization scale on a single machine without network
+access.  The server implements the subset of the Organizations, STS, Account,
+SSM, Security Hub, GuardDuty and Inspector2 APIs called by the service
+modules on top of a synthetic in memory organization, and can add latency,
+throttling and errors to the responses.
+
+Requests go through the full botocore serialization, signing, HTTP and
+parsing path.  The operation of each request is found from the botocore
+service model of the service named in the request signature, so the
+handlers receive the same parameters as the boto3 call.  The account making
+a call is the account of the credentials returned by the fake STS, or the
+management account for any other credentials.
+
+The server runs from the command line or in process:
+
+    python fake_aws.py --accounts 10000 --port 4566 --latency 0.05 --rate-limit 20
+    python ir_setup.py --config config.json --create --force --endpoint-url http://127.0.0.1:4566
+
+    with fake_aws.FakeAwsServer(fake_aws.FakeAwsBackend(fake_aws.SyntheticOrg(10000))) as server:
+        common.set_endpoint_url(server.endpoint_url)
+        ir_setup.IRManager().ir_create(config_dict, force=True)
+"""
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from uuid import uuid4
+from xml.sax.saxutils import escape
+
+import botocore.session
+from botocore import xform_name
+
+import common
+
+
+DEFAULT_PORT = 4566
+DEFAULT_ACCOUNT_COUNT = 100
+DEFAULT_MANAGEMENT_ACCOUNT = "111111111111"
+DEFAULT_REGIONS = [
+    "us-east-1", "us-east-2", "us-west-1", "us-west-2", "ca-central-1",
+    "eu-west-1", "eu-west-2", "eu-west-3", "eu-central-1", "eu-north-1",
+    "ap-south-1", "ap-northeast-1", "ap-northeast-2", "ap-northeast-3",
+    "ap-southeast-1", "ap-southeast-2", "sa-east-1"
+]
+# Services served, by the signing name found in the request signature
+FAKE_SERVICES = ["organizations", "sts", "account", "ssm", "securityhub", "guardduty", "inspector2"]
+# Prefix of the access keys returned by the fake STS, followed by the account id
+ASSUMED_KEY_PREFIX = "ASIA"
+DEFAULT_PAGE_SIZE = 50
+SEVERITY_LABELS = ["INFORMATIONAL", "LOW", "MEDIUM", "HIGH", "CRITICAL"]
+# Severity of a synthetic finding drawn from this list, so most findings have
+# a low severity
+FINDING_SEVERITIES = ["INFORMATIONAL"] * 5 + ["LOW"] * 5 + ["MEDIUM"] * 3 + ["HIGH"] * 2 + ["CRITICAL"]
+# Product name and generator prefix of the synthetic findings
+FINDING_PRODUCTS = [("GuardDuty", "guardduty"), ("Inspector", "inspector"), ("Security Hub", "securityhub")]
+# Resources and finding rules per account, so findings share resources and rules
+FINDING_RESOURCES = 8
+FINDING_RULES = 12
+# Days the UpdatedAt of the synthetic findings are spread over
+FINDING_DAYS = 30
+# Security Hub filter names to the value of a finding they compare
+FINDING_STRING_FILTERS = {
+    "AwsAccountId": lambda finding: finding["AwsAccountId"],
+    "Region": lambda finding: finding["Region"],
+    "SeverityLabel": lambda finding: finding["Severity"]["Label"],
+    "ProductName": lambda finding: finding["ProductName"],
+    "GeneratorId": lambda finding: finding["GeneratorId"],
+    "ResourceId": lambda finding: finding["Resources"][0]["Id"]
+}
+
+_SIGNATURE_PATTERN = re.compile(r"Credential=([^/]+)/[^/]+/([^/]+)/([^/]+)/aws4_request")
+
+
+class FakeAwsError(Exception):
+    """
+    Raised by a handler to return an AWS error response.
+    """
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class FakeCall:
+    """
+    A single API call received by the server.
+    """
+    __slots__ = ("service", "region", "account", "operation")
+
+    def __init__(self, service, region, account, operation):
+        self.service = service
+        self.region = region
+        self.account = account
+        self.operation = operation
+
+
+class SyntheticOrg:
+    """
+    Synthetic organization of a management account and account_count active
+    member accounts with sequential account ids.  The member accounts are
+    spread over the root and a tree of organizational units with ou_fanout
+    children per level, ou_depth levels deep.
+    """
+    def __init__(self, account_count=DEFAULT_ACCOUNT_COUNT,
+                 management_account=DEFAULT_MANAGEMENT_ACCOUNT, regions=None,
+                 ou_fanout=0, ou_depth=2):
+        """
+        Kargs:
+        account_count - Number of member accounts
+        management_account - Account id of the management account
+        regions - Regions enabled for the organization (DEFAULT=DEFAULT_REGIONS)
+        ou_fanout - Child organizational units of the root and of every unit,
+                    0 places every account under the root
+        ou_depth - Levels of organizational units
+        """
+        self.management_account = management_account
+        self.regions = regions or list(DEFAULT_REGIONS)
+        self.org_id = "o-" + hashlib.sha256(management_account.encode()).hexdigest()[:10]
+        joined = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+        self.root_id = "r-" + self.org_id[2:6]
+        # Organizational unit id to unit, parent id to child unit ids and to
+        # account ids, and child id to parent id
+        self.ous = {}
+        self.parent_ids = {}
+        self.child_ous = {self.root_id: []}
+        self.child_accounts = {self.root_id: []}
+        level = [self.root_id]
+        for depth in range(ou_depth if ou_fanout else 0):
+            next_level = []
+            for parent_id in level:
+                for child in range(ou_fanout):
+                    ou_id = f"ou-{self.root_id[2:]}-{len(self.ous) + 1:08x}"
+                    self.ous[ou_id] = {
+                        "Id": ou_id,
+                        "Arn": f"arn:aws:organizations::{management_account}:ou/{self.org_id}/{ou_id}",
+                        "Name": f"ou-{depth + 1}-{len(self.ous) + 1}"}
+                    self.child_ous[parent_id].append(ou_id)
+                    self.parent_ids[ou_id] = parent_id
+                    self.child_ous[ou_id] = []
+                    self.child_accounts[ou_id] = []
+                    next_level.append(ou_id)
+            level = next_level
+        parent_list = [self.root_id] + list(self.ous)
+
+        self.accounts = {}
+        for index in range(account_count + 1):
+            account_id = management_account if index == 0 else f"{100000000000 + index:012d}"
+            self.accounts[account_id] = {
+                "Id": account_id,
+                "Arn": f"arn:aws:organizations::{management_account}:account/{self.org_id}/{account_id}",
+                "Email": f"aws+{account_id}@example.com",
+                "Name": "management" if index == 0 else f"member-{index:05d}",
+                "Status": "ACTIVE",
+                "JoinedMethod": "CREATED" if index == 0 else "INVITED",
+                "JoinedTimestamp": joined
+            }
+            self.child_accounts[parent_list[index % len(parent_list)]].append(account_id)
+            self.parent_ids[account_id] = parent_list[index % len(parent_list)]
+
+
+class FakeAwsBackend:
+    """
+    In memory state of the fake services and the handlers of their
+    operations.  A handler is the method named <service>_<operation> in
+    snake case, e.g. securityhub_create_members, and returns the operation
+    output keyed by member names.
+    """
+    def __init__(self, org, scan_enable_delay=0, findings_per_account=0):
+        """
+        Args:
+        org - SyntheticOrg
+        Kargs:
+        scan_enable_delay - Seconds Inspector scans stay ENABLING after they
+                            are enabled for an account
+        findings_per_account - Synthetic findings of every account in every
+                               region, generated when they are requested
+        """
+        self.org = org
+        self.scan_enable_delay = scan_enable_delay
+        self.findings_per_account = findings_per_account
+        self.findings_epoch = datetime.now(timezone.utc).replace(microsecond=0)
+        self.__account_list = sorted(org.accounts)
+        self.__lock = threading.RLock()
+        self.__service_access = {}
+        self.__delegated_admins = {}
+        # (service, region) to admin account id
+        self.__org_admins = {}
+        # (service, region) to organization configuration dictionary
+        self.__org_configs = {}
+        # (service, region) to dictionary of account id to member dictionary
+        self.__members = {}
+        # Security Hub finding aggregators by account id
+        self.__aggregators = {}
+        self.__hub_accounts = set()
+        # (region, account) to dictionary of resource type to time enabled
+        self.__scans = {}
+        self.__parameters = {}
+
+    def handler(self, call):
+        """
+        Returns the handler method of the call or None if the operation is
+        not implemented.
+        Args:
+        call - FakeCall
+        """
+        return getattr(self, f"{call.service}_{xform_name(call.operation)}", None)
+
+    def account_for_key(self, access_key):
+        """
+        Returns the account id of the credentials with the access key.
+        Args:
+        access_key - Access key id from the request signature
+        """
+        account_id = access_key[len(ASSUMED_KEY_PREFIX):]
+        if access_key.startswith(ASSUMED_KEY_PREFIX) and account_id in self.org.accounts:
+            return account_id
+        return self.org.management_account
+
+    # Helpers
+
+    @staticmethod
+    def _page(item_list, params, token_key="NextToken", max_key="MaxResults"):
+        """
+        Returns one page of item_list and the token of the next page or None.
+        """
+        start = int(params.get(token_key) or 0)
+        end = start + int(params.get(max_key) or DEFAULT_PAGE_SIZE)
+        return item_list[start:end], str(end) if end < len(item_list) else None
+
+    def _require_management(self, call):
+        if call.account != self.org.management_account:
+            raise FakeAwsError("AccessDeniedException",
+                               f"Account {call.account} is not the organization management account")
+
+    def _require_admin(self, call, code):
+        if self.__org_admins.get((call.service, call.region)) != call.account:
+            raise FakeAwsError(code, f"Account {call.account} is not the {call.service} "
+                                     f"administrator in {call.region}")
+
+    def _members(self, call):
+        return self.__members.setdefault((call.service, call.region), {})
+
+    def _org_account(self, account_id, code="AccountNotFoundException"):
+        account = self.org.accounts.get(account_id)
+        if not account:
+            raise FakeAwsError(code, f"Account {account_id} is not a member of the organization")
+        return account
+
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc)
+
+    # STS
+
+    def sts_assume_role(self, call, params):
+        account_id = params["RoleArn"].split(":")[4]
+        self._org_account(account_id, code="AccessDenied")
+        return {
+            "Credentials": {
+                "AccessKeyId": f"{ASSUMED_KEY_PREFIX}{account_id}",
+                "SecretAccessKey": "fake-secret-key",
+                "SessionToken": f"fake-session-token-{account_id}",
+                "Expiration": self._now() + timedelta(hours=1)
+            },
+            "AssumedRoleUser": {
+                "AssumedRoleId": f"AROAFAKE:{params['RoleSessionName']}",
+                "Arn": params["RoleArn"].replace(":iam:", ":sts:").replace(":role/", ":assumed-role/")
+            }
+        }
+
+    def sts_get_caller_identity(self, call, params):
+        return {"Account": call.account, "UserId": f"AIDAFAKE{call.account}",
+                "Arn": f"arn:aws:iam::{call.account}:user/fake"}
+
+    # Account
+
+    def account_list_regions(self, call, params):
+        return {"Regions": [{"RegionName": region, "RegionOptStatus": "ENABLED_BY_DEFAULT"}
+                            for region in self.org.regions]}
+
+    # SSM
+
+    def ssm_get_parameter(self, call, params):
+        with self.__lock:
+            value = self.__parameters.get((call.account, call.region, params["Name"]))
+        if value is None:
+            raise FakeAwsError("ParameterNotFound", f"Parameter {params['Name']} not found")
+        return {"Parameter": {"Name": params["Name"], "Type": "String", "Value": value, "Version": 1}}
+
+    def ssm_put_parameter(self, call, params):
+        with self.__lock:
+            self.__parameters[(call.account, call.region, params["Name"])] = params["Value"]
+        return {"Version": 1}
+
+    # Organizations
+
+    def organizations_list_accounts(self, call, params):
+        self._require_management(call)
+        account_list, next_token = self._page(list(self.org.accounts.values()), params)
+        return {"Accounts": account_list, "NextToken": next_token}
+
+    def organizations_list_roots(self, call, params):
+        self._require_management(call)
+        return {"Roots": [{"Id": self.org.root_id, "Name": "Root", "PolicyTypes": [],
+                           "Arn": f"arn:aws:organizations::{self.org.management_account}:root/"
+                                  f"{self.org.org_id}/{self.org.root_id}"}]}
+
+    def organizations_list_organizational_units_for_parent(self, call, params):
+        self._require_management(call)
+        if params["ParentId"] not in self.org.child_ous:
+            raise FakeAwsError("ParentNotFoundException", f"Parent {params['ParentId']} not found")
+        ou_list, next_token = self._page([self.org.ous[ou_id] for ou_id in self.org.child_ous[params["ParentId"]]],
+                                         params)
+        return {"OrganizationalUnits": ou_list, "NextToken": next_token}
+
+    def organizations_list_accounts_for_parent(self, call, params):
+        self._require_management(call)
+        if params["ParentId"] not in self.org.child_accounts:
+            raise FakeAwsError("ParentNotFoundException", f"Parent {params['ParentId']} not found")
+        account_list, next_token = self._page([self.org.accounts[account_id] for account_id in
+                                               self.org.child_accounts[params["ParentId"]]], params)
+        return {"Accounts": account_list, "NextToken": next_token}
+
+    def organizations_list_parents(self, call, params):
+        self._require_management(call)
+        parent_id = self.org.parent_ids.get(params["ChildId"])
+        if not parent_id:
+            raise FakeAwsError("ChildNotFoundException", f"Child {params['ChildId']} not found")
+        return {"Parents": [{"Id": parent_id,
+                             "Type": "ROOT" if parent_id == self.org.root_id else "ORGANIZATIONAL_UNIT"}]}
+
+    def organizations_describe_organization(self, call, params):
+        management = self.org.accounts[self.org.management_account]
+        return {"Organization": {
+            "Id": self.org.org_id,
+            "Arn": f"arn:aws:organizations::{management['Id']}:organization/{self.org.org_id}",
+            "FeatureSet": "ALL", "MasterAccountId": management["Id"],
+            "MasterAccountArn": management["Arn"], "MasterAccountEmail": management["Email"]}}
+
+    def organizations_describe_account(self, call, params):
+        self._require_management(call)
+        return {"Account": self._org_account(params["AccountId"])}
+
+    def organizations_enable_aws_service_access(self, call, params):
+        self._require_management(call)
+        with self.__lock:
+            self.__service_access.setdefault(params["ServicePrincipal"], self._now())
+        return {}
+
+    def organizations_disable_aws_service_access(self, call, params):
+        self._require_management(call)
+        with self.__lock:
+            self.__service_access.pop(params["ServicePrincipal"], None)
+        return {}
+
+    def organizations_list_aws_service_access_for_organization(self, call, params):
+        self._require_management(call)
+        with self.__lock:
+            service_list = [{"ServicePrincipal": principal, "DateEnabled": enabled}
+                            for principal, enabled in sorted(self.__service_access.items())]
+        service_list, next_token = self._page(service_list, params)
+        return {"EnabledServicePrincipals": service_list, "NextToken": next_token}
+
+    def organizations_register_delegated_administrator(self, call, params):
+        self._require_management(call)
+        self._org_account(params["AccountId"])
+        with self.__lock:
+            if params["ServicePrincipal"] not in self.__service_access:
+                raise FakeAwsError("ConstraintViolationException",
+                                   f"Service access is not enabled for {params['ServicePrincipal']}")
+            if params["ServicePrincipal"] in self.__delegated_admins:
+                raise FakeAwsError("AccountAlreadyRegisteredException",
+                                   f"A delegated administrator is already registered for "
+                                   f"{params['ServicePrincipal']}")
+            self.__delegated_admins[params["ServicePrincipal"]] = (params["AccountId"], self._now())
+        return {}
+
+    def organizations_deregister_delegated_administrator(self, call, params):
+        self._require_management(call)
+        with self.__lock:
+            if self.__delegated_admins.get(params["ServicePrincipal"], (None,))[0] != params["AccountId"]:
+                raise FakeAwsError("AccountNotRegisteredException",
+                                   f"Account {params['AccountId']} is not a delegated administrator "
+                                   f"for {params['ServicePrincipal']}")
+            del self.__delegated_admins[params["ServicePrincipal"]]
+        return {}
+
+    def organizations_list_delegated_administrators(self, call, params):
+        self._require_management(call)
+        with self.__lock:
+            admin_list = [dict(self.org.accounts[account_id], DelegationEnabledDate=enabled)
+                          for principal, (account_id, enabled) in sorted(self.__delegated_admins.items())
+                          if params.get("ServicePrincipal") in [None, principal]]
+        admin_list, next_token = self._page(admin_list, params)
+        return {"DelegatedAdministrators": admin_list, "NextToken": next_token}
+
+    def organizations_list_delegated_services_for_account(self, call, params):
+        self._require_management(call)
+        with self.__lock:
+            service_list = [{"ServicePrincipal": principal, "DelegationEnabledDate": enabled}
+                            for principal, (account_id, enabled) in sorted(self.__delegated_admins.items())
+                            if account_id == params["AccountId"]]
+        if not service_list:
+            raise FakeAwsError("AccountNotRegisteredException",
+                               f"Account {params['AccountId']} is not a delegated administrator")
+        service_list, next_token = self._page(service_list, params)
+        return {"DelegatedServices": service_list, "NextToken": next_token}
+
+    # Organization admin of Security Hub, GuardDuty and Inspector
+
+    def _enable_org_admin(self, call, account_id, code, message):
+        self._org_account(account_id, code="InvalidInputException")
+        with self.__lock:
+            if self.__org_admins.get((call.service, call.region)) == account_id:
+                raise FakeAwsError(code, message)
+            self.__org_admins[(call.service, call.region)] = account_id
+
+    def _disable_org_admin(self, call, account_id, code, message):
+        with self.__lock:
+            if self.__org_admins.get((call.service, call.region)) != account_id:
+                raise FakeAwsError(code, message)
+            del self.__org_admins[(call.service, call.region)]
+
+    def _admin_list(self, call):
+        with self.__lock:
+            admin = self.__org_admins.get((call.service, call.region))
+        return [admin] if admin else []
+
+    # Security Hub
+
+    def securityhub_enable_organization_admin_account(self, call, params):
+        self._require_management(call)
+        self._enable_org_admin(call, params["AdminAccountId"], "ResourceConflictException",
+                               "Account is already the Security Hub administrator")
+        with self.__lock:
+            self.__hub_accounts.add((params["AdminAccountId"], call.region))
+        return {}
+
+    def securityhub_disable_organization_admin_account(self, call, params):
+        self._require_management(call)
+        self._disable_org_admin(call, params["AdminAccountId"], "ResourceNotFoundException",
+                                "Admin account was not found for this organization")
+        return {}
+
+    def securityhub_list_organization_admin_accounts(self, call, params):
+        return {"AdminAccounts": [{"AccountId": admin, "Status": "ENABLED"}
+                                  for admin in self._admin_list(call)]}
+
+    def securityhub_enable_security_hub(self, call, params):
+        with self.__lock:
+            if (call.account, call.region) in self.__hub_accounts:
+                raise FakeAwsError("ResourceConflictException", "Account is already subscribed to Security Hub")
+            self.__hub_accounts.add((call.account, call.region))
+        return {}
+
+    def securityhub_describe_organization_configuration(self, call, params):
+        self._require_admin(call, "InvalidAccessException")
+        with self.__lock:
+            config = self.__org_configs.get((call.service, call.region), {})
+        return {"AutoEnable": config.get("AutoEnable", False), "MemberAccountLimitReached": False,
+                "AutoEnableStandards": config.get("AutoEnableStandards", "NONE")}
+
+    def securityhub_update_organization_configuration(self, call, params):
+        self._require_admin(call, "InvalidAccessException")
+        with self.__lock:
+            self.__org_configs[(call.service, call.region)] = {
+                "AutoEnable": params["AutoEnable"],
+                "AutoEnableStandards": params.get("AutoEnableStandards", "DEFAULT")}
+        return {}
+
+    def securityhub_create_finding_aggregator(self, call, params):
+        with self.__lock:
+            if call.account in self.__aggregators:
+                raise FakeAwsError("InvalidInputException", "A finding aggregator already exists")
+            self.__aggregators[call.account] = {
+                "FindingAggregatorArn": f"arn:aws:securityhub:{call.region}:{call.account}:"
+                                        f"finding-aggregator/{uuid4()}",
+                "FindingAggregationRegion": call.region,
+                "RegionLinkingMode": params["RegionLinkingMode"],
+                "Regions": params.get("Regions", [])}
+            return dict(self.__aggregators[call.account])
+
+    def _aggregator(self, call, params):
+        aggregator = self.__aggregators.get(call.account)
+        if not aggregator or aggregator["FindingAggregatorArn"] != params["FindingAggregatorArn"]:
+            raise FakeAwsError("ResourceNotFoundException",
+                               f"Finding aggregator {params['FindingAggregatorArn']} not found", 404)
+        return aggregator
+
+    def securityhub_list_finding_aggregators(self, call, params):
+        with self.__lock:
+            aggregator = self.__aggregators.get(call.account)
+        return {"FindingAggregators": [{"FindingAggregatorArn": aggregator["FindingAggregatorArn"]}]
+                                      if aggregator else []}
+
+    def securityhub_get_finding_aggregator(self, call, params):
+        with self.__lock:
+            return dict(self._aggregator(call, params))
+
+    def securityhub_update_finding_aggregator(self, call, params):
+        with self.__lock:
+            aggregator = self._aggregator(call, params)
+            aggregator.update(RegionLinkingMode=params["RegionLinkingMode"],
+                              Regions=params.get("Regions", []))
+            return dict(aggregator)
+
+    def securityhub_delete_finding_aggregator(self, call, params):
+        with self.__lock:
+            self._aggregator(call, params)
+            del self.__aggregators[call.account]
+        return {}
+
+    def securityhub_create_members(self, call, params):
+        self._require_admin(call, "InvalidAccessException")
+        unprocessed_list = []
+        with self.__lock:
+            member_dict = self._members(call)
+            for detail in params["AccountDetails"]:
+                if detail["AccountId"] not in self.org.accounts:
+                    unprocessed_list.append({"AccountId": detail["AccountId"],
+                                             "ProcessingResult": "Account is not an organization member"})
+                    continue
+                member_dict[detail["AccountId"]] = {
+                    "AccountId": detail["AccountId"], "Email": detail.get("Email"),
+                    "AdministratorId": call.account, "MasterId": call.account,
+                    "MemberStatus": "Enabled", "InvitedAt": self._now(), "UpdatedAt": self._now()}
+        return {"UnprocessedAccounts": unprocessed_list}
+
+    def securityhub_get_members(self, call, params):
+        self._require_admin(call, "InvalidAccessException")
+        with self.__lock:
+            member_dict = self._members(call)
+            return {"Members": [member_dict[account] for account in params["AccountIds"]
+                                if account in member_dict],
+                    "UnprocessedAccounts": [{"AccountId": account, "ProcessingResult": "Not a member"}
+                                            for account in params["AccountIds"] if account not in member_dict]}
+
+    def synthetic_finding(self, region, account_id, number):
+        """
+        Returns a synthetic finding in the AWS Security Finding Format.  The
+        findings are derived from a hash of their region, account and number,
+        so the same finding is returned by every call.
+        """
+        digest = hashlib.md5(f"{region}:{account_id}:{number}".encode()).digest()
+        product_name, product_key = FINDING_PRODUCTS[digest[0] % len(FINDING_PRODUCTS)]
+        severity = FINDING_SEVERITIES[digest[1] % len(FINDING_SEVERITIES)]
+        rule = digest[2] % FINDING_RULES
+        resource_id = f"arn:aws:ec2:{region}:{account_id}:instance/i-{account_id}{digest[3] % FINDING_RESOURCES:05d}"
+        updated = self.findings_epoch - timedelta(seconds=int.from_bytes(digest[4:8], "big") % (FINDING_DAYS * 86400))
+        return {
+            "SchemaVersion": "2018-10-08",
+            "Id": f"arn:aws:{product_key}:{region}:{account_id}:finding/{digest.hex()}",
+            "ProductArn": f"arn:aws:securityhub:{region}::product/aws/{product_key}",
+            "ProductName": product_name,
+            "CompanyName": "AWS",
+            "Region": region,
+            "GeneratorId": f"{product_key}/rule-{rule}",
+            "AwsAccountId": account_id,
+            "Types": [f"TTPs/Category{rule % 4}/Rule{rule}"],
+            "CreatedAt": updated.isoformat(),
+            "UpdatedAt": updated.isoformat(),
+            "Severity": {"Label": severity, "Normalized": SEVERITY_LABELS.index(severity) * 25},
+            "Title": f"{product_name} rule {rule}",
+            "Description": f"Synthetic {product_name} finding for rule {rule}",
+            "Resources": [{"Type": "AwsEc2Instance", "Id": resource_id, "Region": region}],
+            "RecordState": "ACTIVE",
+            "Workflow": {"Status": "NEW"}
+        }
+
+    @staticmethod
+    def _match_finding(finding, filter_dict):
+        for name, filter_list in filter_dict.items():
+            if name in FINDING_STRING_FILTERS:
+                value = FINDING_STRING_FILTERS[name](finding)
+                if not any(value == string_filter["Value"] for string_filter in filter_list
+                           if string_filter.get("Comparison", "EQUALS") == "EQUALS"):
+                    return False
+            elif name in ["UpdatedAt", "CreatedAt"]:
+                for date_filter in filter_list:
+                    if date_filter.get("Start") and finding[name] < date_filter["Start"]:
+                        return False
+                    if date_filter.get("End") and finding[name] > date_filter["End"]:
+                        return False
+            else:
+                raise FakeAwsError("InvalidInputException", f"Unsupported filter {name}")
+        return True
+
+    def securityhub_get_findings(self, call, params):
+        self._require_admin(call, "InvalidAccessException")
+        filter_dict = params.get("Filters", {})
+        # Date filters are compared as isoformat strings of the same format
+        for name in ["UpdatedAt", "CreatedAt"]:
+            for date_filter in filter_dict.get(name, []):
+                for key in ["Start", "End"]:
+                    if date_filter.get(key):
+                        date_filter[key] = datetime.fromisoformat(
+                            date_filter[key].replace("Z", "+00:00")).astimezone(timezone.utc).isoformat()
+
+        account_list = self.__account_list if self.findings_per_account else []
+        if account_list and filter_dict.get("AwsAccountId"):
+            account_list = sorted(account_filter["Value"] for account_filter in filter_dict["AwsAccountId"]
+                                  if account_filter["Value"] in self.org.accounts)
+
+        # The token is the position of the next finding, as account position:number
+        account_index, number = (int(part) for part in (params.get("NextToken") or "0:0").split(":"))
+        max_results = int(params.get("MaxResults") or 100)
+        finding_list = []
+        while account_index < len(account_list) and len(finding_list) < max_results:
+            finding = self.synthetic_finding(call.region, account_list[account_index], number)
+            if self._match_finding(finding, filter_dict):
+                finding_list.append(finding)
+            number += 1
+            if number >= self.findings_per_account:
+                account_index, number = account_index + 1, 0
+
+        next_token = f"{account_index}:{number}" if account_index < len(account_list) else None
+        return {"Findings": finding_list, "NextToken": next_token}
+
+    def securityhub_list_members(self, call, params):
+        self._require_admin(call, "InvalidAccessException")
+        with self.__lock:
+            member_list = list(self._members(call).values())
+        member_list, next_token = self._page(member_list, params)
+        return {"Members": member_list, "NextToken": next_token}
+
+    def securityhub_disassociate_members(self, call, params):
+        self._require_admin(call, "InvalidAccessException")
+        with self.__lock:
+            member_dict = self._members(call)
+            for account in params["AccountIds"]:
+                if account in member_dict:
+                    member_dict[account]["MemberStatus"] = "Removed"
+        return {}
+
+    def securityhub_delete_members(self, call, params):
+        self._require_admin(call, "InvalidAccessException")
+        with self.__lock:
+            member_dict = self._members(call)
+            for account in params["AccountIds"]:
+                member_dict.pop(account, None)
+        return {"UnprocessedAccounts": []}
+
+    # GuardDuty
+
+    @staticmethod
+    def detector_id(account_id, region):
+        """
+        Returns the id of the GuardDuty detector of an account in a region.
+        """
+        return hashlib.md5(f"{account_id}:{region}".encode()).hexdigest()
+
+    def _check_detector(self, call, params):
+        if params["DetectorId"] != self.detector_id(call.account, call.region):
+            raise FakeAwsError("BadRequestException", f"The detector {params['DetectorId']} does not exist")
+
+    def guardduty_enable_organization_admin_account(self, call, params):
+        self._require_management(call)
+        self._enable_org_admin(call, params["AdminAccountId"], "BadRequestException",
+                               "The request failed because the account is already enabled as the "
+                               "GuardDuty delegated administrator for the organization.")
+        return {}
+
+    def guardduty_disable_organization_admin_account(self, call, params):
+        self._require_management(call)
+        self._disable_org_admin(call, params["AdminAccountId"], "BadRequestException",
+                                "The request failed because the delegated administrator account has "
+                                "already been disabled.")
+        return {}
+
+    def guardduty_list_organization_admin_accounts(self, call, params):
+        return {"AdminAccounts": [{"AdminAccountId": admin, "AdminStatus": "ENABLED"}
+                                  for admin in self._admin_list(call)]}
+
+    def guardduty_list_detectors(self, call, params):
+        return {"DetectorIds": [self.detector_id(call.account, call.region)]}
+
+    def guardduty_describe_organization_configuration(self, call, params):
+        self._require_admin(call, "BadRequestException")
+        self._check_detector(call, params)
+        with self.__lock:
+            auto_enable = self.__org_configs.get((call.service, call.region), {}).get("AutoEnable", False)
+        return {"AutoEnable": auto_enable, "MemberAccountLimitReached": False,
+                "AutoEnableOrganizationMembers": "NEW" if auto_enable else "NONE"}
+
+    def guardduty_update_organization_configuration(self, call, params):
+        self._require_admin(call, "BadRequestException")
+        self._check_detector(call, params)
+        with self.__lock:
+            self.__org_configs[(call.service, call.region)] = {"AutoEnable": params.get("AutoEnable", False)}
+        return {}
+
+    def guardduty_create_members(self, call, params):
+        self._require_admin(call, "BadRequestException")
+        self._check_detector(call, params)
+        unprocessed_list = []
+        with self.__lock:
+            member_dict = self._members(call)
+            for detail in params["AccountDetails"]:
+                if detail["AccountId"] not in self.org.accounts:
+                    unprocessed_list.append({"AccountId": detail["AccountId"],
+                                             "Result": "Account is not an organization member"})
+                    continue
+                member_dict[detail["AccountId"]] = {
+                    "AccountId": detail["AccountId"], "Email": detail.get("Email"),
+                    "DetectorId": self.detector_id(detail["AccountId"], call.region),
+                    "AdministratorId": call.account, "MasterId": call.account,
+                    "RelationshipStatus": "Enabled", "InvitedAt": self._now().isoformat(),
+                    "UpdatedAt": self._now().isoformat()}
+        return {"UnprocessedAccounts": unprocessed_list}
+
+    def guardduty_get_members(self, call, params):
+        self._require_admin(call, "BadRequestException")
+        self._check_detector(call, params)
+        with self.__lock:
+            member_dict = self._members(call)
+            return {"Members": [member_dict[account] for account in params["AccountIds"]
+                                if account in member_dict],
+                    "UnprocessedAccounts": [{"AccountId": account, "Result": "Not a member"}
+                                            for account in params["AccountIds"] if account not in member_dict]}
+
+    def guardduty_list_members(self, call, params):
+        self._require_admin(call, "BadRequestException")
+        self._check_detector(call, params)
+        with self.__lock:
+            member_list = list(self._members(call).values())
+        member_list, next_token = self._page(member_list, params)
+        return {"Members": member_list, "NextToken": next_token}
+
+    def guardduty_disassociate_members(self, call, params):
+        self._require_admin(call, "BadRequestException")
+        self._check_detector(call, params)
+        with self.__lock:
+            member_dict = self._members(call)
+            for account in params["AccountIds"]:
+                if account in member_dict:
+                    member_dict[account]["RelationshipStatus"] = "Removed"
+        return {"UnprocessedAccounts": []}
+
+    def guardduty_delete_members(self, call, params):
+        self._require_admin(call, "BadRequestException")
+        self._check_detector(call, params)
+        with self.__lock:
+            member_dict = self._members(call)
+            for account in params["AccountIds"]:
+                member_dict.pop(account, None)
+        return {"UnprocessedAccounts": []}
+
+    def guardduty_update_member_detectors(self, call, params):
+        self._require_admin(call, "BadRequestException")
+        self._check_detector(call, params)
+        return {"UnprocessedAccounts": []}
+
+    # Inspector2
+
+    def inspector2_enable_delegated_admin_account(self, call, params):
+        self._require_management(call)
+        self._enable_org_admin(call, params["delegatedAdminAccountId"], "ConflictException",
+                               f"Account {params['delegatedAdminAccountId']} is already enabled for "
+                               "the organization")
+        return {"delegatedAdminAccountId": params["delegatedAdminAccountId"]}
+
+    def inspector2_disable_delegated_admin_account(self, call, params):
+        self._require_management(call)
+        self._disable_org_admin(call, params["delegatedAdminAccountId"], "ResourceNotFoundException",
+                                f"Account {params['delegatedAdminAccountId']} is not the delegated "
+                                "administrator")
+        return {"delegatedAdminAccountId": params["delegatedAdminAccountId"]}
+
+    def inspector2_list_delegated_admin_accounts(self, call, params):
+        return {"delegatedAdminAccounts": [{"accountId": admin, "status": "ENABLED"}
+                                           for admin in self._admin_list(call)]}
+
+    def inspector2_describe_organization_configuration(self, call, params):
+        self._require_admin(call, "AccessDeniedException")
+        with self.__lock:
+            auto_enable = self.__org_configs.get((call.service, call.region),
+                                                 {"ec2": False, "ecr": False})
+        return {"autoEnable": auto_enable, "maxAccountLimitReached": False}
+
+    def inspector2_update_organization_configuration(self, call, params):
+        self._require_admin(call, "AccessDeniedException")
+        with self.__lock:
+            self.__org_configs[(call.service, call.region)] = dict(params["autoEnable"])
+        return {"autoEnable": params["autoEnable"]}
+
+    def inspector2_associate_member(self, call, params):
+        self._require_admin(call, "AccessDeniedException")
+        self._org_account(params["accountId"], code="ValidationException")
+        with self.__lock:
+            self._members(call)[params["accountId"]] = {
+                "accountId": params["accountId"], "relationshipStatus": "ENABLED",
+                "delegatedAdminAccountId": call.account, "updatedAt": self._now()}
+        return {"accountId": params["accountId"]}
+
+    def inspector2_disassociate_member(self, call, params):
+        self._require_admin(call, "AccessDeniedException")
+        with self.__lock:
+            self._members(call).pop(params["accountId"], None)
+        return {"accountId": params["accountId"]}
+
+    def inspector2_get_member(self, call, params):
+        self._require_admin(call, "AccessDeniedException")
+        with self.__lock:
+            member = self._members(call).get(params["accountId"])
+        if not member:
+            raise FakeAwsError("ResourceNotFoundException", f"Member {params['accountId']} not found", 404)
+        return {"member": member}
+
+    def inspector2_list_members(self, call, params):
+        self._require_admin(call, "AccessDeniedException")
+        with self.__lock:
+            member_list = list(self._members(call).values())
+        member_list, next_token = self._page(member_list, params, token_key="nextToken", max_key="maxResults")
+        return {"members": member_list, "nextToken": next_token}
+
+    def _scan_state(self, region, account_id):
+        scan_dict = self.__scans.get((region, account_id), {})
+        now = time.monotonic()
+        return {
+            state_key: {"status": "DISABLED" if resource_type not in scan_dict else
+                        "ENABLING" if now - scan_dict[resource_type] < self.scan_enable_delay else "ENABLED"}
+            for resource_type, state_key in [("EC2", "ec2"), ("ECR", "ecr"), ("LAMBDA", "lambda"),
+                                             ("LAMBDA_CODE", "lambdaCode")]
+        }
+
+    def inspector2_enable(self, call, params):
+        account_list = []
+        failed_list = []
+        with self.__lock:
+            member_dict = self._members(call)
+            for account_id in params.get("accountIds") or [call.account]:
+                if account_id != call.account and account_id not in member_dict:
+                    failed_list.append({"accountId": account_id, "errorCode": "ACCESS_DENIED",
+                                        "errorMessage": "Account is not a member"})
+                    continue
+
+                scan_dict = self.__scans.setdefault((call.region, account_id), {})
+                if set(params["resourceTypes"]) <= set(scan_dict):
+                    failed_list.append({"accountId": account_id, "errorCode": "ALREADY_ENABLED",
+                                        "errorMessage": "Scans are already enabled"})
+                    continue
+
+                for resource_type in params["resourceTypes"]:
+                    scan_dict.setdefault(resource_type, time.monotonic())
+                account_list.append({"accountId": account_id, "status": "ENABLING",
+                                     "resourceStatus": {"ec2": "ENABLING", "ecr": "ENABLING"}})
+        return {"accounts": account_list, "failedAccounts": failed_list}
+
+    def inspector2_batch_get_account_status(self, call, params):
+        with self.__lock:
+            account_list = [{"accountId": account_id, "state": {"status": "ENABLED"},
+                             "resourceState": self._scan_state(call.region, account_id)}
+                            for account_id in params.get("accountIds") or [call.account]]
+        return {"accounts": account_list, "failedAccounts": []}
+
+
+class RateLimiter:
+    """
+    Token bucket allowing rate calls per second with bursts of up to rate
+    calls.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.__tokens = rate
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token from the bucket.
+
+        Returns True if a token was available
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.rate, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            if self.__tokens < 1:
+                return False
+            self.__tokens -= 1
+            return True
+
+
+class FakeAwsServer(ThreadingHTTPServer):
+    """
+    HTTP server answering AWS API calls from a FakeAwsBackend.  Latency,
+    throttling and errors are added to the responses as configured.
+    """
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(self, backend, host="127.0.0.1", port=0, latency=0, jitter=0, throttle_rate=0,
+                 error_rate=0, rate_limit=None, failing_regions=None, seed=None):
+        """
+        Args:
+        backend - FakeAwsBackend
+        Kargs:
+        host - Address to listen on
+        port - Port to listen on, 0 picks a free port
+        latency - Seconds added to every response
+        jitter - Up to this many random seconds added to the latency
+        throttle_rate - Fraction of calls answered with a throttling error
+        error_rate - Fraction of calls answered with an internal server error
+        rate_limit - Calls per second allowed for each service region, calls
+                     above the limit are throttled
+        failing_regions - Regions where every call fails with service unavailable
+        seed - Seed of the random latency, throttling and errors
+        """
+        super().__init__((host, port), FakeAwsRequestHandler)
+        self.backend = backend
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.failing_regions = set(failing_regions or [])
+        self.__random = random.Random(seed)
+        self.__random_lock = threading.Lock()
+        self.__limiters = {}
+        self.__stats = Counter()
+        self.__stats_lock = threading.Lock()
+        self.__thread = None
+        self.__model_session = botocore.session.get_session()
+        self.__models = {}
+        self.__model_lock = threading.Lock()
+
+    @property
+    def endpoint_url(self):
+        """
+        Url to use as the endpoint_url of boto3 clients.
+        """
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        """
+        Serves requests from a background thread.
+
+        Returns the server
+        """
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+        logging.info("Fake AWS endpoint for %d accounts listening on %s",
+                     len(self.backend.org.accounts), self.endpoint_url)
+        return self
+
+    def stop(self):
+        """
+        Stops serving requests and closes the server socket.
+
+        Returns None
+        """
+        if self.__thread:
+            self.shutdown()
+            self.__thread.join()
+            self.__thread = None
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def get_stats(self):
+        """
+        Returns a dictionary of counts of the calls received, throttled and
+        failed, keyed by "<count>:<service>.<operation>" and "<count>" for
+        the totals.
+        """
+        with self.__stats_lock:
+            return dict(self.__stats)
+
+    def _count(self, name, call):
+        with self.__stats_lock:
+            self.__stats[name] += 1
+            self.__stats[f"{name}:{call.service}.{call.operation}"] += 1
+
+    def _random(self):
+        with self.__random_lock:
+            return self.__random.random()
+
+    def service_model(self, service):
+        """
+        Returns the botocore service model of a service.
+        """
+        with self.__model_lock:
+            if service not in self.__models:
+                self.__models[service] = self.__model_session.get_service_model(service)
+            return self.__models[service]
+
+    def handle_call(self, method, path, headers, body):
+        """
+        Answers a single API call.
+        Args:
+        method - HTTP method
+        path - Request path including the query string
+        headers - Request headers
+        body - Request body bytes
+
+        Returns tuple of (HTTP status, response headers dictionary, body bytes)
+        """
+        match = _SIGNATURE_PATTERN.search(headers.get("Authorization", ""))
+        if not match or match.group(3) not in FAKE_SERVICES:
+            return 400, {"Content-Type": "text/plain"}, b"Unsupported service"
+
+        access_key, region, service = match.groups()
+        service_model = self.service_model(service)
+        operation_model, params = parse_request(service_model, method, path, headers, body)
+        if not operation_model:
+            return 404, {"Content-Type": "text/plain"}, f"Unknown {service} operation {method} {path}".encode()
+
+        call = FakeCall(service, region, self.backend.account_for_key(access_key), operation_model.name)
+        self._count("calls", call)
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random() * self.jitter)
+
+        try:
+            handler = self.backend.handler(call)
+            if not handler:
+                raise FakeAwsError("InvalidAction", f"{service}.{call.operation} is not implemented")
+            if region in self.failing_regions:
+                raise FakeAwsError("ServiceUnavailable", f"{service} is unavailable in {region}", 503)
+            if self.rate_limit and not self._limiter(call).acquire():
+                raise FakeAwsError("Throttling" if service_model.protocol == "query" else "ThrottlingException",
+                                   "Rate exceeded")
+            if self.throttle_rate and self._random() < self.throttle_rate:
+                raise FakeAwsError("Throttling" if service_model.protocol == "query" else "ThrottlingException",
+                                   "Rate exceeded")
+            if self.error_rate and self._random() < self.error_rate:
+                raise FakeAwsError("InternalServerError", "Injected internal server error", 500)
+
+            result = handler(call, params)
+
+        except FakeAwsError as err:
+            self._count("throttled" if "Throttl" in err.code else "errors", call)
+            return serialize_error(service_model, err)
+
+        return serialize_response(operation_model, result)
+
+    def _limiter(self, call):
+        with self.__stats_lock:
+            return self.__limiters.setdefault((call.service, call.region), RateLimiter(self.rate_limit))
+
+
+class FakeAwsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Passes every HTTP request to FakeAwsServer.handle_call.  HTTP/1.1 is
+    used so botocore keeps its connections open between calls.
+    """
+    protocol_version = "HTTP/1.1"
+    # The headers and body are written separately, without TCP_NODELAY the
+    # body waits for the delayed ACK of the headers
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            status, header_dict, response_body = self.server.handle_call(self.command, self.path,
+                                                                          self.headers, body)
+        except Exception as err:
+            logging.exception("Fake AWS request %s %s failed", self.command, self.path)
+            status, header_dict, response_body = 500, {"Content-Type": "text/plain"}, str(err).encode()
+
+        self.send_response(status)
+        for name, value in header_dict.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        logging.debug("Fake AWS %s", format % args)
+
+
+def parse_request(service_model, method, path, headers, body):
+    """
+    Finds the operation of a request and parses its parameters.
+    Args:
+    service_model - botocore ServiceModel
+    method - HTTP method
+    path - Request path including the query string
+    headers - Request headers
+    body - Request body bytes
+
+    Returns tuple of (botocore OperationModel, parameter dictionary keyed by
+    member names), the operation is None when no operation matches
+    """
+    if service_model.protocol == "query":
+        form = {key: value[0] for key, value in parse_qs(body.decode()).items()}
+        operation_name = form.pop("Action", None)
+        if operation_name not in service_model.operation_names:
+            return None, {}
+        return service_model.operation_model(operation_name), form
+
+    if service_model.protocol == "json":
+        operation_name = headers.get("X-Amz-Target", "").split(".")[-1]
+        if operation_name not in service_model.operation_names:
+            return None, {}
+        operation_model = service_model.operation_model(operation_name)
+        return operation_model, from_wire(operation_model.input_shape, json.loads(body or b"{}"))
+
+    url = urlsplit(path)
+    for operation_model, pattern in _rest_routes(service_model):
+        match = pattern.match(url.path)
+        if operation_model.http["method"] == method and match:
+            break
+    else:
+        return None, {}
+
+    shape = operation_model.input_shape
+    params = from_wire(shape, json.loads(body)) if body and shape else {}
+    query_dict = parse_qs(url.query)
+    for name, member in (shape.members.items() if shape else []):
+        location = member.serialization.get("location")
+        wire_name = member.serialization.get("name", name)
+        if location == "uri":
+            params[name] = unquote(match.group(_group_name(wire_name)))
+        elif location == "querystring" and wire_name in query_dict:
+            params[name] = _query_value(member, query_dict[wire_name])
+
+    return operation_model, params
+
+
+_ROUTES = {}
+
+
+def _rest_routes(service_model):
+    """
+    Returns the (operation model, path regex) pairs of a rest service with
+    the most specific paths first.
+    """
+    service_name = service_model.service_name
+    if service_name not in _ROUTES:
+        route_list = []
+        for operation_name in service_model.operation_names:
+            operation_model = service_model.operation_model(operation_name)
+            uri = operation_model.http["requestUri"].split("?")[0]
+            pattern = re.sub(r"\{(\w+)(\+?)\}",
+                             lambda label: f"(?P<{_group_name(label.group(1))}>"
+                                           f"{'.+' if label.group(2) else '[^/]+'})",
+                             uri.rstrip("/") or "/")
+            route_list.append((len(re.sub(r"\{[^}]*\}", "", uri)), operation_model,
+                               re.compile(f"^{pattern}/?$")))
+        route_list.sort(key=lambda route: -route[0])
+        _ROUTES[service_name] = [(operation_model, pattern) for _, operation_model, pattern in route_list]
+
+    return _ROUTES[service_name]
+
+
+def _group_name(wire_name):
+    return re.sub(r"\W", "_", wire_name)
+
+
+def _query_value(shape, value_list):
+    if shape.type_name == "list":
+        return [_query_value(shape.member, [value]) for value in value_list]
+    if shape.type_name == "boolean":
+        return value_list[0].lower() == "true"
+    if shape.type_name in ["integer", "long"]:
+        return int(value_list[0])
+    return value_list[0]
+
+
+def from_wire(shape, value):
+    """
+    Converts request data keyed by wire names to a value keyed by member names.
+    Args:
+    shape - botocore Shape of the value
+    value - value decoded from JSON
+    """
+    if shape is None or value is None:
+        return value
+    if shape.type_name == "structure":
+        wire_dict = {member.serialization.get("name", name): name for name, member in shape.members.items()}
+        return {wire_dict[key]: from_wire(shape.members[wire_dict[key]], item)
+                for key, item in value.items() if key in wire_dict}
+    if shape.type_name == "list":
+        return [from_wire(shape.member, item) for item in value]
+    if shape.type_name == "map":
+        return {key: from_wire(shape.value, item) for key, item in value.items()}
+    return value
+
+
+def to_wire(shape, value, protocol="json"):
+    """
+    Converts a handler result keyed by member names to response data keyed
+    by wire names.  Members that are not in the shape or are None are left out.
+    Args:
+    shape - botocore Shape of the value
+    value - handler result
+    Kargs:
+    protocol - Protocol of the service, timestamps are ISO 8601 strings for
+               "query" and epoch seconds otherwise
+    """
+    if shape is None or value is None:
+        return value
+    if shape.type_name == "structure":
+        return {shape.members[name].serialization.get("name", name): to_wire(shape.members[name], item, protocol)
+                for name, item in value.items() if name in shape.members and item is not None}
+    if shape.type_name == "list":
+        return [to_wire(shape.member, item, protocol) for item in value]
+    if shape.type_name == "map":
+        return {key: to_wire(shape.value, item, protocol) for key, item in value.items()}
+    if shape.type_name == "timestamp" and isinstance(value, datetime):
+        return value.isoformat() if protocol == "query" else value.timestamp()
+    return value
+
+
+def serialize_response(operation_model, result):
+    """
+    Serializes the result of a handler for the protocol of the service.
+    Args:
+    operation_model - botocore OperationModel
+    result - handler result keyed by member names
+
+    Returns tuple of (HTTP status, headers dictionary, body bytes)
+    """
+    protocol = operation_model.service_model.protocol
+    request_id = str(uuid4())
+    data = to_wire(operation_model.output_shape, result, protocol) or {}
+
+    if protocol == "query":
+        result_xml = _xml_members(data)
+        body = (f'<{operation_model.name}Response xmlns="https://{operation_model.service_model.endpoint_prefix}'
+                f'.amazonaws.com/doc/{operation_model.service_model.api_version}/">'
+                f"<{operation_model.name}Result>{result_xml}</{operation_model.name}Result>"
+                f"<ResponseMetadata><RequestId>{request_id}</RequestId></ResponseMetadata>"
+                f"</{operation_model.name}Response>")
+        return 200, {"Content-Type": "text/xml", "x-amzn-RequestId": request_id}, body.encode()
+
+    content_type = "application/x-amz-json-1.1" if protocol == "json" else "application/json"
+    return (operation_model.http.get("responseCode", 200),
+            {"Content-Type": content_type, "x-amzn-RequestId": request_id},
+            json.dumps(data, separators=(",", ":")).encode())
+
+
+def serialize_error(service_model, err):
+    """
+    Serializes a FakeAwsError for the protocol of the service.
+    Args:
+    service_model - botocore ServiceModel
+    err - FakeAwsError
+
+    Returns tuple of (HTTP status, headers dictionary, body bytes)
+    """
+    request_id = str(uuid4())
+    if service_model.protocol == "query":
+        body = (f"<ErrorResponse><Error><Type>{'Receiver' if err.status >= 500 else 'Sender'}</Type>"
+                f"<Code>{escape(err.code)}</Code><Message>{escape(err.message)}</Message></Error>"
+                f"<RequestId>{request_id}</RequestId></ErrorResponse>")
+        return err.status, {"Content-Type": "text/xml", "x-amzn-RequestId": request_id}, body.encode()
+
+    return (err.status,
+            {"Content-Type": "application/json", "x-amzn-RequestId": request_id, "x-amzn-ErrorType": err.code},
+            json.dumps({"__type": err.code, "message": err.message}).encode())
+
+
+def _xml_members(value):
+    """
+    Returns the XML elements of a query protocol response value.
+    """
+    if isinstance(value, dict):
+        return "".join(f"<{key}>{_xml_members(item)}</{key}>" for key, item in value.items())
+    if isinstance(value, list):
+        return "".join(f"<member>{_xml_members(item)}</member>" for item in value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return escape(str(value))
+
+
+if __name__ == "__main__":
+    arg_dict = {
+        "--accounts": {"help": "Number of member accounts in the synthetic organization",
+                       "type": int,
+                       "default": DEFAULT_ACCOUNT_COUNT},
+        "--management-account": {"help": "Account id of the synthetic management account",
+                                 "default": DEFAULT_MANAGEMENT_ACCOUNT},
+        "--ou-fanout": {"help": "Child organizational units of the root and of every unit",
+                        "type": int,
+                        "default": 0},
+        "--ou-depth": {"help": "Levels of organizational units",
+                       "type": int,
+                       "default": 2},
+        "--regions": {"help": "Comma separated regions enabled for the organization",
+                      "default": ",".join(DEFAULT_REGIONS)},
+        "--host": {"help": "Address to listen on",
+                   "default": "127.0.0.1"},
+        "--port": {"help": "Port to listen on",
+                   "type": int,
+                   "default": DEFAULT_PORT},
+        "--latency": {"help": "Seconds added to every response",
+                      "type": float,
+                      "default": 0},
+        "--jitter": {"help": "Up to this many random seconds added to the latency",
+                     "type": float,
+                     "default": 0},
+        "--throttle-rate": {"help": "Fraction of calls answered with a throttling error",
+                            "type": float,
+                            "default": 0},
+        "--error-rate": {"help": "Fraction of calls answered with an internal server error",
+                         "type": float,
+                         "default": 0},
+        "--rate-limit": {"help": "Calls per second allowed for each service region",
+                         "type": float},
+        "--failing-regions": {"help": "Comma separated regions where every call fails"},
+        "--findings-per-account": {"help": "Synthetic findings of every account in every region",
+                                   "type": int,
+                                   "default": 0},
+        "--scan-enable-delay": {"help": "Seconds Inspector scans stay ENABLING",
+                                "type": float,
+                                "default": 0},
+        "--seed": {"help": "Seed of the random latency, throttling and errors",
+                   "type": int},
+        "--debug": {"help": "Set logging level to debug",
+                    "action": "store_true"}
+    }
+
+    args = common.parse_args(arg_dict)
+    common.setup_logging(log_level=logging.DEBUG if args.debug else logging.INFO)
+
+    fake_org = SyntheticOrg(args.accounts, management_account=args.management_account,
+                            regions=[region.strip() for region in args.regions.split(",")],
+                            ou_fanout=args.ou_fanout, ou_depth=args.ou_depth)
+    fake_server = FakeAwsServer(FakeAwsBackend(fake_org, scan_enable_delay=args.scan_enable_delay,
+                                               findings_per_account=args.findings_per_account),
+                                host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+                                throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                                rate_limit=args.rate_limit,
+                                failing_regions=[region.strip() for region in
+                                                 (args.failing_regions or "").split(",") if region.strip()],
+                                seed=args.seed)
+    logging.info("Fake AWS endpoint for %d accounts listening on %s", len(fake_org.accounts),
+                 fake_server.endpoint_url)
+    try:
+        fake_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake_server.server_close()
+        print(json.dumps({key: value for key, value in sorted(fake_server.get_stats().items())
+                          if ":" not in key}, indent=2))
@@ -0,0 +1,305 @@
+"""
+Module containing the bulk export of Security Hub findings from the delegated
+admin account.  GetFindings is split into shards by filters on the account,
+the update time window or the severity of the findings, and the shards of
+every region are paged concurrently, limited by the adaptive concurrency of
+the Security Hub endpoint of the region.  Every page is written as it
+arrives to one of a fixed number of gzip compressed JSON Lines part files, so
+memory is bounded by the pages in flight and not by the number of findings.
+"""
+import gzip
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import common
+
+
+SHARD_DIMENSIONS = ["account", "time", "severity"]
+SEVERITY_LABELS = ["INFORMATIONAL", "LOW", "MEDIUM", "HIGH", "CRITICAL"]
+# Maximum number of findings returned by a GetFindings call
+FINDINGS_PAGE_SIZE = 100
+DEFAULT_EXPORT_DAYS = 30
+DEFAULT_WINDOW_HOURS = 24
+DEFAULT_PART_FILES = 8
+DEFAULT_OUTPUT_PREFIX = "findings"
+# ISO 8601 timestamp of a finding, with any number of fractional digits,
+# which datetime.fromisoformat only accepts from Python 3.11
+TIMESTAMP_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?"
+                               r"(Z|([+-])(\d{2}):?(\d{2}))?$")
+# Seconds between two export progress log lines
+PROGRESS_INTERVAL = 10
+
+
+def plan_shards(start, end, shard_by=None, account_list=None, window_hours=DEFAULT_WINDOW_HOURS,
+                severity_list=None):
+    """
+    Builds the GetFindings filters of every shard of an export.  The shards
+    are the combinations of the values of the shard dimensions, every shard
+    selecting the findings updated between start and end.  The UpdatedAt
+    bounds of the filters are inclusive, so consecutive time windows share
+    their boundary and pull_findings drops the findings updated at the End
+    of a filter.
+    Args:
+    start - datetime of the oldest finding update exported
+    end - datetime after the newest finding update exported
+    Kargs:
+    shard_by - list of SHARD_DIMENSIONS the findings are split by
+    account_list - list of aws account ids, required to shard by account
+    window_hours - Hours of the update time window of a shard when sharding by time
+    severity_list - list of SEVERITY_LABELS exported (DEFAULT=all of them)
+
+    Returns dictionary of shard name to GetFindings Filters
+    """
+    shard_by = shard_by or []
+    unknown_list = sorted(set(shard_by) - set(SHARD_DIMENSIONS))
+    if unknown_list:
+        raise ValueError(f"Unsupported shard dimensions {unknown_list}")
+    severity_list = severity_list or SEVERITY_LABELS
+    unknown_list = sorted(set(severity_list) - set(SEVERITY_LABELS))
+    if unknown_list:
+        raise ValueError(f"Unsupported severity labels {unknown_list}")
+
+    base_filters = {"UpdatedAt": [{"Start": _iso_time(start), "End": _iso_time(end)}]}
+    if "severity" not in shard_by and len(severity_list) < len(SEVERITY_LABELS):
+        base_filters["SeverityLabel"] = [{"Value": label, "Comparison": "EQUALS"} for label in severity_list]
+
+    # Every dimension is a list of (name, filters) choices
+    dimension_list = []
+    for dimension in shard_by:
+        if dimension == "account":
+            if not account_list:
+                raise ValueError("Sharding by account requires the account list")
+            dimension_list.append([(account_id, {"AwsAccountId": [{"Value": account_id, "Comparison": "EQUALS"}]})
+                                   for account_id in account_list])
+
+        elif dimension == "time":
+            window_list = []
+            window_start = start
+            while window_start < end:
+                window_end = min(window_start + timedelta(hours=window_hours), end)
+                window_list.append((_iso_time(window_start),
+                                    {"UpdatedAt": [{"Start": _iso_time(window_start), "End": _iso_time(window_end)}]}))
+                window_start = window_end
+            dimension_list.append(window_list)
+
+        else:
+            dimension_list.append([(label, {"SeverityLabel": [{"Value": label, "Comparison": "EQUALS"}]})
+                                   for label in severity_list])
+
+    shard_dict = {}
+    for choice_list in itertools.product(*dimension_list):
+        filters = dict(base_filters)
+        for _, choice_filters in choice_list:
+            filters.update(choice_filters)
+        shard_dict["/".join(name for name, _ in choice_list) or "all"] = filters
+
+    return shard_dict
+
+
+def pull_findings(client_manager, region_list, shard_dict, page_function):
+    """
+    Pages the findings of every shard in every region concurrently and calls
+    page_function with each page as it arrives.  page_function is called
+    from the worker threads, at the same time for different shards.  The
+    shards are half-open: a finding updated at the End of the UpdatedAt
+    filter of its shard is left to the next time window, or the next
+    export, which both start at that time.
+    Args:
+    client_manager - ClientManager of the Security Hub delegated admin account
+    region_list - list of AWS regions
+    shard_dict - dictionary of shard name to GetFindings Filters, see plan_shards
+    page_function - Callable accepting the (region, shard name) of a page and
+                    the list of findings of the page
+
+    Returns dictionary of (region, shard name) to the number of findings
+        pulled, or the exception that stopped the shard
+    """
+    def pull_shard(shard):
+        region, shard_name = shard
+        client = client_manager.client("securityhub", region)
+        finding_iter = common.paginate(client, "get_findings", "Findings", page_size=FINDINGS_PAGE_SIZE,
+                                       Filters=shard_dict[shard_name])
+        shard_end = parse_time(shard_dict[shard_name]["UpdatedAt"][0]["End"])
+        finding_count = 0
+        while True:
+            page = list(itertools.islice(finding_iter, FINDINGS_PAGE_SIZE))
+            if not page:
+                return finding_count
+            page = [finding for finding in page if parse_time(finding.get("UpdatedAt")) != shard_end]
+            if not page:
+                continue
+            page_function(shard, page)
+            finding_count += len(page)
+
+    shard_list = [(region.strip(), shard_name) for region in region_list for shard_name in shard_dict]
+    return common.adaptive_map(pull_shard, shard_list, lambda shard: ("securityhub", shard[0]),
+                               return_exceptions=True)
+
+
+class FindingsWriter:
+    """
+    Gzip compressed JSON Lines part files the findings of an export are
+    written to.  The pages of a shard always go to the same part file and
+    every page is written under the lock of its part file, so shards write
+    to different part files at the same time.
+    """
+    def __init__(self, output_prefix, part_count=DEFAULT_PART_FILES):
+        """
+        Args:
+        output_prefix - Filename prefix of the part files
+        Kargs:
+        part_count - Number of part files
+        """
+        self.filenames = [f"{output_prefix}-{part:04d}.jsonl.gz" for part in range(part_count)]
+        self.__parts = [(gzip.open(filename, "wt", encoding="utf-8"), threading.Lock())
+                        for filename in self.filenames]
+        self.__part_index = {}
+        self.__lock = threading.Lock()
+        self.findings = 0
+        self.pages = 0
+        self.start_time = time.monotonic()
+        self.__logged = self.start_time
+
+    def write_page(self, shard, page):
+        """
+        Writes a page of findings to the part file of its shard and logs the
+        export progress every PROGRESS_INTERVAL seconds.
+        Args:
+        shard - (region, shard name) tuple
+        page - list of findings
+
+        Returns None
+        """
+        with self.__lock:
+            part = self.__part_index.setdefault(shard, len(self.__part_index) % len(self.__parts))
+
+        lines = "".join(json.dumps(finding, default=str) + "\n" for finding in page)
+        part_file, part_lock = self.__parts[part]
+        with part_lock:
+            part_file.write(lines)
+
+        with self.__lock:
+            self.findings += len(page)
+            self.pages += 1
+            now = time.monotonic()
+            if now - self.__logged < PROGRESS_INTERVAL:
+                return
+            self.__logged = now
+            findings = self.findings
+
+        logging.info("Exported %d findings, %.1f findings per second", findings,
+                     findings / max(now - self.start_time, 0.001))
+
+    def close(self):
+        """
+        Closes the part files.
+
+        Returns None
+        """
+        for part_file, part_lock in self.__parts:
+            with part_lock:
+                part_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def export_findings(client_manager, region_list, shard_dict, output_prefix=DEFAULT_OUTPUT_PREFIX,
+                    part_count=DEFAULT_PART_FILES):
+    """
+    Exports the findings of every shard in every region to gzip compressed
+    JSON Lines part files.  A failed shard is logged and reported in the
+    summary while the other shards complete.
+    Args:
+    client_manager - ClientManager of the Security Hub delegated admin account
+    region_list - list of AWS regions
+    shard_dict - dictionary of shard name to GetFindings Filters, see plan_shards
+    Kargs:
+    output_prefix - Filename prefix of the part files
+    part_count - Number of part files
+
+    Returns dictionary with the number of findings, pages and shards, the
+        failed shards, the part files, the duration and findings per second
+    """
+    with FindingsWriter(output_prefix, part_count=part_count) as writer:
+        results = pull_findings(client_manager, region_list, shard_dict, writer.write_page)
+
+    failed_list = []
+    for (region, shard_name), result in results.items():
+        if isinstance(result, Exception):
+            logging.error("Findings export of shard %s in %s failed: %s", shard_name, region, result)
+            failed_list.append(f"{region}:{shard_name}")
+
+    duration = time.monotonic() - writer.start_time
+    return {
+        "findings": writer.findings,
+        "pages": writer.pages,
+        "shards": len(results),
+        "failed_shards": failed_list,
+        "files": writer.filenames,
+        "duration": round(duration, 3),
+        "findings_per_second": round(writer.findings / max(duration, 0.001), 1)
+    }
+
+
+def read_findings(filename_list):
+    """
+    Generator that yields the findings of the part files of exports one at
+    a time.
+    Args:
+    filename_list - list of gzip compressed JSON Lines part filenames
+
+    Yields finding dictionaries
+    """
+    for filename in filename_list:
+        with gzip.open(filename, "rt", encoding="utf-8") as part_file:
+            for line in part_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def export_window(days=DEFAULT_EXPORT_DAYS):
+    """
+    Returns the (start, end) datetimes of an export of the findings updated
+    in the last days.
+    """
+    end = datetime.now(timezone.utc).replace(microsecond=0)
+    return end - timedelta(days=days), end
+
+
+def parse_time(timestamp):
+    """
+    Returns the timezone aware datetime of an ASFF timestamp, None when it is
+    missing or cannot be parsed.  Timestamps without an offset are UTC and
+    fractional digits beyond microseconds are dropped.
+    """
+    match = TIMESTAMP_PATTERN.match(timestamp or "")
+    if not match:
+        return None
+
+    fraction = (match.group(7) or "")[:6]
+    try:
+        value = datetime(*(int(part) for part in match.group(1, 2, 3, 4, 5, 6)), int(fraction.ljust(6, "0")),
+                         tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+    if match.group(9):
+        offset = timedelta(hours=int(match.group(10)), minutes=int(match.group(11)))
+        value -= offset if match.group(9) == "+" else -offset
+    return value
+
+
+def _iso_time(value):
+    value = value.astimezone(timezone.utc)
+    if value.microsecond:
+        return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -5,12 +5,19 @@ AWS GuardDuty for an AWS Organization through the organizations service.
 import logging
 
 import botocore.exceptions
+import common
+import ledger
+import profiling
 from org_accounts import manager
 
 
 class Guardduty(manager.OrgManager):
     AWS_SERVICE = "guardduty"
     SERVICE_PRINCIPAL = "guardduty.amazonaws.com"
+    DISABLE_UNLISTED_REGIONS = True
+    MEMBER_STATUS_KEY = "RelationshipStatus"
+    # Maximum number of account IDs accepted by get_members
+    MEMBER_BATCH_SIZE = 50
     GD_DATA_SOURCE_ENABLE = {
         "s3": {
             "name": "S3Logs",
@@ -45,6 +52,38 @@ class Guardduty(manager.OrgManager):
         Args:
         input_dict - IR dictionary
 
+        Returns None
+        """
+        self.prepare(input_dict)
+        profiling.phase(f"{self.AWS_SERVICE} members")
+        org_accounts = self.get_inventory()
+
+        for region in input_dict["enable_regions"]:
+            with self.region_guard(region):
+                add_account_list = []
+                org_accounts.set_members(self.AWS_SERVICE, region,
+                                         (account["AccountId"] for account in self.get_associated_members(region=region)))
+                self.remove_untargeted(org_accounts, input_dict, region)
+                for account in self.missing_targets(org_accounts, input_dict, region):
+                    common.log_account_event(self.AWS_SERVICE, region, "added", account)
+                    add_account_list.append({"AccountId": account, "Email": org_accounts.account(account).email})
+
+                if add_account_list:
+                    self.add_members(add_account_list, region=region)
+                    org_accounts.add_members(self.AWS_SERVICE, region,
+                                             [account["AccountId"] for account in add_account_list])
+                common.flush_account_events(self.AWS_SERVICE, region)
+
+        self.raise_for_skipped_regions()
+
+    def prepare(self, input_dict):
+        """
+        Configures everything except member accounts for GuardDuty: the
+        delegated admin, the admin for each region and the organization
+        configuration of each region.
+        Args:
+        input_dict - IR dictionary
+
         Returns None
         """
         logging.info("#"*80)
@@ -62,12 +101,14 @@ class Guardduty(manager.OrgManager):
         else:
             logging.info(f"Account {input_dict['admin_account_id']} is already set to delegated admin for service {self.AWS_SERVICE}")
 
+        self.warm_up_clients(input_dict)
+
         # Enable the delegated admin account as the admin for SH service in the desired regions
         logging.info(f"Enabling {self.SERVICE_PRINCIPAL} in regions {input_dict['enable_regions']}")
-        for region in input_dict["enable_regions"]:
-            # Strip whitespace on region to prevent incorrectly formed ","
-            # separated lists from introducing valid region strings
-            region = region.strip()
+
+        # Regions are stripped by fan_out_regions to prevent incorrectly formed
+        # "," separated lists from introducing valid region strings
+        def enable_region(region):
             try:
                 self.enable_org_admin(input_dict["admin_account_id"], region)
 
@@ -77,29 +118,21 @@ class Guardduty(manager.OrgManager):
                 else:
                     raise err from None
 
+        self.fan_out_regions(enable_region, input_dict["enable_regions"])
+
         region_disable = self.enabled_regions.copy()
         [region_disable.remove(region) for region in input_dict["enable_regions"]]
         logging.info(f"Ensuring {self.SERVICE_PRINCIPAL} is disabled in regions {region_disable}")
         for region in region_disable:
-            self.disable_org_admin(account_id=input_dict["admin_account_id"], region=region)
-
-        org_accounts = self.get_org_accounts()
+            with self.region_guard(region):
+                self.disable_org_admin(account_id=input_dict["admin_account_id"], region=region)
 
         # Autojoin needs to be set per region
         for region in input_dict["enable_regions"]:
-            logging.info(f"Enabling autojoin for {self.AWS_SERVICE} in region {region}")
-            param_dict = {"region": region}
-            self.update_org_config(**param_dict)
-
-            add_account_list = []
-            gd_members = [ account["AccountId"] for account in self.get_associated_members(region=region)]
-            for account, account_email in {account:org_accounts[account]["Email"] for account in org_accounts}.items():
-                if account not in gd_members and account != input_dict["admin_account_id"]:
-                    logging.info(f"Adding account {account} as a SH member")
-                    add_account_list.append({"AccountId": account, "Email": account_email})
-
-            if add_account_list:
-                self.add_members(add_account_list, region=region)
+            with self.region_guard(region):
+                logging.info(f"Configuring autojoin for {self.AWS_SERVICE} in region {region}")
+                param_dict = {"region": region, "auto_enable": self.org_auto_enable(input_dict)}
+                self.update_org_config(**param_dict)
 
     def update(self, input_dict):
         """
@@ -135,6 +168,35 @@ class Guardduty(manager.OrgManager):
             logging.info(f"Account {input_dict['admin_account_id']} unregistered for service {self.AWS_SERVICE}")
 
 
+    def enroll_account(self, account_id, account_email, input_dict, region):
+        """
+        Adds a single organization account as a GuardDuty member for the
+        region provided in the region parameter.
+        Args:
+        account_id - AWS account ID string
+        account_email - Email address of the account
+        input_dict - IR dictionary
+        region - aws region string
+
+        Returns None
+        """
+        logging.info(f"Adding account {account_id} as a {self.AWS_SERVICE} member in {region}")
+        self.add_members([{"AccountId": account_id, "Email": account_email}], region=region)
+
+    def offboard_account(self, account_id, input_dict, region):
+        """
+        Removes a single account as a GuardDuty member for the region provided
+        in the region parameter.
+        Args:
+        account_id - AWS account ID string
+        input_dict - IR dictionary
+        region - aws region string
+
+        Returns None
+        """
+        logging.info(f"Removing account {account_id} as a {self.AWS_SERVICE} member in {region}")
+        self.remove_members([account_id], region=region)
+
     def get_delegated_admin(self):
         """
         Returns information about the delegated administrator account which
@@ -216,6 +278,38 @@ class Guardduty(manager.OrgManager):
             else:
                 raise err from None
 
+    def get_admin_status(self, account_id, region):
+        """
+        Returns the status of the account provided in the account_id parameter
+        as the GuardDuty admin for the region provided in the region parameter.
+        Args:
+        account_id - AWS account ID string
+        region - aws region string
+
+        Returns status string or None if the account is not the admin
+        """
+        response = self.client_manager.client("guardduty", region).list_organization_admin_accounts()
+        for admin in response["AdminAccounts"]:
+            if admin["AdminAccountId"] == account_id:
+                return admin["AdminStatus"]
+
+        return None
+
+    @manager.s_client_manager
+    def get_auto_enable(self, region):
+        """
+        Returns True if new organization accounts are auto enabled for the
+        region provided in the region parameter.
+        Args:
+        region - aws region string
+
+        Returns bool
+        """
+        response = self.da_client_manager.client("guardduty", region).describe_organization_configuration(
+            DetectorId=self.get_detector_id(region))
+        return bool(response.get("AutoEnable")) or \
+            response.get("AutoEnableOrganizationMembers") in ["NEW", "ALL"]
+
     @manager.s_client_manager
     def get_detector_id(self, region):
         """
@@ -235,18 +329,20 @@ class Guardduty(manager.OrgManager):
         return response["DetectorIds"][0]
 
     @manager.s_client_manager
-    def update_org_config(self, region):
+    def update_org_config(self, region, auto_enable=True):
         """
         Update the configuration of GuardDuty for the organization enabling
         autojoin for new member accounts.
         Args:
         region - aws region string
+        Kargs:
+        auto_enable - Autojoin new member accounts, see org_auto_enable
 
         Returns None
         """
         param_dict = {
             "DetectorId": self.get_detector_id(region),
-            "AutoEnable": True
+            "AutoEnable": auto_enable
         }
 
         self.da_client_manager.client("guardduty", region).update_organization_configuration(
@@ -258,34 +354,108 @@ class Guardduty(manager.OrgManager):
         Adds AWS accounts as members to the Region.  The parameter member_list
         is a list of dictionaries where each dictionary contains keys AccountId and Email.  The
         case of these keys is intentional and matches those returned from the list_members
-        method return.
+        method return.  The accounts are added in batches of MEMBER_BATCH_SIZE, the
+        maximum accepted by create_members, run concurrently through common.adaptive_map.
+        The outcome of every batch is recorded in the run ledger and
+        ledger.UnitsFailed is raised when batches failed.
         Args:
         member_list -
 
         Returns None
         """
         detector_id = self.get_detector_id(region)
-        response = self.da_client_manager.client("guardduty", region).create_members(
-            DetectorId=detector_id,
-            AccountDetails=member_list)
+        client = self.da_client_manager.client("guardduty", region)
+
+        def create_batch(index):
+            response = client.create_members(
+                DetectorId=detector_id,
+                AccountDetails=member_list[index:index + self.MEMBER_BATCH_SIZE])
+
+            if response["UnprocessedAccounts"] != []:
+                raise ValueError(f"Unable to add all accounts as members {response['UnprocessedAccounts']}")
+
+        results = common.adaptive_map(create_batch, range(0, len(member_list), self.MEMBER_BATCH_SIZE),
+                                      (self.AWS_SERVICE, region), return_exceptions=True)
+        ledger.record_batches(self.AWS_SERVICE, region, [
+            ([member["AccountId"] for member in member_list[index:index + self.MEMBER_BATCH_SIZE]], result)
+            for index, result in results.items()])
+
+    @manager.s_client_manager
+    def remove_members(self, account_list, region):
+        """
+        Disassociates and deletes the AWS accounts in account_list as GuardDuty
+        members for the region provided in the region parameter.
+        Args:
+        account_list - list of aws account id strings
+        region - aws region string
+
+        Returns None
+        """
+        detector_id = self.get_detector_id(region)
+        client = self.da_client_manager.client("guardduty", region)
+        for method in [client.disassociate_members, client.delete_members]:
+            response = method(DetectorId=detector_id, AccountIds=account_list)
+
+            if response["UnprocessedAccounts"]:
+                logging.warning(f"Unable to process all accounts {response['UnprocessedAccounts']}")
+
+    def remove_member_accounts(self, account_list, region):
+        """
+        Removes the accounts in account_list as GuardDuty members for the region
+        provided in the region parameter, in batches of MEMBER_BATCH_SIZE run
+        concurrently through common.adaptive_map.
+        Args:
+        account_list - list of aws account id strings
+        region - aws region string
+
+        Returns None
+        """
+        common.adaptive_map(
+            lambda index: self.remove_members(account_list[index:index + self.MEMBER_BATCH_SIZE], region=region),
+            range(0, len(account_list), self.MEMBER_BATCH_SIZE), (self.AWS_SERVICE, region))
+
+    @manager.s_client_manager
+    def get_member_accounts(self, account_list, region):
+        """
+        Returns the accounts from account_list that are enabled GuardDuty
+        members for the region provided by the region parameter.  Accounts are
+        requested in batches of MEMBER_BATCH_SIZE.
+        Args:
+        account_list - list of aws account id strings
+        region - aws region string
+
+        Returns list of aws account id strings
+        """
+        detector_id = self.get_detector_id(region)
+        client = self.da_client_manager.client("guardduty", region)
+
+        return_list = []
+        for index in range(0, len(account_list), self.MEMBER_BATCH_SIZE):
+            response = client.get_members(DetectorId=detector_id,
+                                          AccountIds=account_list[index:index + self.MEMBER_BATCH_SIZE])
+            return_list.extend(member["AccountId"] for member in response["Members"]
+                               if member["RelationshipStatus"] == "Enabled")
 
-        if response["UnprocessedAccounts"] != []:
-            raise ValueError(f"Unable to add all accounts as members {response['UnprocessedAccounts']}")
+        return return_list
 
     @manager.s_client_manager
-    def get_associated_members(self, region):
+    def get_associated_members(self, region, only_associated=True):
         """
         Returns the organization member accounts that are associated with
         GuardDuty for the region provided by the region parameter.
         Args:
         region - aws region string
+        Kargs:
+        only_associated - When False every member is returned whatever its
+                          relationship status
 
-        Returns list of dictionaries contaiing member information.
+        Returns generator of dictionaries containing member information, the
+        pages are listed as the members are consumed.
         """
         detector_id = self.get_detector_id(region)
-        response = self.da_client_manager.client("guardduty", region).list_members(DetectorId=detector_id,
-                                                                                   OnlyAssociated="True")
-        return response["Members"]
+        return common.paginate(self.da_client_manager.client("guardduty", region), "list_members",
+                               "Members", page_size=self.MEMBER_PAGE_SIZE, DetectorId=detector_id,
+                               OnlyAssociated=str(only_associated))
 
     @manager.s_client_manager
     def update_members(self, account_list, region):
@@ -3,14 +3,37 @@ Implements the class Inspector which is used by ir_setup to enable and configure
 AWS Inspector 2 for an AWS Organization through the organizations service.
 """
 import logging
+import time
 
 import botocore.exceptions
+import common
+import ledger
+import profiling
 from org_accounts import manager
 
 
 class Inspector(manager.OrgManager):
     AWS_SERVICE = "inspector2"
     SERVICE_PRINCIPAL = "inspector2.amazonaws.com"
+    MEMBER_ID_KEY = "accountId"
+    MEMBER_STATUS_KEY = "relationshipStatus"
+    ORG_AUTO_ENABLE = {
+        'ec2': True,
+        'ecr': True,
+        'lambda': True
+    }
+    SCAN_RESOURCE_TYPES = ['EC2', 'ECR', 'LAMBDA', 'LAMBDA_CODE']
+    # Maps the scan resource types to their key in the account resourceState
+    RESOURCE_STATE_KEYS = {
+        "EC2": "ec2",
+        "ECR": "ecr",
+        "LAMBDA": "lambda",
+        "LAMBDA_CODE": "lambdaCode"
+    }
+    # Maximum number of account IDs accepted by batch_get_account_status
+    STATUS_BATCH_SIZE = 10
+    STATUS_PENDING = ["ENABLING"]
+    DEFAULT_STATUS_TIMEOUT = 30
 
     def __init__(self, target_account=None, assume_role_name=None, external_id=None, region=None):
         super().__init__(target_account=target_account,
@@ -26,6 +49,48 @@ class Inspector(manager.OrgManager):
         Args:
         input_dict - IR dictionary
 
+        Returns None
+        """
+        self.prepare(input_dict)
+        profiling.phase(f"{self.AWS_SERVICE} members")
+        org_accounts = self.get_inventory()
+
+        # Adding existing member accounts per region
+        scan_accounts = {}
+        for region in input_dict["enable_regions"]:
+            with self.region_guard(region):
+                add_account_list = []
+                in_members = [ account["accountId"] for account in self.get_associated_members(region=region)]
+                org_accounts.set_members(self.AWS_SERVICE, region, in_members)
+                removed_list = self.remove_untargeted(org_accounts, input_dict, region)
+                in_members = [account for account in in_members if account not in removed_list]
+                for account in self.missing_targets(org_accounts, input_dict, region):
+                    common.log_account_event(self.AWS_SERVICE, region, "added", account)
+                    add_account_list.append(account)
+
+                if add_account_list:
+                    self.add_member_list(add_account_list, region=region)
+                    org_accounts.add_members(self.AWS_SERVICE, region, add_account_list)
+
+                self.enable_scans(in_members, region=region)
+                scan_accounts[region] = in_members
+                common.flush_account_events(self.AWS_SERVICE, region)
+
+        status_timeout = int(input_dict.get("scan_status_timeout", self.DEFAULT_STATUS_TIMEOUT))
+        if status_timeout > 0:
+            logging.info(f"Waiting up to {status_timeout}s for {self.AWS_SERVICE} scans to be enabled")
+            self.log_scan_status(self.wait_for_scans(scan_accounts, timeout=status_timeout))
+
+        self.raise_for_skipped_regions()
+
+    def prepare(self, input_dict):
+        """
+        Configures everything except member accounts for Inspector: the
+        delegated admin, the admin for each region and the autojoin
+        configuration of each region.
+        Args:
+        input_dict - IR dictionary
+
         Returns None
         """
         logging.info("#"*80)
@@ -44,30 +109,17 @@ class Inspector(manager.OrgManager):
         else:
             logging.info(f"Account {input_dict['admin_account_id']} is already set to delegated admin for service {self.AWS_SERVICE}")
 
-        logging.info(f"Enabling {self.SERVICE_PRINCIPAL} in regions {input_dict['enable_regions']}")
-        for region in input_dict["enable_regions"]:
-            self.enable_org_admin(input_dict["admin_account_id"], region)
+        self.warm_up_clients(input_dict)
 
-        org_accounts = self.get_org_accounts()
+        logging.info(f"Enabling {self.SERVICE_PRINCIPAL} in regions {input_dict['enable_regions']}")
+        self.fan_out_regions(lambda region: self.enable_org_admin(input_dict["admin_account_id"], region),
+                             input_dict["enable_regions"])
 
-        # Configuring autojoin per region and adding existing member accounts
+        # Configuring autojoin per region
         for region in input_dict["enable_regions"]:
-
-            add_account_list = []
-            in_members = [ account["accountId"] for account in self.get_associated_members(region=region)]
-            for account in {account:org_accounts[account]["Email"] for account in org_accounts}:
-                if account not in in_members and account != input_dict["admin_account_id"]:
-                    logging.info(f"Adding account {account} as a {self.AWS_SERVICE} member in {region}")
-                    add_account_list.append(account)
-
-            if add_account_list:
-                for account in add_account_list:
-                    self.add_member(account, region=region)
-
-            self.enable_scans(in_members, region=region)
-
-            logging.info(f"Enabling autojoin for {self.AWS_SERVICE} in region {region}")
-            self.update_org_config(region=region)
+            with self.region_guard(region):
+                logging.info(f"Configuring autojoin for {self.AWS_SERVICE} in region {region}")
+                self.update_org_config(region=region, auto_enable=self.org_auto_enable(input_dict))
 
     def update(self, input_dict):
         """
@@ -87,27 +139,99 @@ class Inspector(manager.OrgManager):
         account from being able to manage the organizations Inspector Service.
         This returns the control of Inspector back to each account and does
         NOT disable or remove any findings from organization member accounts.
+        The admin is disabled in all regions concurrently and a ValueError
+        listing the failed regions is raised once every region was attempted.
         Args:
         input_dict - IR dictionary
 
         Returns None
         """
-        for region in input_dict["enable_regions"]:
-            self.disable_org_admin(input_dict["admin_account_id"], region)
-
-        account_services = self.list_services_for_account(input_dict["admin_account_id"])
+        admin_account_id = input_dict["admin_account_id"]
+        region_status = self.disable_org_admin_regions(admin_account_id, input_dict["enable_regions"])
+        failed_dict = {region: status for region, status in region_status.items()
+                       if isinstance(status, Exception)}
+        if failed_dict:
+            # The delegated admin is kept registered so the failed regions can
+            # be retried by destroying again
+            raise ValueError(f"Unable to disable {self.AWS_SERVICE} admin in regions " +
+                             ", ".join(f"{region}: {err}" for region, err in failed_dict.items()))
+
+        account_services = self.list_services_for_account(admin_account_id)
 
         if not account_services:
             logging.info(f"No delegated admin account for service {self.AWS_SERVICE}")
 
         elif self.SERVICE_PRINCIPAL in account_services:
-            logging.info(f"Unregistering delegated admin account {input_dict['admin_account_id']} for service {self.AWS_SERVICE}")
-            self.deregister_delegated_admin(input_dict["admin_account_id"])
-            logging.info(f"Account {input_dict['admin_account_id']} unregistered for service {self.AWS_SERVICE}")
+            logging.info(f"Unregistering delegated admin account {admin_account_id} for service {self.AWS_SERVICE}")
+            self.deregister_delegated_admin(admin_account_id)
+            logging.info(f"Account {admin_account_id} unregistered for service {self.AWS_SERVICE}")
 
         else:
             logging.warning("Service principal %s was not found enabled for the org", self.SERVICE_PRINCIPAL)
 
+    def disable_org_admin_regions(self, account_id, region_list):
+        """
+        Disables the account provided in the account_id parameter as the
+        Inspector admin in every region in region_list concurrently.  The
+        admin status is read first so regions where the account is no longer
+        the admin are skipped.  A failure in one region does not stop the
+        other regions.
+        Args:
+        account_id - AWS account ID string
+        region_list - list of AWS region strings
+
+        Returns dictionary of region to "DISABLED", "SKIPPED" or the exception
+        raised for the region
+        """
+        def disable_region(region):
+            status = self.get_admin_status(account_id, region)
+            if status in [None, "DISABLE_IN_PROGRESS"]:
+                logging.info(f"{self.AWS_SERVICE} admin already disabled for region {region}")
+                return "SKIPPED"
+
+            self.disable_org_admin(account_id, region)
+            logging.info(f"{self.AWS_SERVICE} admin disabled for region {region}")
+            return "DISABLED"
+
+        region_status = common.thread_map(disable_region, [region.strip() for region in region_list],
+                                          return_exceptions=True)
+        for region, status in region_status.items():
+            if isinstance(status, Exception):
+                logging.error(f"Failed to disable {self.AWS_SERVICE} admin for region {region}: {status}")
+
+        return region_status
+
+    def enroll_account(self, account_id, account_email, input_dict, region):
+        """
+        Adds a single organization account as an Inspector member and enables
+        the default scan types for it in the region provided in the region
+        parameter.
+        Args:
+        account_id - AWS account ID string
+        account_email - Email address of the account
+        input_dict - IR dictionary
+        region - aws region string
+
+        Returns None
+        """
+        logging.info(f"Adding account {account_id} as a {self.AWS_SERVICE} member in {region}")
+        self.add_member(account_id, region=region)
+        self.enable_scans([account_id], region=region)
+
+    def offboard_account(self, account_id, input_dict, region):
+        """
+        Removes a single account as an Inspector member for the region provided
+        in the region parameter.
+        Args:
+        account_id - AWS account ID string
+        input_dict - IR dictionary
+        region - aws region string
+
+        Returns None
+        """
+        logging.info(f"Removing account {account_id} as a {self.AWS_SERVICE} member in {region}")
+        self.remove_member(account_id, region=region)
+
     def get_delegated_admin(self):
         """
         Returns information about the delegated administrator account which
@@ -195,22 +319,85 @@ class Inspector(manager.OrgManager):
             else:
                 raise err from None
 
-    def update_org_config(self, region):
+    def get_admin_status(self, account_id, region):
+        """
+        Returns the status of the account provided in the account_id parameter
+        as the Inspector delegated admin for the region provided in the region
+        parameter.
+        Args:
+        account_id - AWS account ID string
+        region - aws region string
+
+        Returns status string or None if the account is not the admin
+        """
+        response = self.client_manager.client(self.AWS_SERVICE, region).list_delegated_admin_accounts()
+        for admin in response["delegatedAdminAccounts"]:
+            if admin["accountId"] == account_id:
+                return admin["status"]
+
+        return None
+
+    @manager.s_client_manager
+    def get_auto_enable(self, region):
+        """
+        Returns True if new organization accounts are auto enabled for all
+        scan types in ORG_AUTO_ENABLE for the region provided in the region
+        parameter.
+        Args:
+        region - aws region string
+
+        Returns bool
+        """
+        response = self.da_client_manager.client("inspector2", region).describe_organization_configuration()
+        return all(response["autoEnable"].get(scan_type) == value
+                   for scan_type, value in self.ORG_AUTO_ENABLE.items())
+
+    @manager.s_client_manager
+    def update_org_config(self, region, auto_enable=True):
         """
         Set autoenable for new organization accounts.
         Args:
         region - aws region string
+        Kargs:
+        auto_enable - Auto enable the scan types in ORG_AUTO_ENABLE, every
+                      scan type is disabled when False, see org_auto_enable
 
         Returns None
         """
         self.da_client_manager.client("inspector2", region).update_organization_configuration(
-            autoEnable={
-                'ec2': True,
-                'ecr': True,
-                'lambda': True
-            }
+            autoEnable=self.ORG_AUTO_ENABLE if auto_enable else {scan_type: False for scan_type in self.ORG_AUTO_ENABLE}
         )
 
+    @manager.s_client_manager
+    def remove_member(self, account_id, region):
+        """
+        Disassociates a member account from Inspector for the region indicated
+        by the region parameter.
+        Args:
+        account_id - aws account ID string
+        region - aws region string
+
+        Returns None
+        """
+        self.da_client_manager.client("inspector2", region).disassociate_member(
+            accountId=account_id
+        )
+
+    def remove_member_accounts(self, account_list, region):
+        """
+        Disassociates the accounts in account_list from Inspector for the
+        region indicated by the region parameter, concurrently through
+        common.adaptive_map.
+        Args:
+        account_list - list of aws account id strings
+        region - aws region string
+
+        Returns None
+        """
+        common.adaptive_map(lambda account: self.remove_member(account, region=region), account_list,
+                            (self.AWS_SERVICE, region))
+
+    @manager.s_client_manager
     def add_member(self, account_id, region):
         """
         Adds a member account as "managed by" for Inspector for the region
@@ -225,6 +412,32 @@ class Inspector(manager.OrgManager):
             accountId=account_id
         )
 
+    def add_member_list(self, account_list, region):
+        """
+        Adds the accounts in account_list as Inspector members for the region
+        indicated by the region parameter.  Inspector only associates a single
+        member per call so the accounts are associated concurrently through
+        common.adaptive_map.  The outcomes are recorded in the run ledger in
+        batches of MEMBER_PAGE_SIZE accounts and ledger.UnitsFailed is raised
+        when batches failed.
+        Args:
+        account_list - list of aws account id strings
+        region - aws region string
+
+        Returns None
+        """
+        results = common.adaptive_map(lambda account: self.add_member(account, region=region), account_list,
+                                      (self.AWS_SERVICE, region), return_exceptions=True)
+
+        batch_list = []
+        for index in range(0, len(account_list), self.MEMBER_PAGE_SIZE):
+            batch_accounts = account_list[index:index + self.MEMBER_PAGE_SIZE]
+            batch_errors = [results[account] for account in batch_accounts
+                            if isinstance(results[account], Exception)]
+            batch_list.append((batch_accounts, batch_errors[0] if batch_errors else None))
+        ledger.record_batches(self.AWS_SERVICE, region, batch_list)
+
+    @manager.s_client_manager
     def enable_scans(self, add_account_list, region):
         """
         Enables the default stan types for the accounts provided by the
@@ -237,7 +450,7 @@ class Inspector(manager.OrgManager):
         """
         response = self.da_client_manager.client("inspector2", region).enable(
             accountIds=add_account_list,
-            resourceTypes=['EC2','ECR','LAMBDA','LAMBDA_CODE']
+            resourceTypes=self.SCAN_RESOURCE_TYPES
         )
 
         if response["failedAccounts"]:
@@ -250,14 +463,171 @@ class Inspector(manager.OrgManager):
                 raise ValueError("Unable to enable in all accounts %s" % str(failure_results))
 
     @manager.s_client_manager
-    def get_associated_members(self, region):
+    def get_member_accounts(self, account_list, region):
+        """
+        Returns the accounts from account_list that are enabled Inspector
+        members for the region provided by the region parameter.  Inspector
+        only supports looking up a single member so the accounts are looked up
+        concurrently.
+        Args:
+        account_list - list of aws account id strings
+        region - aws region string
+
+        Returns list of aws account id strings
+        """
+        client = self.da_client_manager.client("inspector2", region)
+
+        def get_status(account_id):
+            try:
+                return client.get_member(accountId=account_id)["member"]["relationshipStatus"]
+
+            except botocore.exceptions.ClientError as err:
+                if err.response["Error"]["Code"] == "ResourceNotFoundException":
+                    return None
+                raise err from None
+
+        status_dict = common.thread_map(get_status, account_list)
+        return [account for account in account_list if status_dict[account] == "ENABLED"]
+
+    def sync_member_accounts(self, add_dict, associated_list, region):
+        """
+        Adds the accounts in add_dict as Inspector members and enables scans for
+        the accounts that were already associated, matching the create workflow.
+        Args:
+        add_dict - dictionary of aws account id to account email to add
+        associated_list - list of aws account ids already associated
+        region - aws region string
+
+        Returns None
+        """
+        for account in add_dict:
+            common.log_account_event(self.AWS_SERVICE, region, "added", account)
+        self.add_member_list(list(add_dict), region=region)
+        common.flush_account_events(self.AWS_SERVICE, region)
+
+        if associated_list:
+            self.enable_scans(associated_list, region=region)
+
+    @manager.s_client_manager
+    def get_associated_members(self, region, only_associated=True):
         """
         Returns the organization member accounts that are associated with
         Inspactor for the region provided by the region parameter.
         Args:
         region - aws region string
+        Kargs:
+        only_associated - When False every member is returned whatever its
+                          relationship status
+
+        Returns generator of dictionaries containing member information, the
+        pages are listed as the members are consumed.
+        """
+        return common.paginate(self.da_client_manager.client("inspector2", region), "list_members",
+                               "members", page_size=self.MEMBER_PAGE_SIZE, onlyAssociated=only_associated)
+
+    @manager.s_client_manager
+    def get_account_status(self, account_list, region):
+        """
+        Returns the scan status of the accounts provided by the account_list
+        parameter for the region indicated by the region parameter.  Accounts are
+        requested in batches of STATUS_BATCH_SIZE, the maximum number accepted by
+        batch_get_account_status.
+        Args:
+        account_list - list of aws account id strings
+        region - aws region string
+
+        Returns dictionary of account id to a dictionary of resource type to status
+        """
+        client = self.da_client_manager.client("inspector2", region)
+
+        return_dict = {}
+        for index in range(0, len(account_list), self.STATUS_BATCH_SIZE):
+            response = client.batch_get_account_status(
+                accountIds=account_list[index:index + self.STATUS_BATCH_SIZE])
+
+            for account in response["accounts"]:
+                resource_state = account.get("resourceState", {})
+                return_dict[account["accountId"]] = {
+                    resource_type: resource_state.get(state_key, {}).get("status", "UNKNOWN")
+                    for resource_type, state_key in self.RESOURCE_STATE_KEYS.items()
+                }
+
+            for failure in response["failedAccounts"]:
+                return_dict[failure["accountId"]] = dict.fromkeys(self.RESOURCE_STATE_KEYS,
+                                                                  failure["errorCode"])
+
+        return return_dict
+
+    @manager.s_client_manager
+    def wait_for_scans(self, region_accounts, timeout=None, initial_interval=2, max_interval=30):
+        """
+        Polls the scan status of the accounts in each region until none of their
+        resource types are pending or the timeout is reached.  Regions are polled
+        concurrently, only accounts that are still pending are polled again and
+        the interval between polls doubles up to max_interval.
+        Args:
+        region_accounts - dictionary of aws region string to list of aws account id strings
+        Kargs:
+        timeout - Seconds to wait for all regions (DEFAULT=DEFAULT_STATUS_TIMEOUT)
+        initial_interval - Seconds to wait before the second poll
+        max_interval - Maximum seconds to wait between polls
 
-        Returns list of dictionaries contaiing member information.
+        Returns dictionary of region to account id to resource type to status
         """
-        response = self.da_client_manager.client("inspector2", region).list_members(onlyAssociated=True)
-        return response["members"]
\ No newline at end of file
+        if timeout is None:
+            timeout = self.DEFAULT_STATUS_TIMEOUT
+        deadline = time.monotonic() + timeout
+
+        def poll_region(region):
+            status_dict = {}
+            pending_list = list(region_accounts[region])
+            interval = initial_interval
+            while pending_list:
+                status_dict.update(self.get_account_status(pending_list, region))
+                pending_list = [account for account in pending_list
+                                if self._scan_pending(status_dict.get(account))]
+
+                remaining = deadline - time.monotonic()
+                if not pending_list or remaining <= 0:
+                    break
+
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, max_interval)
+
+            return status_dict
+
+        return common.thread_map(poll_region, region_accounts)
+
+    def log_scan_status(self, status_table):
+        """
+        Logs a per region summary of the status table returned by wait_for_scans
+        along with any account that does not have all scan types enabled.
+        Args:
+        status_table - dictionary of region to account id to resource type to status
+
+        Returns None
+        """
+        for region, account_dict in status_table.items():
+            incomplete = {account: status for account, status in account_dict.items()
+                          if set(status.values()) != {"ENABLED"}}
+            logging.info("%s scans enabled for %d of %d accounts in %s", self.AWS_SERVICE,
+                         len(account_dict) - len(incomplete), len(account_dict), region)
+
+            for account, status in incomplete.items():
+                logging.warning("%s scans not fully enabled for account %s in %s: %s",
+                                self.AWS_SERVICE, account, region, status)
+
+    def _scan_pending(self, status):
+        """
+        Returns True when an account status from get_account_status still has
+        a resource type in a pending state or no status was returned.
+        Args:
+        status - dictionary of resource type to status or None
+
+        Returns bool
+        """
+        if not status:
+            return True
+
+        return any(status[resource_type] in self.STATUS_PENDING
+                   for resource_type in self.SCAN_RESOURCE_TYPES)
@@ -2,13 +2,47 @@
 Entrypoint for setting up IR solution.  Can be run from a system with the
 appropriate IAM credentials or as a custom resource in a Cloudformation stack.
 """
+import csv
+import glob
+import hashlib
+import io
+import json
 import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from uuid import uuid4
 
 
+import botocore.exceptions
 import common
+import correlation
+import findings
 import guardduty
 import inspector
+import ledger
+import profiling
 import securityhub
+import sharding
+from org_accounts import manager
+
+
+# Seconds kept in reserve from the Lambda remaining time when scanning for drift
+DRIFT_RESPONSE_MARGIN = 30
+# Seconds kept in reserve from the Lambda remaining time when gathering shards
+SHARD_RESPONSE_MARGIN = 30
+# Seconds kept in reserve from the Lambda remaining time to send the CFN response
+DEADLINE_RESPONSE_MARGIN = 30
+# Seconds a cached shard worker service object (and its assumed role
+# credentials) is reused for
+SHARD_SERVICE_TTL = 2700
+_SHARD_SERVICE_CACHE = {}
+INFO_FORMATS = ["jsonl", "csv"]
+# Inventory rows buffered between the listing threads and the writer
+INFO_QUEUE_SIZE = 1000
 
 
 class IRManager:
@@ -21,56 +55,102 @@ class IRManager:
         "guardduty": guardduty.Guardduty,
         "inspector": inspector.Inspector
     }
+    ACCOUNT_ACTIONS = ["enroll", "offboard"]
+    DEFAULT_DRIFT_BUDGET = 300
+    DRIFT_WORKERS = 32
+    # SSM parameter path holding the fingerprint of each converged service
+    FINGERPRINT_PARAMETER_PREFIX = "/ir-foundations/fingerprint"
+    # Status of a service in results
+    RESULT_STATUSES = ["NOT_STARTED", "SUCCEEDED", "SKIPPED", "PARTIAL", "FAILED", "DEADLINE_EXCEEDED"]
 
     def __init__(self, target_account=None, assume_role_name=None, external_id=None):
         self.target_account = target_account
         self.assume_role_name = assume_role_name
         self.external_id = external_id
+        # Service to status of the last create or update, see RESULT_STATUSES
+        self.results = {}
 
-    def ir_create(self, config_dict):
+    def ir_create(self, config_dict, force=False):
         """
         Invokes the create methods for the services requested in the config_dict
         Args:
         config_dict - IR dictionary
+        Kargs:
+        force - Run the service workflow even when the service is converged
 
         Returns None
         """
-        self._ir_action("create", config_dict)
+        self._ir_action("create", config_dict, force=force)
 
-    def ir_update(self, config_dict):
+    def ir_update(self, config_dict, force=False):
         """
         Invokes the update methods for the services requested in the
         config_dict. NOTE: The created method for IR services will be the same
         method used for creation.
         Args:
         config_dict - IR dictionary
+        Kargs:
+        force - Run the service workflow even when the service is converged
 
         Returns None
         """
-        self._ir_action("update", config_dict)
+        self._ir_action("update", config_dict, force=force)
 
     def ir_destroy(self, config_dict):
         """
         Invokes the destroy methods for the services requested in the config_dict
         Note: Most services will destroy by removing the delegated admin from
         the organization which returns service control to local account.
+        The services are destroyed concurrently and a failed service does not
+        stop the others; a ValueError listing the failed services is raised
+        once all of them were attempted.
         Args:
         config_dict - IR dictionary
 
         Returns None
         """
-        self._ir_action("destroy", config_dict)
+        service_list = [service for service in config_dict if service in self.SERVICE_CLASS_MAPPING]
+
+        profiling.phase("destroy")
+
+        def destroy_service(service):
+            logging.debug(config_dict[service])
+            self._get_service_object(service).destroy(config_dict[service])
 
-    def _ir_action(self, action, config_dict):
+        result_dict = common.thread_map(destroy_service, service_list, return_exceptions=True)
+        failed_dict = {service: result for service, result in result_dict.items()
+                       if isinstance(result, Exception)}
+        for service, err in failed_dict.items():
+            logging.error("Destroy failed for service %s: %s", service, err)
+
+        if failed_dict:
+            raise ValueError("Destroy failed for " +
+                             "; ".join(f"{service}: {err}" for service, err in failed_dict.items()))
+
+    def _ir_action(self, action, config_dict, force=False):
         """
         Generalized function used to perform create, update and destroy actions
-        for IR services.
+        for IR services.  Create and update are skipped for services that are
+        still converged with their config (see is_converged) unless force is
+        set, and the fingerprint of each service is stored after it converges.
+        The status of every service is kept in results so the services
+        completed before a failure or the run deadline can be reported, and
+        the workflow of every service is recorded in the run ledger.  A
+        service with failed account batches is PARTIAL and does not stop the
+        services after it; ledger.UnitsFailed listing the PARTIAL services is
+        raised once every service was attempted.
         Args:
         action - Type of action to take
         config_dict - IR configuration dictionary
+        Kargs:
+        force - Run the service workflow even when the service is converged
 
         Returns None
         """
+        self.results = {service: "NOT_STARTED" for service in config_dict
+                        if service in self.SERVICE_CLASS_MAPPING}
+        partial_list = []
+
         for service in config_dict:
 
             logging.debug(config_dict[service])
@@ -78,26 +158,691 @@ class IRManager:
             if service not in self.SERVICE_CLASS_MAPPING:
                 continue
 
-            service_object = self.SERVICE_CLASS_MAPPING[service](
-                target_account=self.target_account,
-                assume_role_name=self.assume_role_name,
-                external_id=self.external_id)
+            try:
+                common.check_deadline(f"IR {action} of {service}")
+                profiling.phase(f"{action} {service}")
+                service_object = self._get_service_object(service)
+
+                if action == "destroy":
+                    service_object.destroy(config_dict[service])
+                    self.results[service] = "SUCCEEDED"
+                    continue
+
+                with ledger.track(service):
+                    if not force and self.is_converged(service, service_object, config_dict[service]):
+                        logging.info("Service %s is converged with its config, skipping %s", service, action)
+                        self.results[service] = "SKIPPED"
+                        continue
+
+                    if action == "create":
+                        service_object.create(config_dict[service])
+                    else:
+                        service_object.update(config_dict[service])
+
+                    self.save_fingerprint(service, service_object, config_dict[service])
+                self.results[service] = "SUCCEEDED"
+
+            except common.DeadlineExceeded:
+                self.results[service] = "DEADLINE_EXCEEDED"
+                raise
+
+            except ledger.UnitsFailed as err:
+                # The ledger recorded the failed batches for --retry-failed
+                logging.error("Service %s %s completed with failed account batches: %s", service, action, err)
+                self.results[service] = "PARTIAL"
+                partial_list.append(service)
+
+            except Exception:
+                self.results[service] = "FAILED"
+                raise
+
+        if partial_list:
+            raise ledger.UnitsFailed(f"Account batches failed for {', '.join(partial_list)}")
+
+    def get_fingerprint(self, service, service_object, input_dict):
+        """
+        Returns a hash of the desired state of a service together with
+        inexpensive organization signals, the number of organization accounts,
+        whether its delegated admin account is registered for the service and,
+        when the config has targeting parameters, the regions targeted for
+        every account.  A change to any of them results in a different
+        fingerprint.
+        Args:
+        service - IR service name
+        service_object - service class instance
+        input_dict - IR dictionary for the service
+
+        Returns sha256 hex string
+        """
+        state_dict = {
+            "service": service,
+            "config": input_dict,
+            "account_count": len(service_object.get_org_accounts()),
+            # Only the principal of this service, so registering the admin for
+            # another service does not change this fingerprint
+            "admin_registered": service_object.SERVICE_PRINCIPAL in service_object.list_services_for_account(
+                input_dict["admin_account_id"])
+        }
+        target_index = service_object.get_target_index(input_dict)
+        if target_index:
+            # Accounts moving between organizational units change their targets
+            state_dict["targets"] = target_index.digest()
+
+        return hashlib.sha256(json.dumps(state_dict, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def is_converged(self, service, service_object, input_dict):
+        """
+        Returns True if the fingerprint stored after the last successful run
+        of the service matches its current fingerprint and a low cost read
+        only verification passes.  The verification checks the service access,
+        delegated admin and admin status in every enabled region, so changes
+        made outside of the IR solution still cause a full run.
+        Args:
+        service - IR service name
+        service_object - service class instance
+        input_dict - IR dictionary for the service
+
+        Returns bool
+        """
+        stored_fingerprint = self.load_fingerprint(service, service_object)
+        if stored_fingerprint != self.get_fingerprint(service, service_object, input_dict):
+            return False
+
+        admin_account_id = input_dict["admin_account_id"]
+
+        def run_check(region):
+            if region == "global":
+                return not service_object.check_org_drift(input_dict)
+            return service_object.get_admin_status(admin_account_id, region) == "ENABLED"
+
+        check_list = ["global"] + [region.strip() for region in input_dict["enable_regions"]]
+        results = common.thread_map(run_check, check_list, return_exceptions=True)
+        for region, result in results.items():
+            if result is not True:
+                logging.info("Service %s fingerprint matches but %s verification failed: %s",
+                             service, region, result)
+                return False
+
+        return True
+
+    def _fingerprint_parameter(self, service):
+        """
+        Returns the SSM parameter name holding the fingerprint of the service.
+        """
+        return f"{self.FINGERPRINT_PARAMETER_PREFIX}/{service}"
+
+    def load_fingerprint(self, service, service_object):
+        """
+        Returns the fingerprint stored for the service or None if the service
+        has not been converged yet.
+        Args:
+        service - IR service name
+        service_object - service class instance
+
+        Returns sha256 hex string or None
+        """
+        try:
+            response = service_object.client_manager.client("ssm").get_parameter(
+                Name=self._fingerprint_parameter(service))
+
+        except botocore.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] == "ParameterNotFound":
+                return None
+            raise err from None
+
+        return response["Parameter"]["Value"]
+
+    def save_fingerprint(self, service, service_object, input_dict):
+        """
+        Stores the current fingerprint of a converged service.
+        Args:
+        service - IR service name
+        service_object - service class instance
+        input_dict - IR dictionary for the service
+
+        Returns None
+        """
+        service_object.client_manager.client("ssm").put_parameter(
+            Name=self._fingerprint_parameter(service),
+            Value=self.get_fingerprint(service, service_object, input_dict),
+            Type="String",
+            Overwrite=True)
+
+    def ir_sharded_create(self, config_dict, work_queue, result_queue, shard_size=None,
+                          timeout=None, local_workers=0, result_queue_url=None, force=False):
+        """
+        Performs the create workflow with the member account work split into
+        (service, region, account range) shards.  Every service is prepared
+        first, then the shards are queued on work_queue and their results are
+        gathered from result_queue.
+        Args:
+        config_dict - IR configuration dictionary
+        work_queue - sharding queue backend the shards are sent to
+        result_queue - sharding queue backend the shard results are read from
+        Kargs:
+        shard_size - Number of accounts per shard
+        timeout - Seconds allowed for the whole run
+        local_workers - Number of threads in this process that process shards
+        result_queue_url - Url of result_queue for remote workers
+        force - Run the services even when they are converged with their config
+
+        Returns dictionary summarizing the shard results, the regions skipped
+        because they were failing and the open circuits
+        """
+        start_time = time.monotonic()
+        service_list = [service for service in config_dict if service in self.SERVICE_CLASS_MAPPING]
+        service_dict = common.thread_map(self._get_service_object, service_list)
+        if not force:
+            converged_dict = common.thread_map(
+                lambda service: self.is_converged(service, service_dict[service], config_dict[service]),
+                service_list)
+            for service in [service for service in service_list if converged_dict[service]]:
+                logging.info("Service %s is converged with its config, skipping create", service)
+                if ledger.get_ledger():
+                    ledger.get_ledger().record(service)
+                service_list.remove(service)
+                del service_dict[service]
+        profiling.phase("prepare")
+        common.thread_map(lambda service: service_dict[service].prepare(config_dict[service]),
+                          service_list)
+        org_accounts = next(iter(service_dict.values())).get_org_accounts() if service_dict else {}
+
+        coordinator = sharding.ShardCoordinator(work_queue, result_queue, shard_size=shard_size,
+                                                result_queue_url=result_queue_url)
+        # Regions skipped while preparing are failing, their shards would fail fast
+        skipped_list = sorted(f"{service}:{region}" for service in service_list
+                              for region in service_dict[service].skipped_regions)
+        shard_config = {service: dict(config_dict[service], enable_regions=[
+            region for region in config_dict[service]["enable_regions"]
+            if region.strip() not in service_dict[service].skipped_regions])
+                        for service in service_list}
+        shard_list = coordinator.plan_shards(str(uuid4()), shard_config, org_accounts,
+                                             {"target_account": self.target_account,
+                                              "assume_role": self.assume_role_name,
+                                              "external_id": self.external_id})
+
+        if timeout is not None:
+            timeout = max(timeout - (time.monotonic() - start_time), 0)
+        profiling.phase("shards")
+        results = coordinator.run(shard_list, timeout=timeout,
+                                  service_factory=lambda shard: service_dict[shard["service"]],
+                                  local_workers=local_workers)
+
+        failed_list = sorted(shard_id for shard_id, result in results.items()
+                             if result["status"] != "SUCCEEDED")
+        for shard_id in failed_list:
+            logging.error("Shard %s failed: %s", shard_id, results[shard_id]["error"])
+
+        for region_key in skipped_list:
+            logging.error("Region %s skipped: %s", region_key,
+                          service_dict[region_key.split(":")[0]].skipped_regions[region_key.split(":")[1]])
+
+        for service in service_list:
+            if service_dict[service].skipped_regions:
+                continue
+            if not [shard_id for shard_id in failed_list if shard_id.startswith(f"{service}:")]:
+                self.save_fingerprint(service, service_dict[service], config_dict[service])
+
+        if ledger.get_ledger():
+            self.record_shards(ledger.get_ledger(), service_dict, shard_list, results)
+
+        return {
+            "shards": len(results),
+            "failed": len(failed_list),
+            "added": sum(result.get("added", 0) for result in results.values()),
+            "removed": sum(result.get("removed", 0) for result in results.values()),
+            "duration": round(time.monotonic() - start_time, 3),
+            "failed_shards": failed_list,
+            "skipped_regions": skipped_list,
+            "open_circuits": common.get_open_circuits(),
+            "results": results
+        }
+
+    def record_shards(self, run_ledger, service_dict, shard_list, results):
+        """
+        Records the shards of a sharded create as account batch units of the
+        run ledger, and the workflow unit of every sharded service: FAILED
+        when regions were skipped, PARTIAL when shards failed.
+        Args:
+        run_ledger - ledger.RunLedger
+        service_dict - dictionary of IR service name to service class instance
+        shard_list - list of shard messages from plan_shards
+        results - dictionary of shard id to shard result
 
-            if action == "create":
-                method = service_object.create
-            elif action == "update":
-                method = service_object.update
+        Returns None
+        """
+        for shard in shard_list:
+            result = results[shard["shard_id"]]
+            run_ledger.record(service_dict[shard["service"]].AWS_SERVICE, shard["region"],
+                              f"shard-{shard['shard_id'].rsplit(':', 1)[1]}",
+                              status="SUCCEEDED" if result["status"] == "SUCCEEDED" else "FAILED",
+                              accounts=shard["accounts"], error=result["error"],
+                              duration=result.get("duration"))
+
+        for service, service_object in service_dict.items():
+            failed_list = [shard_id for shard_id, result in results.items()
+                           if shard_id.startswith(f"{service}:") and result["status"] != "SUCCEEDED"]
+            if service_object.skipped_regions:
+                run_ledger.record(service, status="FAILED", error="Skipped failing regions " +
+                                  ", ".join(sorted(service_object.skipped_regions)))
+            elif failed_list:
+                run_ledger.record(service, status="PARTIAL", error=f"{len(failed_list)} shards failed")
             else:
-                method = service_object.destroy
+                run_ledger.record(service)
+
+    def ir_retry_failed(self, config_dict, run_ledger):
+        """
+        Retries the units of a previous run that did not succeed, recording
+        their new outcome in run_ledger.  The accounts of failed batches are
+        reconciled again for their service region only, see
+        reconcile_members.  Services whose workflow failed, or that were not
+        reached by the previous run, are created again completely.
+        Args:
+        config_dict - IR configuration dictionary
+        run_ledger - ledger.RunLedger of the previous run
+
+        Returns None
+        """
+        service_list = [service for service in config_dict if service in self.SERVICE_CLASS_MAPPING]
+        rerun_list, retry_dict = run_ledger.plan_retry(
+            {service: self.SERVICE_CLASS_MAPPING[service].AWS_SERVICE for service in service_list})
+        logging.info("Retrying %d account batch regions and %d services",
+                     sum(len(region_dict) for region_dict in retry_dict.values()), len(rerun_list))
+
+        retry_results = {}
+        if retry_dict:
+            profiling.phase("retry batches")
+            service_dict = common.thread_map(self._get_service_object, retry_dict)
+            org_accounts = next(iter(service_dict.values())).get_org_accounts()
+            work_list = [(service, region) for service, region_dict in retry_dict.items()
+                         for region in region_dict]
 
-            method(config_dict[service])
+            def run_work(work):
+                service, region = work
+                run_ledger.discard(service_dict[service].AWS_SERVICE, region)
+                account_list = retry_dict[service][region]
+                try:
+                    service_dict[service].reconcile_members(
+                        config_dict[service], region,
+                        {account: org_accounts[account]["Email"] for account in account_list
+                         if account in org_accounts})
 
-    def list_info(self):
-        for service in self.SERVICE_CLASS_MAPPING:
-            class_instance = self.SERVICE_CLASS_MAPPING[service]()
-            class_instance.echo_info()
+                except ledger.UnitsFailed:
+                    raise
 
+                except Exception as err:
+                    # Batches are not recorded when the lookup of the members failed
+                    run_ledger.record(service_dict[service].AWS_SERVICE, region, account_list[0],
+                                      status="FAILED", accounts=account_list, error=str(err))
+                    raise
+
+            results = common.thread_map(run_work, work_list, return_exceptions=True)
+            for (service, region), result in results.items():
+                if isinstance(result, Exception):
+                    logging.error("Retry of %s members in %s failed: %s", service, region, result)
+
+            for service, service_object in service_dict.items():
+                if run_ledger.failed(service_object.AWS_SERVICE, batches=True):
+                    run_ledger.record(service, status="PARTIAL", error="Account batches failed again")
+                    retry_results[service] = "PARTIAL"
+                else:
+                    run_ledger.record(service)
+                    self.save_fingerprint(service, service_object, config_dict[service])
+                    retry_results[service] = "SUCCEEDED"
+
+        self.results = {}
+        try:
+            if rerun_list:
+                for service in rerun_list:
+                    run_ledger.discard(service)
+                    run_ledger.discard(self.SERVICE_CLASS_MAPPING[service].AWS_SERVICE)
+                self._ir_action("create", {service: config_dict[service] for service in rerun_list},
+                                force=True)
+        finally:
+            self.results.update(retry_results)
+
+        failed_list = [service for service, status in retry_results.items() if status != "SUCCEEDED"]
+        if failed_list:
+            raise ledger.UnitsFailed(f"Account batches failed again for {', '.join(failed_list)}")
+
+    def ir_account_event(self, action, account_id, config_dict):
+        """
+        Enrolls or offboards a single account for the services requested in
+        the config_dict.  Every (service, region) pair is handled concurrently
+        so only O(regions) work is needed instead of a full create.
+        Args:
+        action - "enroll" or "offboard"
+        account_id - AWS account id the action applies to
+        config_dict - IR configuration dictionary
 
+        Returns dictionary of "service:region" to the result of the action
+        """
+        work_list = self.plan_account_event(action, account_id, config_dict)
+        if not work_list:
+            logging.info("No work to %s account %s", action, account_id)
+            return {}
+
+        service_dict = common.thread_map(self._get_service_object,
+                                         {service for service, _ in work_list})
+
+        account_email = None
+        if action == "enroll":
+            account_info = next(iter(service_dict.values())).get_org_account(account_id)
+            if not account_info or account_info["Status"] != "ACTIVE":
+                logging.warning("Account %s is not an active organization member, skipping enroll",
+                                account_id)
+                return {}
+            account_email = account_info["Email"]
+
+            # Only the regions the account is targeted in by each service config
+            index_dict = {service: service_object.get_target_index(config_dict[service], account_id)
+                          for service, service_object in service_dict.items()}
+            work_list = [(service, region) for service, region in work_list
+                         if not index_dict[service] or index_dict[service].is_target(account_id, region)]
+            if not work_list:
+                logging.info("Account %s is not targeted by any service, skipping enroll", account_id)
+                return {}
+
+        def run_work(work):
+            service, region = work
+            service_object = service_dict[service]
+            if action == "enroll":
+                service_object.enroll_account(account_id, account_email, config_dict[service], region)
+            else:
+                service_object.offboard_account(account_id, config_dict[service], region)
+            return "OK"
+
+        results = common.thread_map(run_work, work_list, return_exceptions=True)
+
+        return_dict = {}
+        failure_list = []
+        for (service, region), result in results.items():
+            if isinstance(result, Exception):
+                logging.error("Unable to %s account %s for %s in %s: %s",
+                              action, account_id, service, region, result)
+                failure_list.append(f"{service}:{region}")
+                result = str(result)
+            return_dict[f"{service}:{region}"] = result
+
+        if failure_list:
+            raise ValueError(f"Unable to {action} account {account_id} for {failure_list}")
+
+        return return_dict
+
+    def plan_account_event(self, action, account_id, config_dict):
+        """
+        Builds the list of (service, region) work items needed to enroll or
+        offboard a single account.  No AWS calls are made so the plan can be
+        inspected offline.
+        Args:
+        action - "enroll" or "offboard"
+        account_id - AWS account id the action applies to
+        config_dict - IR configuration dictionary
+
+        Returns list of (service, region) tuples
+        """
+        if action not in self.ACCOUNT_ACTIONS:
+            raise ValueError(f"Unsupported account action {action}")
+
+        work_list = []
+        for service in config_dict:
+            if service not in self.SERVICE_CLASS_MAPPING:
+                continue
+
+            if account_id == config_dict[service]["admin_account_id"]:
+                logging.info("Account %s is the %s delegated admin, skipping", account_id, service)
+                continue
+
+            for region in config_dict[service]["enable_regions"]:
+                work_list.append((service, region.strip()))
+
+        return work_list
+
+    def ir_drift(self, config_dict, time_budget=None):
+        """
+        Read only scan that compares the organization with the services
+        requested in the config_dict.  The delegated admin, per region admin
+        status, organization auto enable, aggregation and member association
+        checks of every service and region are run concurrently.  Checks that
+        have not completed when the time budget runs out are reported with a
+        "timeout" check.
+        Args:
+        config_dict - IR configuration dictionary
+        Kargs:
+        time_budget - Seconds allowed for the scan (DEFAULT=DEFAULT_DRIFT_BUDGET)
+
+        Returns drift report dictionary
+        """
+        if not time_budget:
+            time_budget = self.DEFAULT_DRIFT_BUDGET
+        start_time = time.monotonic()
+        deadline = start_time + time_budget
+
+        service_list = [service for service in config_dict if service in self.SERVICE_CLASS_MAPPING]
+        service_dict = common.thread_map(self._get_service_object, service_list)
+        org_accounts = next(iter(service_dict.values())).get_inventory() if service_dict else {}
+
+        check_list = []
+        for service, service_object in service_dict.items():
+            check_list.append((service, "global"))
+            for region in service_object.get_drift_regions(config_dict[service]):
+                check_list.append((service, region))
+
+        def run_check(check):
+            service, region = check
+            if region == "global":
+                return service_dict[service].check_org_drift(config_dict[service])
+            return service_dict[service].check_region_drift(config_dict[service], region, org_accounts)
+
+        profiling.phase("drift checks")
+        results = common.thread_map(run_check, check_list, max_workers=self.DRIFT_WORKERS,
+                                    return_exceptions=True,
+                                    timeout=max(deadline - time.monotonic(), 0))
+
+        drift_list = []
+        complete = True
+        for (service, region), result in results.items():
+            if isinstance(result, Exception):
+                complete = complete and not isinstance(result, TimeoutError)
+                check_name = "timeout" if isinstance(result, TimeoutError) else "error"
+                logging.error("Drift check for %s in %s failed: %s", service, region, result)
+                drift_list.append((service_dict[service].AWS_SERVICE, region, "", check_name, "", str(result)))
+            else:
+                drift_list.extend(result)
+
+        return {
+            "generated": datetime.now(timezone.utc).isoformat(),
+            "duration": round(time.monotonic() - start_time, 3),
+            "complete": complete,
+            "account_count": len(org_accounts),
+            "drift_count": len(drift_list),
+            "columns": manager.DRIFT_COLUMNS,
+            "drift": drift_list
+        }
+
+    def _get_service_object(self, service):
+        """
+        Creates the service class instance for the service name provided.
+        Args:
+        service - IR service name
+
+        Returns service class instance
+        """
+        return self.SERVICE_CLASS_MAPPING[service](
+            target_account=self.target_account,
+            assume_role_name=self.assume_role_name,
+            external_id=self.external_id)
+
+    def list_info(self, config_dict, output, output_format="jsonl"):
+        """
+        Writes an inventory of the organization for the services requested in
+        the config_dict: the management account, service access, delegated
+        admins and the admin and member status of every service region (see
+        OrgManager.echo_org_info and echo_info).  The services and regions are
+        listed concurrently and the rows are written as they arrive through a
+        queue of INFO_QUEUE_SIZE rows, so memory does not grow with the
+        number of rows and the first rows are written without waiting for the
+        whole inventory.
+        Args:
+        config_dict - IR configuration dictionary
+        output - Text file object the rows are written to
+        Kargs:
+        output_format - One of INFO_FORMATS
+
+        Returns dictionary with the number of rows written and the duration
+        """
+        start_time = time.monotonic()
+        service_list = [service for service in config_dict if service in self.SERVICE_CLASS_MAPPING]
+        write_row = info_row_writer(output, output_format)
+        row_queue = queue.Queue(maxsize=INFO_QUEUE_SIZE)
+        error_list = []
+
+        def run_listing():
+            try:
+                service_dict = common.thread_map(self._get_service_object, service_list)
+                if not service_dict:
+                    return
+                org_accounts = next(iter(service_dict.values())).get_inventory()
+
+                def run_item(item):
+                    if item == "organization":
+                        next(iter(service_dict.values())).echo_org_info(row_queue.put)
+                    else:
+                        service_dict[item].echo_info(row_queue.put, org_accounts)
+
+                results = common.thread_map(run_item, ["organization"] + service_list, return_exceptions=True)
+                for item, result in results.items():
+                    if isinstance(result, Exception):
+                        logging.error("Inventory of %s failed: %s", item, result)
+                        row_queue.put(("error", item, "global", "", "", "ERROR", str(result)))
+
+            except Exception as err:
+                error_list.append(err)
+
+            finally:
+                row_queue.put(None)
+
+        profiling.phase("inventory")
+        threading.Thread(target=run_listing, daemon=True).start()
+
+        row_count = 0
+        while True:
+            try:
+                row = row_queue.get_nowait()
+            except queue.Empty:
+                # Make the rows written so far visible while waiting for more
+                output.flush()
+                row = row_queue.get()
+
+            if row is None:
+                break
+            if not row_count:
+                logging.info("First inventory row after %.3fs", time.monotonic() - start_time)
+            write_row(row)
+            row_count += 1
+
+        output.flush()
+        if error_list:
+            raise error_list[0]
+
+        return {"rows": row_count, "duration": round(time.monotonic() - start_time, 3)}
+
+    def export_findings(self, config_dict, output_prefix=findings.DEFAULT_OUTPUT_PREFIX,
+                        days=findings.DEFAULT_EXPORT_DAYS, shard_by=None,
+                        window_hours=findings.DEFAULT_WINDOW_HOURS, severity_list=None,
+                        part_count=findings.DEFAULT_PART_FILES):
+        """
+        Exports the Security Hub findings updated in the last days from the
+        delegated admin account to gzip compressed JSON Lines part files, see
+        findings.export_findings and plan_findings_export.
+        Args:
+        config_dict - IR configuration dictionary
+        Kargs:
+        output_prefix - Filename prefix of the part files
+        days - Days of finding updates exported
+        shard_by - list of findings.SHARD_DIMENSIONS the export is split by
+        window_hours - Hours of the time window shards
+        severity_list - list of severity labels exported (DEFAULT=all of them)
+        part_count - Number of part files
+
+        Returns the export summary dictionary
+        """
+        client_manager, region_list, shard_dict = self.plan_findings_export(
+            config_dict, days=days, shard_by=shard_by, window_hours=window_hours, severity_list=severity_list)
+
+        profiling.phase("findings export")
+        return findings.export_findings(client_manager, region_list, shard_dict,
+                                        output_prefix=output_prefix, part_count=part_count)
+
+    def correlate_findings(self, config_dict, filename_list=None, dedup_by="generator", **export_kargs):
+        """
+        Builds the correlation.FindingIndex of the Security Hub findings,
+        read from the part files of an earlier export or, without part files,
+        pulled from the delegated admin account and indexed as the pages
+        arrive.
+        Args:
+        config_dict - IR configuration dictionary
+        Kargs:
+        filename_list - list of findings part files
+        dedup_by - One of correlation.DEDUP_KEYS
+        export_kargs - days, shard_by, window_hours and severity_list of the
+                       findings pulled, see plan_findings_export
+
+        Returns FindingIndex
+        """
+        finding_index = correlation.FindingIndex(dedup_by=dedup_by)
+        profiling.phase("findings correlation")
+        if filename_list:
+            finding_index.add_page(None, findings.read_findings(filename_list))
+            return finding_index
+
+        client_manager, region_list, shard_dict = self.plan_findings_export(config_dict, **export_kargs)
+        results = findings.pull_findings(client_manager, region_list, shard_dict, finding_index.add_page)
+        for (region, shard_name), result in results.items():
+            if isinstance(result, Exception):
+                raise ValueError(f"Findings of shard {shard_name} in {region} could not be pulled: {result}")
+
+        return finding_index
+
+    def plan_findings_export(self, config_dict, days=findings.DEFAULT_EXPORT_DAYS, shard_by=None,
+                             window_hours=findings.DEFAULT_WINDOW_HOURS, severity_list=None):
+        """
+        Plans the GetFindings shards of the findings updated in the last days.
+        The findings are pulled from the aggregation region, which holds the
+        findings of every linked region, or from every enabled region when no
+        aggregation region is set.
+        Args:
+        config_dict - IR configuration dictionary
+        Kargs:
+        days - Days of finding updates pulled
+        shard_by - list of findings.SHARD_DIMENSIONS the findings are split by
+        window_hours - Hours of the time window shards
+        severity_list - list of severity labels pulled (DEFAULT=all of them)
+
+        Returns tuple of (ClientManager of the delegated admin account, list
+            of regions, dictionary of shard name to GetFindings Filters)
+        """
+        input_dict = config_dict.get("securityhub")
+        if not input_dict:
+            raise ValueError("Findings are pulled with the securityhub configuration")
+
+        service_object = self._get_service_object("securityhub")
+        client_manager = service_object.get_delegated_client_manager(service_object.SERVICE_PRINCIPAL)
+        if input_dict.get("aggregate_region"):
+            region_list = [input_dict["aggregate_region"].strip()]
+        else:
+            region_list = [region.strip() for region in input_dict["enable_regions"]]
+
+        start, end = findings.export_window(days)
+        account_list = sorted(service_object.get_org_accounts()) if "account" in (shard_by or []) else None
+        shard_dict = findings.plan_shards(start, end, shard_by=shard_by, account_list=account_list,
+                                          window_hours=window_hours, severity_list=severity_list)
+        logging.info("Pulling findings updated since %s from %s in %d shards", start.isoformat(),
+                     region_list, len(shard_dict) * len(region_list))
+        return client_manager, region_list, shard_dict
+
+
+@profiling.profile_handler
 def lambda_handler(event, context):
     """
     Function used as a handler for when this module is called as a custom
@@ -118,9 +863,14 @@ def lambda_handler(event, context):
     # CR considered failed if any part of the try block fails
     cfn_status = cfnresponse.FAILED
     cfn_response_data = {}
+    irm_object = None
+    run_ledger = ledger.RunLedger(run_id=event.get("RequestId"))
+    ledger.set_ledger(run_ledger)
 
     try:
         common.setup_logging()
+        common.half_open_circuits()
+        common.set_deadline(common.Deadline.from_lambda_context(context, DEADLINE_RESPONSE_MARGIN))
 
         config_dict = _process_lambda_event(event)
 
@@ -128,8 +878,26 @@ def lambda_handler(event, context):
                                assume_role_name=config_dict["assume_role"],
                                external_id=config_dict["external_id"])
 
-        if event["RequestType"] in  ["Create", "Update"]:
-            irm_object.ir_create(config_dict)
+        if event["RequestType"] in  ["Create", "Update"] and os.environ.get("IR_SHARD_QUEUE_URL"):
+            result_queue_url = os.environ["IR_RESULT_QUEUE_URL"]
+            shard_result = irm_object.ir_sharded_create(
+                config_dict,
+                sharding.SQSQueue(os.environ["IR_SHARD_QUEUE_URL"]),
+                sharding.SQSQueue(result_queue_url),
+                shard_size=int(os.environ.get("IR_SHARD_SIZE", sharding.DEFAULT_SHARD_SIZE)),
+                timeout=max(context.get_remaining_time_in_millis() / 1000 - SHARD_RESPONSE_MARGIN, 0),
+                result_queue_url=result_queue_url,
+                force=event["RequestType"] == "Create")
+
+            cfn_response_data = {key: shard_result[key] for key in ["shards", "failed", "added"]}
+            if shard_result["failed"]:
+                raise ValueError(f"{shard_result['failed']} of {shard_result['shards']} shards failed")
+            if shard_result["skipped_regions"]:
+                raise ValueError(f"Skipped failing regions {', '.join(shard_result['skipped_regions'])}")
+
+        elif event["RequestType"] in  ["Create", "Update"]:
+            # A new resource always performs a full run
+            irm_object.ir_create(config_dict, force=event["RequestType"] == "Create")
 
         elif event["RequestType"] == "Delete":
             irm_object.ir_destroy(config_dict)
@@ -137,9 +905,222 @@ def lambda_handler(event, context):
         cfn_status = cfnresponse.SUCCESS
 
     finally:
+        if irm_object and irm_object.results:
+            cfn_response_data["services"] = ",".join(f"{service}:{status}"
+                                                     for service, status in irm_object.results.items())
+        if common.get_open_circuits():
+            cfn_response_data["open_circuits"] = ",".join(common.get_open_circuits())
+        if run_ledger.units:
+            run_ledger.log_failed()
+            cfn_response_data.update(run_ledger.response_data())
+        common.log_concurrency_metrics()
         cfnresponse.send(event, context, cfn_status, cfn_response_data)
 
 
+@profiling.profile_handler
+def shard_worker_handler(event, context):
+    """
+    Function used as a handler for the SQS queue of shards created by a
+    sharded create.  Each shard is processed and its result is sent to the
+    result queue named in the shard.
+
+    Args:
+    event - AWS SQS event
+    context - AWS contect object
+
+    Returns None
+    """
+    common.setup_logging()
+    common.half_open_circuits()
+    common.set_deadline(common.Deadline.from_lambda_context(context, SHARD_RESPONSE_MARGIN))
+
+    worker = sharding.ShardWorker(_get_shard_service)
+    for record in event["Records"]:
+        shard = json.loads(record["body"])
+        result = worker.process(shard)
+        sharding.SQSQueue(shard["result_queue"]).send([result])
+
+
+def _get_shard_service(shard):
+    """
+    Returns the service class instance for a shard message.  Instances are
+    cached between invocations of a warm Lambda for SHARD_SERVICE_TTL seconds.
+    Args:
+    shard - shard message dictionary
+
+    Returns service class instance
+    """
+    cache_key = (shard["service"], shard["target_account"], shard["assume_role"],
+                 shard["external_id"])
+    created, service_object = _SHARD_SERVICE_CACHE.get(cache_key, (0, None))
+    if time.monotonic() - created > SHARD_SERVICE_TTL:
+        service_object = IRManager(target_account=shard["target_account"],
+                                   assume_role_name=shard["assume_role"],
+                                   external_id=shard["external_id"])._get_service_object(shard["service"])
+        _SHARD_SERVICE_CACHE[cache_key] = (time.monotonic(), service_object)
+
+    return service_object
+
+
+@profiling.profile_handler
+def drift_handler(event, context):
+    """
+    Function used as a handler for the scheduled drift scan.  Scans the
+    services in the IR config stored in the IR_CONFIG environment variable
+    using the Lambda remaining time as the time budget.  When the
+    DRIFT_REPORT_BUCKET environment variable is set the JSON and CSV reports
+    are written to that bucket.
+
+    Args:
+    event - AWS EventBridge scheduled event
+    context - AWS contect object
+
+    Returns dictionary summarizing the drift report
+    """
+    common.setup_logging()
+    common.half_open_circuits()
+    common.set_deadline(common.Deadline.from_lambda_context(context, DRIFT_RESPONSE_MARGIN))
+
+    config_dict = json.loads(os.environ["IR_CONFIG"])
+    irm_object = IRManager(target_account=config_dict.get("target_account"),
+                           assume_role_name=config_dict.get("assume_role"),
+                           external_id=config_dict.get("external_id"))
+
+    time_budget = max(context.get_remaining_time_in_millis() / 1000 - DRIFT_RESPONSE_MARGIN, 0)
+    if not time_budget:
+        logging.warning("Drift scan skipped, less than %d seconds of Lambda time remaining",
+                        DRIFT_RESPONSE_MARGIN)
+        return {"generated": datetime.now(timezone.utc).isoformat(), "duration": 0, "complete": False,
+                "drift_count": 0}
+
+    report = irm_object.ir_drift(config_dict, time_budget=time_budget)
+    logging.info("Drift scan found %d drifted items (complete: %s)",
+                 report["drift_count"], report["complete"])
+
+    bucket = os.environ.get("DRIFT_REPORT_BUCKET")
+    if bucket:
+        s3_client = common.get_client("s3")
+        key_prefix = f"drift/{report['generated']}"
+        s3_client.put_object(Bucket=bucket, Key=f"{key_prefix}.json", Body=drift_report_json(report))
+        s3_client.put_object(Bucket=bucket, Key=f"{key_prefix}.csv", Body=drift_report_csv(report))
+        logging.info("Drift report written to s3://%s/%s", bucket, key_prefix)
+
+    return {key: report[key] for key in ["generated", "duration", "complete", "drift_count"]}
+
+
+def drift_report_json(report):
+    """
+    Serializes a drift report returned by IRManager.ir_drift as compact JSON.
+    Args:
+    report - drift report dictionary
+
+    Returns JSON string
+    """
+    return json.dumps(report, separators=(",", ":"))
+
+
+def drift_report_csv(report):
+    """
+    Serializes the drift rows of a report returned by IRManager.ir_drift as CSV.
+    Args:
+    report - drift report dictionary
+
+    Returns CSV string
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(report["columns"])
+    writer.writerows(report["drift"])
+    return output.getvalue()
+
+
+def info_row_writer(output, output_format):
+    """
+    Returns a function that writes a single inventory row to output in the
+    format requested.  The CSV header is written immediately.
+    Args:
+    output - Text file object
+    output_format - One of INFO_FORMATS
+
+    Returns function that accepts a row tuple matching manager.INFO_COLUMNS
+    """
+    if output_format not in INFO_FORMATS:
+        raise ValueError(f"Unsupported inventory format {output_format}")
+
+    if output_format == "csv":
+        csv_writer = csv.writer(output)
+        csv_writer.writerow(manager.INFO_COLUMNS)
+        return csv_writer.writerow
+
+    return lambda row: output.write(json.dumps(dict(zip(manager.INFO_COLUMNS, row))) + "\n")
+
+
+@profiling.profile_handler
+def org_event_handler(event, context):
+    """
+    Function used as a handler for Organizations membership change events
+    delivered by EventBridge.  Enrolls a new member account or offboards a
+    removed or closed account for the services in the IR config stored in the
+    IR_CONFIG environment variable.
+
+    Args:
+    event - AWS EventBridge event
+    context - AWS contect object
+
+    Returns dictionary of "service:region" to the result of the action
+    """
+    common.setup_logging()
+    common.half_open_circuits()
+    common.set_deadline(common.Deadline.from_lambda_context(context, DEADLINE_RESPONSE_MARGIN))
+
+    action, account_id = parse_org_event(event)
+    if not action:
+        logging.info("Ignoring event %s", event.get("detail", {}).get("eventName"))
+        return {}
+
+    config_dict = json.loads(os.environ["IR_CONFIG"])
+    irm_object = IRManager(target_account=config_dict.get("target_account"),
+                           assume_role_name=config_dict.get("assume_role"),
+                           external_id=config_dict.get("external_id"))
+
+    return irm_object.ir_account_event(action, account_id, config_dict)
+
+
+def parse_org_event(event):
+    """
+    Determines the account action and account id for an Organizations
+    CloudTrail event delivered by EventBridge.
+    Args:
+    event - AWS EventBridge event
+
+    Returns tuple of action ("enroll" or "offboard") and account id. Both are
+    None if the event does not require any action.
+    """
+    detail = event.get("detail", {})
+    event_name = detail.get("eventName")
+    request_params = detail.get("requestParameters") or {}
+    response_elements = detail.get("responseElements") or {}
+
+    if event_name == "CreateAccountResult":
+        status = detail["serviceEventDetails"]["createAccountStatus"]
+        if status["state"] == "SUCCEEDED":
+            return "enroll", status["accountId"]
+
+    elif event_name == "InviteAccountToOrganization":
+        if request_params["target"]["type"] == "ACCOUNT":
+            return "enroll", request_params["target"]["id"]
+
+    elif event_name == "AcceptHandshake":
+        for party in response_elements["handshake"]["parties"]:
+            if party["type"] == "ACCOUNT":
+                return "enroll", party["id"]
+
+    elif event_name in ["RemoveAccountFromOrganization", "CloseAccount"]:
+        return "offboard", request_params["accountId"]
+
+    return None, None
+
+
 def _process_lambda_event(event):
     """
     Parse a custom resource event's ResourceProperties and build a ir config
@@ -195,13 +1176,91 @@ if __name__ == "__main__":
     arg_dict = {
         "--config" : {"help": "IR config json file",
                       "required": True},
+        "--event": {"help": "Organizations event json file to process for a single account"},
+        "--dryrun": {"help": "Print the work planned for --event without calling AWS",
+                     "action": "store_true"},
+        "--drift": {"help": "Report drift between the org and the config file without making changes",
+                    "action": "store_true"},
+        "--info": {"help": "Write an inventory of the organization and the services in the config file",
+                   "action": "store_true"},
+        "--info-format": {"help": "Format of the --info inventory",
+                          "choices": INFO_FORMATS,
+                          "default": "jsonl"},
+        "--info-output": {"help": "File the --info inventory is written to (DEFAULT=standard output)"},
+        "--export-findings": {"help": "Export the Security Hub findings of the delegated admin account",
+                              "action": "store_true"},
+        "--export-output": {"help": "Filename prefix for the gzip JSON Lines findings part files",
+                            "default": findings.DEFAULT_OUTPUT_PREFIX},
+        "--export-days": {"help": "Days of finding updates exported",
+                          "type": int,
+                          "default": findings.DEFAULT_EXPORT_DAYS},
+        "--export-shard-by": {"help": "Comma separated dimensions the export is split by "
+                                      f"({', '.join(findings.SHARD_DIMENSIONS)})",
+                              "default": "account"},
+        "--export-window-hours": {"help": "Hours of the time window shards",
+                                  "type": int,
+                                  "default": findings.DEFAULT_WINDOW_HOURS},
+        "--export-severity": {"help": "Comma separated severity labels exported (DEFAULT=all of them)"},
+        "--export-parts": {"help": "Number of findings part files",
+                           "type": int,
+                           "default": findings.DEFAULT_PART_FILES},
+        "--correlate": {"help": "Index the Security Hub findings and answer the --resource and --top-accounts queries",
+                        "action": "store_true"},
+        "--correlate-input": {"help": "Glob pattern of the findings part files indexed by --correlate "
+                                      "(DEFAULT=findings pulled with the --export-* options)"},
+        "--dedup-by": {"help": "Finding field duplicates on the same resource are merged by",
+                       "choices": correlation.DEDUP_KEYS,
+                       "default": "generator"},
+        "--resource": {"help": "Resource ARN whose findings --correlate lists, may be repeated",
+                       "action": "append"},
+        "--top-accounts": {"help": "Number of accounts --correlate lists by findings of --top-severity",
+                           "type": int,
+                           "default": 10},
+        "--top-severity": {"help": "Severity label of the --top-accounts findings",
+                           "choices": findings.SEVERITY_LABELS,
+                           "default": "CRITICAL"},
+        "--report": {"help": "Filename prefix for the drift JSON and CSV reports",
+                     "default": "drift_report"},
+        "--budget": {"help": "Seconds allowed for the drift scan",
+                     "type": int},
+        "--shards": {"help": "Run --create with member accounts split into shards processed by local workers",
+                     "action": "store_true"},
+        "--shard-size": {"help": "Number of accounts per shard",
+                         "type": int,
+                         "default": sharding.DEFAULT_SHARD_SIZE},
+        "--shard-workers": {"help": "Number of local shard worker threads",
+                            "type": int,
+                            "default": common.DEFAULT_MAX_WORKERS},
         "--target": {"help": "AWS account ID of organization master"},
         "--role": {"help": "AWS IAM role to assume in organization master"},
         "--exid": {"help": "External ID for organization master role"},
         "--create": {"help": "Enable or update IR services.",
                      "action": "store_true"},
+        "--retry-failed": {"help": "Run ledger of a previous create whose failed units are retried"},
+        "--ledger": {"help": "File the run ledger of --create or --retry-failed is written to",
+                     "default": ledger.DEFAULT_LEDGER_FILE},
         "--destroy": {"help": "Remove the services defined in the config file",
                       "action": "store_true"},
+        "--force": {"help": "Run --create even when the services are converged with the config file",
+                    "action": "store_true"},
+        "--deadline": {"help": "Seconds allowed for the run, partial results are reported when it is reached",
+                       "type": int},
+        "--profile": {"help": "Profile the run and write the profile files",
+                      "choices": profiling.PROFILE_MODES},
+        "--profile-output": {"help": "Filename prefix for the profile files",
+                             "default": profiling.DEFAULT_OUTPUT_PREFIX},
+        "--record": {"help": "Cassette file every AWS API call of the run is recorded to"},
+        "--replay": {"help": "Cassette file the AWS API responses are replayed from instead of calling AWS"},
+        "--replay-speed": {"help": "Replay speed relative to the recorded latencies, 0 replays without delays",
+                           "type": float,
+                           "default": 0},
+        "--endpoint-url": {"help": "Endpoint every AWS API call is sent to, e.g. a fake_aws.py server"},
+        "--circuit-threshold": {"help": "Consecutive failed calls to a service region before its calls fail fast",
+                                "type": int},
+        "--log-format": {"help": "Format of the log output",
+                         "choices": common.LOG_FORMATS},
+        "--log-detail": {"help": "Log every account event, a sample of them or only per region summaries",
+                         "choices": common.ACCOUNT_LOG_DETAILS},
         "--debug": {"help": "Set logging level to debug",
                     "action": "store_true"}
     }
@@ -213,18 +1272,132 @@ if __name__ == "__main__":
     else:
         LOG_LEVEL=logging.INFO
 
-    common.setup_logging(log_level=LOG_LEVEL)
+    common.setup_logging(log_level=LOG_LEVEL, log_format=args.log_format,
+                         account_detail=args.log_detail)
+    if args.endpoint_url:
+        common.set_endpoint_url(args.endpoint_url)
+    if args.circuit_threshold:
+        common.configure_circuit_breaker(args.circuit_threshold)
+    if args.deadline:
+        common.set_deadline(common.Deadline(args.deadline))
+    if args.record and args.replay:
+        raise SystemExit("Must request only one of --record or --replay")
+    if args.record:
+        common.set_cassette(common.Cassette(args.record, "record"))
+    elif args.replay:
+        common.set_cassette(common.Cassette(args.replay, "replay", speed=args.replay_speed))
 
     config_content = common.load_json(args.config)
     ir_object = IRManager(target_account=args.target,
                           assume_role_name=args.role,
                           external_id=args.exid)
 
-    if True not in [args.create, args.destroy]:
+    run_ledger = None
+    if args.retry_failed:
+        run_ledger = ledger.RunLedger.load(args.retry_failed)
+    elif args.create:
+        run_ledger = ledger.RunLedger(run_id=str(uuid4()))
+    ledger.set_ledger(run_ledger)
+
+    if True not in [args.create, args.destroy, args.drift, args.info, args.export_findings, args.correlate,
+                    bool(args.event), bool(args.retry_failed)]:
         logging.error("No action requested. Must request to create or destroy")
 
-    if args.create:
-        ir_object.ir_create(config_content)
+    profiling.start_profile(args.profile, output_prefix=args.profile_output)
+    try:
+        if args.drift:
+            drift_report = ir_object.ir_drift(config_content, time_budget=args.budget)
+            for report_extension, report_function in [("json", drift_report_json),
+                                                      ("csv", drift_report_csv)]:
+                with open(f"{args.report}.{report_extension}", "w", encoding="utf-8") as report_file:
+                    report_file.write(report_function(drift_report))
+            logging.info("Drift scan found %d drifted items in %ss (complete: %s)",
+                         drift_report["drift_count"], drift_report["duration"], drift_report["complete"])
+
+        elif args.info:
+            with open(args.info_output or sys.stdout.fileno(), "w", encoding="utf-8", newline="",
+                      closefd=bool(args.info_output)) as info_file:
+                info_summary = ir_object.list_info(config_content, info_file, output_format=args.info_format)
+            logging.info("Inventory of %d rows written in %ss", info_summary["rows"], info_summary["duration"])
+
+        elif args.export_findings:
+            export_summary = ir_object.export_findings(
+                config_content, output_prefix=args.export_output, days=args.export_days,
+                shard_by=[item.strip() for item in args.export_shard_by.split(",") if item.strip()],
+                window_hours=args.export_window_hours,
+                severity_list=[item.strip() for item in (args.export_severity or "").split(",") if item.strip()],
+                part_count=args.export_parts)
+            print(json.dumps(export_summary, indent=2))
+
+        elif args.correlate:
+            filename_list = sorted(glob.glob(args.correlate_input)) if args.correlate_input else None
+            if args.correlate_input and not filename_list:
+                raise SystemExit(f"No findings part files match {args.correlate_input}")
+
+            index_start = time.monotonic()
+            finding_index = ir_object.correlate_findings(
+                config_content, filename_list=filename_list, dedup_by=args.dedup_by, days=args.export_days,
+                shard_by=[item.strip() for item in args.export_shard_by.split(",") if item.strip()],
+                window_hours=args.export_window_hours,
+                severity_list=[item.strip() for item in (args.export_severity or "").split(",") if item.strip()])
+            correlate_summary = dict(finding_index.stats(), index_seconds=round(time.monotonic() - index_start, 3))
+
+            query_start = time.monotonic()
+            correlate_summary["top_accounts"] = finding_index.top_accounts(count=args.top_accounts,
+                                                                           severity=args.top_severity)
+            correlate_summary["resource_findings"] = {resource_id: finding_index.resource_findings(resource_id)
+                                                      for resource_id in args.resource or []}
+            correlate_summary["query_ms"] = round((time.monotonic() - query_start) * 1000, 3)
+            print(json.dumps(correlate_summary, indent=2))
+
+        elif args.event:
+            event_action, event_account = parse_org_event(common.load_json(args.event))
+            if not event_action:
+                logging.info("Event %s does not require any action", args.event)
+
+            elif args.dryrun:
+                for work_service, work_region in ir_object.plan_account_event(
+                        event_action, event_account, config_content):
+                    print(f"{event_action} {event_account} {work_service} {work_region}")
+
+            else:
+                print(json.dumps(ir_object.ir_account_event(event_action, event_account, config_content),
+                                 indent=2))
+
+        elif args.retry_failed:
+            ir_object.ir_retry_failed(config_content, run_ledger)
+
+        elif args.create and args.shards:
+            shard_summary = ir_object.ir_sharded_create(config_content, sharding.LocalQueue(),
+                                                        sharding.LocalQueue(),
+                                                        shard_size=args.shard_size,
+                                                        local_workers=args.shard_workers,
+                                                        force=args.force)
+            del shard_summary["results"]
+            print(json.dumps(shard_summary, indent=2))
+
+        elif args.create:
+            ir_object.ir_create(config_content, force=args.force)
+
+        elif args.destroy:
+            ir_object.ir_destroy(config_content)
+
+    except (common.DeadlineExceeded, ledger.UnitsFailed) as err:
+        logging.error("%s", err)
+        for result_service, result_status in ir_object.results.items():
+            logging.error("Service %s: %s", result_service, result_status)
+        raise SystemExit(1) from None
+
+    finally:
+        profiling.stop_profile()
+        common.log_concurrency_metrics()
+        if run_ledger:
+            run_ledger.log_failed()
+            run_ledger.save(args.ledger)
+            logging.info("Run ledger written to %s: %s", args.ledger,
+                         run_ledger.response_data()["ledger"])
+        if common.get_cassette():
+            common.get_cassette().close()
 
-    elif args.destroy:
-        ir_object.ir_destroy(config_content)
+    if common.get_open_circuits():
+        logging.error("Open circuits: %s", ", ".join(common.get_open_circuits()))
@@ -0,0 +1,306 @@
+"""
+Module containing the run ledger of IR creates.  Every work unit of a run,
+the workflow of each service and each (service, region, account batch) of
+the member account work, records its outcome in the ledger.  The ledger is
+returned in the Cloudformation response data and written to disk from the
+command line, and a later run can retry only the units that failed.
+
+Unit statuses:
+SUCCEEDED - The unit completed
+PARTIAL - The service workflow completed except for failed account batches
+FAILED - The unit failed, failed account batches keep their accounts
+"""
+import contextlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import common
+
+
+UNIT_STATUSES = ["SUCCEEDED", "PARTIAL", "FAILED"]
+DEFAULT_LEDGER_FILE = "run_ledger.json"
+# Characters of failed unit ids returned in the Cloudformation response data,
+# which is limited to 4096 bytes
+DATA_FAILED_UNITS_LIMIT = 1024
+
+_LEDGER_SETTINGS = {
+    "ledger": None
+}
+
+
+class UnitsFailed(ValueError):
+    """
+    Raised when account batches failed while the rest of the work completed.
+    The failed batches are recorded in the run ledger.
+    """
+
+
+class RunLedger:
+    """
+    Outcomes of the work units of a run, keyed by unit id.  The workflow
+    unit of a service has the id "<service>", account batch units have the
+    id "<service>:<region>:<batch>".  Only failed units keep their account
+    ids so the ledger of a large organization stays small.
+    """
+    def __init__(self, run_id=None, units=None):
+        self.run_id = run_id
+        self.units = units or {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def unit_id(service, region=None, batch=None):
+        """
+        Returns the unit id of a service workflow or account batch.
+        """
+        return ":".join(str(part) for part in [service, region, batch] if part is not None)
+
+    def record(self, service, region=None, batch=None, status="SUCCEEDED", accounts=None,
+               error=None, duration=None):
+        """
+        Records the outcome of a work unit, replacing any earlier outcome of
+        the same unit.
+        Args:
+        service - IR service name or AWS service name of the unit
+        Kargs:
+        region - AWS region of an account batch
+        batch - Identifier of an account batch within the region
+        status - One of UNIT_STATUSES
+        accounts - list of aws account ids of an account batch
+        error - Error string of a failed unit
+        duration - Seconds taken by the unit
+
+        Returns None
+        """
+        if status not in UNIT_STATUSES:
+            raise ValueError(f"Unsupported unit status {status}")
+
+        accounts = list(accounts or [])
+        unit = {
+            "service": service,
+            "region": region,
+            "batch": batch,
+            "status": status,
+            "count": len(accounts),
+            "accounts": accounts if status == "FAILED" else [],
+            "error": error,
+            "duration": duration
+        }
+        with self.__lock:
+            self.units[self.unit_id(service, region, batch)] = unit
+
+    @contextlib.contextmanager
+    def track(self, service):
+        """
+        Context manager that records the workflow unit of a service.  The
+        unit is PARTIAL when UnitsFailed is raised and FAILED for any other
+        exception, which is raised again.
+        Args:
+        service - IR service name
+        """
+        start_time = time.monotonic()
+        try:
+            yield
+
+        except UnitsFailed as err:
+            self.record(service, status="PARTIAL", error=str(err),
+                        duration=round(time.monotonic() - start_time, 3))
+            raise
+
+        except Exception as err:
+            self.record(service, status="FAILED", error=str(err) or type(err).__name__,
+                        duration=round(time.monotonic() - start_time, 3))
+            raise
+
+        self.record(service, duration=round(time.monotonic() - start_time, 3))
+
+    def discard(self, service, region=None):
+        """
+        Removes the units of a service, or of a single region of the service.
+        Args:
+        service - IR or AWS service name
+        Kargs:
+        region - AWS region
+
+        Returns None
+        """
+        with self.__lock:
+            for unit_id in [unit_id for unit_id, unit in self.units.items()
+                            if unit["service"] == service and region in [None, unit["region"]]]:
+                del self.units[unit_id]
+
+    def failed(self, service=None, batches=False):
+        """
+        Returns the unit ids that did not succeed, optionally only for one
+        service or only the account batch units.
+        """
+        with self.__lock:
+            return sorted(unit_id for unit_id, unit in self.units.items()
+                          if unit["status"] != "SUCCEEDED" and service in [None, unit["service"]]
+                          and (unit["region"] or not batches))
+
+    def plan_retry(self, service_dict):
+        """
+        Builds the work needed to retry the failed units of the services.  A
+        service is run again completely when its workflow unit is missing
+        (the service was not reached) or FAILED.  For a PARTIAL service only
+        the accounts of its failed batches are retried, grouped per region.
+        Args:
+        service_dict - dictionary of IR service name to AWS service name
+
+        Returns tuple of (list of services to run again, dictionary of IR
+            service name to dictionary of region to list of aws account ids)
+        """
+        rerun_list = []
+        retry_dict = {}
+        for service, aws_service in service_dict.items():
+            workflow = self.units.get(service)
+            if not workflow or workflow["status"] == "FAILED":
+                rerun_list.append(service)
+                continue
+
+            for unit in self.units.values():
+                if unit["service"] == aws_service and unit["region"] and unit["status"] == "FAILED":
+                    region_accounts = retry_dict.setdefault(service, {}).setdefault(unit["region"], [])
+                    region_accounts.extend(account for account in unit["accounts"]
+                                           if account not in region_accounts)
+
+        return rerun_list, retry_dict
+
+    def summary(self):
+        """
+        Returns a dictionary with the number of units, failed units and the
+        failed unit ids.
+        """
+        failed_list = self.failed()
+        return {"run_id": self.run_id, "units": len(self.units), "failed": len(failed_list),
+                "failed_units": failed_list}
+
+    def response_data(self):
+        """
+        Returns the ledger summary as Cloudformation response data, with the
+        failed unit ids truncated to DATA_FAILED_UNITS_LIMIT characters.
+        """
+        summary = self.summary()
+        failed_units = ",".join(summary["failed_units"])
+        if len(failed_units) > DATA_FAILED_UNITS_LIMIT:
+            failed_units = failed_units[:DATA_FAILED_UNITS_LIMIT].rsplit(",", 1)[0] + ",..."
+
+        return_dict = {"ledger": f"{summary['units']} units, {summary['failed']} failed"}
+        if failed_units:
+            return_dict["failed_units"] = failed_units
+        return return_dict
+
+    def log_failed(self):
+        """
+        Logs every unit that did not succeed.
+
+        Returns None
+        """
+        for unit_id in self.failed():
+            unit = self.units[unit_id]
+            logging.error("Unit %s %s: %s", unit_id, unit["status"], unit["error"],
+                          extra=dict(unit, unit=unit_id))
+
+    def to_dict(self):
+        """
+        Returns the ledger as a json serializable dictionary.
+        """
+        with self.__lock:
+            return {"run_id": self.run_id,
+                    "generated": datetime.now(timezone.utc).isoformat(),
+                    "units": dict(self.units)}
+
+    def save(self, filename):
+        """
+        Writes the ledger to a json file.
+        Args:
+        filename - Filename of the ledger
+
+        Returns None
+        """
+        with open(filename, "w", encoding="utf-8") as ledger_file:
+            json.dump(self.to_dict(), ledger_file, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns the RunLedger stored in a json file by save.
+        Args:
+        filename - Filename of the ledger
+        """
+        ledger_dict = common.load_json(filename)
+        return cls(run_id=ledger_dict.get("run_id"), units=ledger_dict["units"])
+
+
+def set_ledger(run_ledger):
+    """
+    Sets the ledger the work units of the run are recorded in, None stops
+    recording.
+    Args:
+    run_ledger - RunLedger or None
+
+    Returns None
+    """
+    _LEDGER_SETTINGS["ledger"] = run_ledger
+
+
+def get_ledger():
+    """
+    Returns the RunLedger of the run or None if the run is not recorded.
+    """
+    return _LEDGER_SETTINGS["ledger"]
+
+
+@contextlib.contextmanager
+def track(service):
+    """
+    Records the workflow unit of a service in the ledger of the run, see
+    RunLedger.track.  Does nothing when the run is not recorded.
+    Args:
+    service - IR service name
+    """
+    run_ledger = get_ledger()
+    if not run_ledger:
+        yield
+        return
+
+    with run_ledger.track(service):
+        yield
+
+
+def record_batches(service, region, batch_list):
+    """
+    Records the outcome of the account batches of a service region in the
+    ledger of the run.  A batch is identified by its first account id so the
+    batches of different shards do not collide.  When batches failed, a
+    deadline or region failure (see common.is_region_failure) is raised as
+    is so the region is handled like any other failing region, otherwise
+    UnitsFailed is raised.
+    Args:
+    service - AWS service name
+    region - AWS region
+    batch_list - list of (list of aws account ids, exception or None) tuples
+
+    Returns None
+    """
+    run_ledger = get_ledger()
+    error_list = []
+    for account_list, err in batch_list:
+        if not account_list:
+            continue
+        if err:
+            error_list.append(err)
+        if run_ledger:
+            run_ledger.record(service, region, account_list[0], status="FAILED" if err else "SUCCEEDED",
+                              accounts=account_list, error=str(err) if err else None)
+
+    for err in error_list:
+        if isinstance(err, common.DeadlineExceeded) or common.is_region_failure(err):
+            raise err
+
+    if error_list:
+        raise UnitsFailed(f"{len(error_list)} of {len(batch_list)} {service} member batches failed in "
+                          f"{region}: {error_list[0]}")
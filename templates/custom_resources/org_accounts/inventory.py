@@ -0,0 +1,214 @@
+"""
+Module containing the OrgInventory class, a compact in memory view of the
+organization accounts and their membership in each service and region.
+"""
+import threading
+
+
+class AccountRecord:
+    """
+    Metadata of a single organization account.
+    """
+    __slots__ = ("index", "account_id", "email", "name", "status")
+
+    def __init__(self, index, account_id, email=None, name=None, status=None):
+        self.index = index
+        self.account_id = account_id
+        self.email = email
+        self.name = name
+        self.status = status
+
+    def __repr__(self):
+        return f"AccountRecord({self.index}, {self.account_id!r})"
+
+
+class OrgInventory:
+    """
+    Organization accounts and their membership per (service, region).  Each
+    account ID is interned to an integer index and the members of a
+    (service, region) are kept as an integer bitset, so finding the accounts
+    missing from a service is a single bitwise operation and memory grows by
+    one bit per account for every (service, region).
+    """
+    def __init__(self):
+        self.__index_dict = {}
+        self.__record_list = []
+        self.__member_dict = {}
+        self.__all_mask = 0
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def from_org_accounts(cls, org_accounts):
+        """
+        Creates an inventory from the dictionary returned by
+        OrgManager.get_org_accounts.
+        Args:
+        org_accounts - dictionary of account id to list_accounts account dictionary
+
+        Returns OrgInventory
+        """
+        inventory = cls()
+        for account_id, account in org_accounts.items():
+            inventory.add_account(account_id, email=account.get("Email"),
+                                  name=account.get("Name"), status=account.get("Status"))
+
+        return inventory
+
+    def __len__(self):
+        return len(self.__record_list)
+
+    def __contains__(self, account_id):
+        return account_id in self.__index_dict
+
+    def __iter__(self):
+        return iter(record.account_id for record in self.__record_list)
+
+    def add_account(self, account_id, email=None, name=None, status=None):
+        """
+        Adds an account to the inventory, or updates the metadata of an account
+        already in the inventory.
+        Args:
+        account_id - AWS account id
+        Kargs:
+        email - Email address of the account
+        name - Name of the account
+        status - Organizations status of the account
+
+        Returns the index of the account
+        """
+        with self.__lock:
+            if account_id in self.__index_dict:
+                record = self.__record_list[self.__index_dict[account_id]]
+                record.email = email or record.email
+                record.name = name or record.name
+                record.status = status or record.status
+                return record.index
+
+            index = len(self.__record_list)
+            self.__index_dict[account_id] = index
+            self.__record_list.append(AccountRecord(index, account_id, email=email,
+                                                    name=name, status=status))
+            self.__all_mask |= 1 << index
+            return index
+
+    def account(self, account_id):
+        """
+        Returns the AccountRecord of the account or None if it is not in the
+        inventory.
+        Args:
+        account_id - AWS account id
+        """
+        index = self.__index_dict.get(account_id)
+        return None if index is None else self.__record_list[index]
+
+    def set_members(self, service, region, account_list):
+        """
+        Replaces the members of the service in the region.  Accounts that are
+        not in the inventory are ignored.
+        Args:
+        service - AWS service name
+        region - AWS region string
+        account_list - Iterable of member account ids
+
+        Returns None
+        """
+        member_mask = self._mask(account_list)
+        with self.__lock:
+            self.__member_dict[(service, region)] = member_mask
+
+    def add_members(self, service, region, account_list):
+        """
+        Marks the accounts as members of the service in the region.
+        Args:
+        service - AWS service name
+        region - AWS region string
+        account_list - Iterable of member account ids
+
+        Returns None
+        """
+        member_mask = self._mask(account_list)
+        with self.__lock:
+            self.__member_dict[(service, region)] = self.__member_dict.get((service, region), 0) | member_mask
+
+    def remove_members(self, service, region, account_list):
+        """
+        Marks the accounts as no longer members of the service in the region.
+        Args:
+        service - AWS service name
+        region - AWS region string
+        account_list - Iterable of account ids
+
+        Returns None
+        """
+        member_mask = self._mask(account_list)
+        with self.__lock:
+            self.__member_dict[(service, region)] = self.__member_dict.get((service, region), 0) & ~member_mask
+
+    def is_member(self, service, region, account_id):
+        """
+        Returns True if the account is a member of the service in the region.
+        Args:
+        service - AWS service name
+        region - AWS region string
+        account_id - AWS account id
+        """
+        index = self.__index_dict.get(account_id)
+        if index is None:
+            return False
+        return bool(self.__member_dict.get((service, region), 0) >> index & 1)
+
+    def members(self, service, region):
+        """
+        Returns the list of accounts that are members of the service in the region.
+        Args:
+        service - AWS service name
+        region - AWS region string
+        """
+        return self._accounts(self.__member_dict.get((service, region), 0))
+
+    def missing(self, service, region, exclude=None):
+        """
+        Returns the list of inventory accounts that are not members of the
+        service in the region.
+        Args:
+        service - AWS service name
+        region - AWS region string
+        Kargs:
+        exclude - Iterable of account ids to leave out, e.g. the delegated admin
+
+        Returns list of account ids in inventory order
+        """
+        missing_mask = self.__all_mask & ~self.__member_dict.get((service, region), 0)
+        if exclude:
+            missing_mask &= ~self._mask(exclude)
+
+        return self._accounts(missing_mask)
+
+    def member_count(self, service, region):
+        """
+        Returns the number of members of the service in the region.
+        Args:
+        service - AWS service name
+        region - AWS region string
+        """
+        return bin(self.__member_dict.get((service, region), 0)).count("1")
+
+    def _mask(self, account_list):
+        """
+        Returns the bitset of the inventory accounts in account_list.
+        """
+        # Built as a string of bits so large lists cost O(accounts)
+        bit_list = bytearray(b"0" * len(self.__record_list))
+        for account_id in account_list:
+            index = self.__index_dict.get(account_id)
+            if index is not None:
+                bit_list[index] = ord("1")
+
+        return int(bit_list[::-1] or b"0", 2)
+
+    def _accounts(self, mask):
+        """
+        Returns the account ids of the bits set in mask.
+        """
+        return [self.__record_list[index].account_id
+                for index, bit in enumerate(bin(mask)[:1:-1]) if bit == "1"]
@@ -2,22 +2,43 @@
 Module containing the base class for IR services. Base class contains common
 functionality used by all services.
 """
+import abc
+import contextlib
+import json
 import logging
+import threading
 
 import botocore.exceptions
 import common
+import ledger
+from org_accounts import targeting
+from org_accounts.inventory import OrgInventory
+
+
+_DA_CLIENT_LOCK = threading.Lock()
+_TARGET_INDEX_LOCK = threading.Lock()
 
 
 def s_client_manager(function):
     def wrapper(self, *args, **kwargs):
         if not self.da_client_manager:
-            self.da_client_manager = self.get_delegated_client_manager(self.SERVICE_PRINCIPAL)
+            # Methods may be called from several threads at once, only the
+            # first should assume the delegated admin role
+            with _DA_CLIENT_LOCK:
+                if not self.da_client_manager:
+                    self.da_client_manager = self.get_delegated_client_manager(self.SERVICE_PRINCIPAL)
 
         return function(self, *args, **kwargs)
     return wrapper
 
 
-class OrgManager:
+DRIFT_COLUMNS = ["service", "region", "account", "check", "expected", "actual"]
+INFO_COLUMNS = ["record", "service", "region", "account", "name", "status", "detail"]
+# Status of organization accounts that are not members of a service region
+NOT_MEMBER_STATUS = "NOT_MEMBER"
+
+
+class OrgManager(abc.ABC):
     """
     Base class to use with IR service classes. Contains base functionality for
     managing AWS services through AWS organizations.
@@ -30,6 +51,14 @@ class OrgManager:
     ORG_ACCESS_ROLE_NAME = "OrganizationAccountAccessRole"
     AWS_SERVICE = None
     SERVICE_PRINCIPAL = None
+    # Key holding the account id in the service list_members response
+    MEMBER_ID_KEY = "AccountId"
+    # Key holding the relationship status in the service list_members response
+    MEMBER_STATUS_KEY = "MemberStatus"
+    # Largest page size accepted by the service list_members
+    MEMBER_PAGE_SIZE = 50
+    # Services whose create workflow disables the admin in unlisted regions
+    DISABLE_UNLISTED_REGIONS = False
 
     def __init__(self, target_account=None, assume_role_name=None,
                  external_id=None, region=None):
@@ -43,6 +72,12 @@ class OrgManager:
         self.access_key = None
         self.secret_key = None
         self.token = None
+        # Regions skipped by region_guard mapped to the error
+        self.skipped_regions = {}
+        # Regions with failed account batches mapped to the error
+        self.partial_regions = {}
+        # (config key, TargetIndex) of the last config, see get_target_index
+        self.target_index = None
 
         self.sts_client = common.get_client("sts", region=self.region)
         if self.target_account:
@@ -207,12 +242,225 @@ class OrgManager:
         Returns a dictionary containing information about the organizations
         member accounts.
         """
-        response = self.org_client.list_accounts()
-        return_dict = {}
-        for account in response["Accounts"]:
-            return_dict[account["Id"]] = account
+        return {account["Id"]: account
+                for account in common.paginate(self.org_client, "list_accounts", "Accounts", page_size=20)}
+
+    @s_client_manager
+    def warm_up_clients(self, input_dict):
+        """
+        Creates the service clients used by the create workflow concurrently,
+        for the management account in every region it configures and for the
+        delegated admin account in the enabled regions.  Called once the
+        delegated admin is registered so the region loops do not create
+        clients one at a time.
+        Args:
+        input_dict - IR dictionary
+
+        Returns None
+        """
+        enable_regions = [region.strip() for region in input_dict["enable_regions"]]
+        management_regions = self.enabled_regions if self.DISABLE_UNLISTED_REGIONS else enable_regions
+
+        self.client_manager.warm_up([self.AWS_SERVICE], management_regions)
+        self.da_client_manager.warm_up([self.AWS_SERVICE], enable_regions)
+
+    @contextlib.contextmanager
+    def region_guard(self, region):
+        """
+        Context manager for the work done in a single region of the create
+        workflow.  When the region is failing or unreachable (see
+        common.is_region_failure) the error is recorded in skipped_regions
+        and the remaining regions still run; other errors are raised.
+        Account batches that failed (ledger.UnitsFailed) are recorded in
+        partial_regions and the remaining regions also still run.  A region
+        is not started once the run deadline is reached.
+        Args:
+        region - AWS region string
+        """
+        common.check_deadline(f"{self.AWS_SERVICE} {region.strip()}")
+        try:
+            yield
+
+        except ledger.UnitsFailed as err:
+            logging.error("Member accounts failed in region %s for %s: %s", region.strip(), self.AWS_SERVICE, err)
+            self.partial_regions.setdefault(region.strip(), str(err))
+
+        except Exception as err:
+            if not common.is_region_failure(err):
+                raise err from None
+            logging.error("Skipping region %s for %s: %s", region.strip(), self.AWS_SERVICE, err)
+            self.skipped_regions.setdefault(region.strip(), str(err))
 
-        return return_dict
+    def fan_out_regions(self, function, region_list):
+        """
+        Runs function for every region concurrently, each region under
+        region_guard.  A region makes a single call chain, so the regions
+        are run through common.thread_map and the calls within a region are
+        left to the adaptive concurrency of the fan outs they start.
+        Args:
+        function - Callable that accepts a stripped region string
+        region_list - list of AWS region strings
+
+        Returns None
+        """
+        def run_region(region):
+            with self.region_guard(region):
+                function(region.strip())
+
+        common.thread_map(run_region, region_list)
+
+    def raise_for_skipped_regions(self):
+        """
+        Raises a ValueError listing the regions skipped by region_guard, if
+        any, otherwise ledger.UnitsFailed listing the regions with failed
+        account batches, if any.
+
+        Returns None
+        """
+        if self.skipped_regions:
+            raise ValueError(f"{self.AWS_SERVICE} skipped failing regions " +
+                             ", ".join(f"{region}: {err}" for region, err in sorted(self.skipped_regions.items())))
+
+        if self.partial_regions:
+            raise ledger.UnitsFailed(f"{self.AWS_SERVICE} member accounts failed in regions " +
+                                     ", ".join(sorted(self.partial_regions)))
+
+    def get_inventory(self):
+        """
+        Returns an OrgInventory of the organizations member accounts, used to
+        track the membership of each service and region.
+        """
+        return OrgInventory.from_org_accounts(self.get_org_accounts())
+
+    def get_target_index(self, input_dict, account_id=None):
+        """
+        Returns the TargetIndex compiled from the targeting parameters of the
+        IR dictionary (see org_accounts.targeting), or None when there are none
+        and every account is enrolled in every enabled region.  The
+        organizational unit tree is shared by the services of the run and the
+        index is compiled once per config.
+        Args:
+        input_dict - IR dictionary
+        Kargs:
+        account_id - Account that must be in the tree, located if it joined
+                     after the tree was walked
+
+        Returns targeting.TargetIndex or None
+        """
+        if not targeting.has_targeting(input_dict):
+            return None
+
+        org_tree = targeting.get_org_tree((self.target_account, self.assume_role_name), self.org_client)
+        if account_id and account_id not in org_tree.parents:
+            org_tree.locate(self.org_client, account_id)
+
+        # Ids created after the tree was walked are located, unknown ids are
+        # left for TargetIndex.compile to reject
+        for node_id in targeting.target_ids(input_dict):
+            if node_id not in org_tree.parents and node_id not in org_tree.names:
+                try:
+                    org_tree.locate(self.org_client, node_id)
+                except botocore.exceptions.ClientError as err:
+                    logging.error("Targeting id %s was not found in the organization: %s", node_id, err)
+
+        index_key = (id(org_tree), len(org_tree.parents),
+                     json.dumps({key: input_dict.get(key) for key in targeting.TARGETING_KEYS + ["enable_regions"]},
+                                sort_keys=True))
+        with _TARGET_INDEX_LOCK:
+            if not self.target_index or self.target_index[0] != index_key:
+                self.target_index = (index_key, targeting.TargetIndex.compile(input_dict, org_tree))
+            return self.target_index[1]
+
+    def org_auto_enable(self, input_dict):
+        """
+        Returns True if the organization configuration of the service should
+        auto enable new member accounts.  Auto enable ignores the targeting
+        parameters, so it is turned off when the IR dictionary has any and new
+        accounts are enrolled by the targeted create and the account event
+        handler instead.
+        Args:
+        input_dict - IR dictionary
+
+        Returns bool
+        """
+        return not targeting.has_targeting(input_dict)
+
+    def missing_targets(self, org_accounts, input_dict, region):
+        """
+        Returns the accounts of org_accounts that are not members of the
+        service in the region but are targeted in it by the IR dictionary.
+        Args:
+        org_accounts - OrgInventory with the service members of the region set
+        input_dict - IR dictionary
+        region - AWS region
+
+        Returns list of aws account ids
+        """
+        account_list = org_accounts.missing(self.AWS_SERVICE, region, exclude=[input_dict["admin_account_id"]])
+        target_index = self.get_target_index(input_dict)
+        if not target_index:
+            return account_list
+
+        return [account for account in account_list if target_index.is_target(account, region.strip())]
+
+    def untargeted_members(self, org_accounts, input_dict, region):
+        """
+        Returns the accounts of org_accounts that are members of the service
+        in the region but are not targeted in it by the IR dictionary, e.g.
+        accounts of an organizational unit excluded after they were enrolled.
+        Args:
+        org_accounts - OrgInventory with the service members of the region set
+        input_dict - IR dictionary
+        region - AWS region
+
+        Returns list of aws account ids, empty when the IR dictionary has no
+            targeting parameters
+        """
+        target_index = self.get_target_index(input_dict)
+        if not target_index:
+            return []
+
+        return [account for account in org_accounts.members(self.AWS_SERVICE, region)
+                if account != input_dict["admin_account_id"] and not target_index.is_target(account, region.strip())]
+
+    def remove_untargeted(self, org_accounts, input_dict, region):
+        """
+        Removes the members of the service in the region that the IR
+        dictionary no longer targets, see untargeted_members.
+        Args:
+        org_accounts - OrgInventory with the service members of the region set
+        input_dict - IR dictionary
+        region - AWS region
+
+        Returns list of the aws account ids removed
+        """
+        account_list = self.untargeted_members(org_accounts, input_dict, region)
+        if account_list:
+            for account in account_list:
+                common.log_account_event(self.AWS_SERVICE, region, "removed", account)
+            self.remove_member_accounts(account_list, region)
+            org_accounts.remove_members(self.AWS_SERVICE, region, account_list)
+
+        return account_list
+
+    def get_org_account(self, account_id):
+        """
+        Returns information about a single organization member account.
+        Args:
+        account_id - AWS account id
+
+        Returns dictionary of account information or None if the account is
+        not a member of the organization.
+        """
+        try:
+            return self.org_client.describe_account(AccountId=account_id)["Account"]
+
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] == "AccountNotFoundException":
+                logging.warning("Account %s is not a member of the organization", account_id)
+                return None
+
+            raise err from None
 
     def get_enabled_regions(self):
         """
@@ -270,11 +518,276 @@ class OrgManager:
             ServicePrincipal=service_principal
         )
 
-    def echo_info(self):
-        # List delegated admin accounts
-        # List enabled service access
-        # List management account info
-        # List member account info
+    def echo_org_info(self, emit):
+        """
+        Emits the organization wide inventory rows: the management account,
+        the service principals with organization access enabled and every
+        delegated admin registration.
+        Args:
+        emit - Callable that accepts a row tuple matching INFO_COLUMNS
+
+        Returns None
+        """
+        organization = self.org_client.describe_organization()["Organization"]
+        management = self.get_org_account(organization["MasterAccountId"]) or {}
+        emit(("management", "organizations", "global", organization["MasterAccountId"],
+              management.get("Name", ""), management.get("Status", ""), organization["Id"]))
+
+        for service_principal in self.list_service_access():
+            emit(("service_access", service_principal, "global", "", "", "ENABLED", ""))
+
+        # An account is listed once however many services it is the admin for
+        for admin in {admin["Id"]: admin for admin in self.get_delegated_admins()}.values():
+            for service_principal in self.list_services_for_account(admin["Id"]):
+                emit(("delegated_admin", service_principal, "global", admin["Id"],
+                      admin.get("Name", ""), admin.get("Status", ""), admin.get("Email", "")))
+
+    def echo_info(self, emit, org_accounts, region_list=None):
+        """
+        Emits the inventory rows of the service: the admin status of the
+        delegated admin in each region and the relationship status of every
+        organization account in the regions where the admin is enabled.
+        Accounts that are not members have the status NOT_MEMBER_STATUS.  The
+        regions are listed concurrently and each member is emitted as its page
+        arrives, so only the org_accounts bitsets grow with the organization.
+        Args:
+        emit - Callable that accepts a row tuple matching INFO_COLUMNS, called
+               from several threads
+        org_accounts - OrgInventory of the organization accounts
+        Kargs:
+        region_list - Regions to list (DEFAULT=the enabled regions of the organization)
+
+        Returns None
+        """
+        admin_list = self.get_delegated_admins(self.SERVICE_PRINCIPAL)
+        if not admin_list:
+            emit(("org_admin", self.AWS_SERVICE, "global", "", "", "NONE", self.SERVICE_PRINCIPAL))
+            return
+        admin_account = admin_list[0]["Id"]
+
+        def emit_member(member, region):
+            account = org_accounts.account(member[self.MEMBER_ID_KEY])
+            emit(("member", self.AWS_SERVICE, region, member[self.MEMBER_ID_KEY],
+                  account.name if account else "", member.get(self.MEMBER_STATUS_KEY, ""),
+                  "" if account else "NOT_IN_ORGANIZATION"))
+            return member[self.MEMBER_ID_KEY]
+
+        def run_region(region):
+            admin_status = self.get_admin_status(admin_account, region)
+            emit(("org_admin", self.AWS_SERVICE, region, admin_account, "", admin_status or "NONE", ""))
+            if admin_status != "ENABLED":
+                return
+
+            org_accounts.set_members(self.AWS_SERVICE, region,
+                                     (emit_member(member, region) for member in
+                                      self.get_associated_members(region=region, only_associated=False)))
+            for account_id in org_accounts.missing(self.AWS_SERVICE, region, exclude=[admin_account]):
+                emit(("member", self.AWS_SERVICE, region, account_id, org_accounts.account(account_id).name,
+                      NOT_MEMBER_STATUS, ""))
+
+        results = common.thread_map(run_region, region_list or self.enabled_regions, return_exceptions=True)
+        for region, result in results.items():
+            if isinstance(result, Exception):
+                logging.error("Inventory of %s in %s failed: %s", self.AWS_SERVICE, region, result)
+                emit(("error", self.AWS_SERVICE, region, "", "", "ERROR", str(result)))
+
+    def reconcile_members(self, input_dict, region, account_dict):
+        """
+        Ensures the accounts in account_dict are associated members of the
+        service for the region specified.  Used to process a single shard of a
+        sharded create, so only the accounts provided are looked up.  Accounts
+        the IR dictionary does not target in the region are removed when they
+        are members.
+        Args:
+        input_dict - IR dictionary
+        region - AWS region
+        account_dict - dictionary of aws account id to account email
+
+        Returns dictionary with the number of accounts checked, added and removed
+        """
+        target_index = self.get_target_index(input_dict)
+        account_list = [account for account in account_dict if account != input_dict["admin_account_id"]]
+        associated_list = self.get_member_accounts(account_list, region)
+
+        remove_list = []
+        if target_index:
+            remove_list = [account for account in associated_list if not target_index.is_target(account, region)]
+            account_list = [account for account in account_list if target_index.is_target(account, region)]
+            associated_list = [account for account in associated_list if account not in remove_list]
+        if remove_list:
+            logging.info("Removing %d untargeted accounts as %s members in %s",
+                         len(remove_list), self.AWS_SERVICE, region)
+            self.remove_member_accounts(remove_list, region)
+
+        add_dict = {account: account_dict[account] for account in account_list
+                    if account not in associated_list}
+        self.sync_member_accounts(add_dict, associated_list, region)
+
+        return {"checked": len(account_list) + len(remove_list), "added": len(add_dict),
+                "removed": len(remove_list)}
+
+    @abc.abstractmethod
+    def get_member_accounts(self, account_list, region):
+        """
+        Returns the accounts from account_list that are associated members of
+        the service for the region specified.  Implemented by the service classes.
+        Args:
+        account_list - list of aws account id strings
+        region - AWS region
+
+        Returns list of aws account id strings
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove_member_accounts(self, account_list, region):
+        """
+        Removes the accounts in account_list as members of the service for the
+        region specified.  Implemented by the service classes.
+        Args:
+        account_list - list of aws account id strings
+        region - AWS region
+
+        Returns None
+        """
+        raise NotImplementedError
+
+    def sync_member_accounts(self, add_dict, associated_list, region):
+        """
+        Adds the accounts in add_dict as members of the service for the region
+        specified.  Services that need to act on the already associated
+        accounts override this method.
+        Args:
+        add_dict - dictionary of aws account id to account email to add
+        associated_list - list of aws account ids already associated
+        region - AWS region
+
+        Returns None
+        """
+        if add_dict:
+            logging.info("Adding %d accounts as %s members in %s",
+                         len(add_dict), self.AWS_SERVICE, region)
+            self.add_members([{"AccountId": account, "Email": email}
+                              for account, email in add_dict.items()], region=region)
+
+    def get_drift_regions(self, input_dict):
+        """
+        Returns the regions that are checked by check_region_drift.  Services
+        that disable the admin in unlisted regions are checked in every enabled
+        region of the organization.
+        Args:
+        input_dict - IR dictionary
+
+        Returns list of aws region strings
+        """
+        enable_regions = [region.strip() for region in input_dict["enable_regions"]]
+        if not self.DISABLE_UNLISTED_REGIONS:
+            return enable_regions
+
+        return enable_regions + [region for region in self.enabled_regions
+                                 if region not in enable_regions]
+
+    def check_org_drift(self, input_dict):
+        """
+        Read only check that the service has organization access enabled and
+        the delegated admin matches the account in the IR dictionary.
+        Args:
+        input_dict - IR dictionary
+
+        Returns list of drift rows as returned by drift_row
+        """
+        admin_account = input_dict["admin_account_id"]
+
+        drift_list = []
+        if self.SERVICE_PRINCIPAL not in self.list_service_access():
+            drift_list.append(self.drift_row("global", "", "service_access", "ENABLED", "DISABLED"))
+
+        admin_list = [admin["Id"] for admin in self.get_delegated_admins(self.SERVICE_PRINCIPAL)]
+        if admin_list != [admin_account]:
+            drift_list.append(self.drift_row("global", admin_account, "delegated_admin",
+                                             admin_account, ",".join(admin_list) or "NONE"))
+
+        return drift_list
+
+    def check_region_drift(self, input_dict, region, org_accounts):
+        """
+        Read only check of the admin status, organization auto enable setting
+        and member association for the region indicated by the region parameter.
+        Args:
+        input_dict - IR dictionary
+        region - aws region string
+        org_accounts - OrgInventory of the organization accounts, the service
+                       members found are recorded in it
+
+        Returns list of drift rows as returned by drift_row
+        """
+        admin_account = input_dict["admin_account_id"]
+        enable_regions = [enable_region.strip() for enable_region in input_dict["enable_regions"]]
+
+        drift_list = []
+        admin_status = self.get_admin_status(admin_account, region)
+        if region not in enable_regions:
+            if admin_status == "ENABLED":
+                drift_list.append(self.drift_row(region, admin_account, "org_admin",
+                                                 "DISABLED", admin_status))
+            return drift_list
+
+        if admin_status != "ENABLED":
+            # The delegated admin calls below fail without an enabled admin
+            drift_list.append(self.drift_row(region, admin_account, "org_admin",
+                                             "ENABLED", admin_status or "NONE"))
+            return drift_list
+
+        auto_enable = self.get_auto_enable(region)
+        if auto_enable != self.org_auto_enable(input_dict):
+            drift_list.append(self.drift_row(region, admin_account, "auto_enable", str(not auto_enable),
+                                             str(auto_enable)))
+
+        org_accounts.set_members(self.AWS_SERVICE, region,
+                                 (member[self.MEMBER_ID_KEY] for member in self.get_associated_members(region=region)))
+        for account in self.missing_targets(org_accounts, input_dict, region):
+            drift_list.append(self.drift_row(region, account, "member", "ASSOCIATED", "MISSING"))
+        for account in self.untargeted_members(org_accounts, input_dict, region):
+            drift_list.append(self.drift_row(region, account, "member", "NOT_TARGETED", "ASSOCIATED"))
+
+        return drift_list
+
+    @abc.abstractmethod
+    def get_admin_status(self, account_id, region):
+        """
+        Returns the status of the account as the service admin for the region
+        specified.  Implemented by the service classes.
+        Args:
+        account_id - AWS account id
+        region - AWS region
+
+        Returns status string or None if the account is not the admin
+        """
+        raise NotImplementedError
 
+    @abc.abstractmethod
+    def get_auto_enable(self, region):
+        """
+        Returns True if the organization configuration of the service auto
+        enables new member accounts in the region specified.  Implemented by the
+        service classes.
+        Args:
+        region - AWS region
+
+        Returns bool
+        """
+        raise NotImplementedError
 
-        pass
\ No newline at end of file
+    def drift_row(self, region, account_id, check, expected, actual):
+        """
+        Builds a single drift report row for the service.
+        Args:
+        region - AWS region or "global" for organization wide checks
+        account_id - AWS account id the row applies to
+        check - Name of the check that failed
+        expected - Expected value
+        actual - Value found
+
+        Returns tuple matching DRIFT_COLUMNS
+        """
+        return (self.AWS_SERVICE, region, account_id, check, str(expected), str(actual))
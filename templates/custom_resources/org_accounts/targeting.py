@@ -0,0 +1,306 @@
+"""
+Module containing the organizational unit tree of an organization and the
+TargetIndex compiled from the targeting parameters of an IR service config,
+which resolves the regions an account is enrolled in with a single lookup.
+
+Targeting parameters of a service config, all optional:
+include_ous - Only accounts under these organizational units (or roots) are enrolled
+exclude_ous - Accounts under these organizational units are not enrolled
+include_accounts - Accounts enrolled whatever their organizational unit
+exclude_accounts - Accounts never enrolled
+default_regions - Regions accounts are enrolled in (DEFAULT=enable_regions)
+region_overrides - Dictionary of organizational unit or account id to the
+                   regions its accounts are enrolled in instead
+
+The most specific rule wins: an account rule over any organizational unit
+rule, and the rule of the closest organizational unit over its ancestors.
+"""
+import hashlib
+import json
+import threading
+import time
+
+import common
+
+
+TARGETING_KEYS = ["include_ous", "exclude_ous", "include_accounts", "exclude_accounts",
+                  "default_regions", "region_overrides"]
+# Seconds a walked organizational unit tree is reused for
+ORG_TREE_TTL = 300
+_ORG_TREE_CACHE = {}
+_ORG_TREE_LOCK = threading.Lock()
+
+
+class OrgTree:
+    """
+    Organizational unit tree of an organization: the parent of every
+    organizational unit and account.
+    """
+    def __init__(self, parents=None, names=None):
+        """
+        Kargs:
+        parents - dictionary of organizational unit or account id to parent id
+        names - dictionary of root and organizational unit id to name
+        """
+        self.parents = parents or {}
+        self.names = names or {}
+        self.__path_cache = {}
+
+    @classmethod
+    def walk(cls, org_client):
+        """
+        Walks the tree of the organization level by level.  The organizational
+        units and accounts of every parent in a level are listed concurrently,
+        limited by the adaptive concurrency of the Organizations endpoint.
+        Args:
+        org_client - boto3 Organizations client of the management account
+
+        Returns OrgTree
+        """
+        tree = cls()
+        level = []
+        for root in common.paginate(org_client, "list_roots", "Roots"):
+            tree.names[root["Id"]] = root["Name"]
+            level.append(root["Id"])
+
+        limiter_key = ("organizations", org_client.meta.region_name)
+
+        def list_children(parent_id):
+            for account in common.paginate(org_client, "list_accounts_for_parent", "Accounts",
+                                           ParentId=parent_id):
+                tree.parents[account["Id"]] = parent_id
+
+            child_list = []
+            for ou in common.paginate(org_client, "list_organizational_units_for_parent",
+                                      "OrganizationalUnits", ParentId=parent_id):
+                tree.parents[ou["Id"]] = parent_id
+                tree.names[ou["Id"]] = ou["Name"]
+                child_list.append(ou["Id"])
+            return child_list
+
+        while level:
+            results = common.adaptive_map(list_children, level, limiter_key)
+            level = [ou_id for parent_id in level for ou_id in results[parent_id]]
+
+        return tree
+
+    def locate(self, org_client, node_id):
+        """
+        Adds an account or organizational unit that is not in the tree, such
+        as an account that joined after the tree was walked, by listing its
+        parents up to the first one already in the tree.
+        Args:
+        org_client - boto3 Organizations client of the management account
+        node_id - Organizational unit or account id
+
+        Returns None
+        """
+        while node_id not in self.parents and node_id not in self.names:
+            parent = org_client.list_parents(ChildId=node_id)["Parents"][0]
+            self.parents[node_id] = parent["Id"]
+            if parent["Type"] == "ROOT":
+                self.names.setdefault(parent["Id"], "Root")
+            node_id = parent["Id"]
+
+    def accounts(self):
+        """
+        Returns the ids of the accounts in the tree.
+        """
+        return [node_id for node_id in self.parents if node_id not in self.names]
+
+    def path(self, node_id):
+        """
+        Returns the ids of the ancestors of an organizational unit or account,
+        from its root to its parent.  The path of every organizational unit is
+        computed once.
+        Args:
+        node_id - Organizational unit or account id
+
+        Returns tuple of ids, empty when the node is not in the tree
+        """
+        parent_id = self.parents.get(node_id)
+        if not parent_id:
+            return ()
+
+        parent_path = self.__path_cache.get(parent_id)
+        if parent_path is None:
+            parent_path = self.path(parent_id) + (parent_id,)
+            self.__path_cache[parent_id] = parent_path
+        return parent_path
+
+
+class TargetIndex:
+    """
+    Regions every organization account is enrolled in, compiled once from the
+    targeting parameters and the OrgTree.  Accounts sharing a region set share
+    the same frozenset, so the index holds one reference per account.
+    """
+    def __init__(self, account_regions, other_regions):
+        """
+        Args:
+        account_regions - dictionary of account id to frozenset of regions,
+                          empty for accounts that are not enrolled
+        other_regions - frozenset of regions of accounts not in the index
+        """
+        self.account_regions = account_regions
+        self.other_regions = other_regions
+
+    @classmethod
+    def compile(cls, input_dict, org_tree):
+        """
+        Compiles the targeting parameters of a service config for the accounts
+        of the organization.  Every organizational unit and account named by
+        the parameters must be in the tree, as accounts that are not targeted
+        are removed as members.
+        Args:
+        input_dict - IR dictionary of the service
+        org_tree - OrgTree of the organization
+
+        Returns TargetIndex
+        """
+        enable_regions = [region.strip() for region in input_dict["enable_regions"]]
+        default_regions = frozenset(_as_list(input_dict.get("default_regions")) or enable_regions)
+        overrides = _overrides(input_dict)
+
+        unknown_list = sorted(node_id for node_id in target_ids(input_dict)
+                              if node_id not in org_tree.parents and node_id not in org_tree.names)
+        if unknown_list:
+            raise ValueError(f"Targeting ids {unknown_list} are not in the organization")
+
+        # One shared frozenset per distinct region set
+        region_sets = {default_regions: default_regions}
+        override_dict = {}
+        for node_id, region_list in overrides.items():
+            region_set = frozenset(_as_list(region_list))
+            region_sets.setdefault(region_set, region_set)
+            override_dict[node_id] = region_sets[region_set]
+
+        unknown_list = sorted(set().union(default_regions, *override_dict.values()) - set(enable_regions))
+        if unknown_list:
+            raise ValueError(f"Targeting regions {unknown_list} are not in enable_regions {enable_regions}")
+
+        include_ous = set(_as_list(input_dict.get("include_ous")))
+        exclude_ous = set(_as_list(input_dict.get("exclude_ous")))
+        ou_rules = include_ous | exclude_ous
+        include_accounts = set(_as_list(input_dict.get("include_accounts")))
+        exclude_accounts = set(_as_list(input_dict.get("exclude_accounts")))
+        empty = frozenset()
+
+        # Rules resolved per parent, as every account of a parent shares them
+        parent_cache = {}
+
+        def resolve_parent(parent_id):
+            included = not include_ous
+            regions = default_regions
+            included_found = regions_found = False
+            for node_id in reversed(org_tree.path(parent_id) + (parent_id,)):
+                if not included_found and node_id in ou_rules:
+                    included = node_id in include_ous
+                    included_found = True
+                if not regions_found and node_id in override_dict:
+                    regions = override_dict[node_id]
+                    regions_found = True
+            return included, regions
+
+        account_regions = {}
+        for account_id in set(org_tree.accounts()) | include_accounts | exclude_accounts:
+            parent_id = org_tree.parents.get(account_id)
+            if parent_id not in parent_cache:
+                parent_cache[parent_id] = resolve_parent(parent_id) if parent_id else \
+                    (not include_ous, default_regions)
+            included, regions = parent_cache[parent_id]
+
+            if account_id in exclude_accounts:
+                included = False
+            elif account_id in include_accounts:
+                included = True
+            regions = override_dict.get(account_id, regions)
+
+            account_regions[account_id] = regions if included else empty
+
+        # Accounts outside of the tree are only enrolled when no organizational
+        # unit is included
+        return cls(account_regions, empty if include_ous else default_regions)
+
+    def regions(self, account_id):
+        """
+        Returns the frozenset of regions the account is enrolled in.
+        """
+        return self.account_regions.get(account_id, self.other_regions)
+
+    def is_target(self, account_id, region):
+        """
+        Returns True if the account is enrolled in the region.
+        """
+        return region in self.account_regions.get(account_id, self.other_regions)
+
+    def digest(self):
+        """
+        Returns a hash of the region set of every account, which changes when
+        accounts move between organizational units.
+        """
+        digest = hashlib.sha256()
+        for account_id in sorted(self.account_regions):
+            digest.update(f"{account_id}:{','.join(sorted(self.account_regions[account_id]))};".encode("utf-8"))
+        return digest.hexdigest()
+
+
+def has_targeting(input_dict):
+    """
+    Returns True if the service config has any targeting parameter.
+    """
+    return any(input_dict.get(key) for key in TARGETING_KEYS)
+
+
+def target_ids(input_dict):
+    """
+    Returns the set of organizational unit and account ids named by the
+    targeting parameters of a service config.
+    """
+    id_set = set(_overrides(input_dict))
+    for key in ["include_ous", "exclude_ous", "include_accounts", "exclude_accounts"]:
+        id_set.update(_as_list(input_dict.get(key)))
+    return id_set
+
+
+def get_org_tree(cache_key, org_client):
+    """
+    Returns the OrgTree of the organization, walked at most once every
+    ORG_TREE_TTL seconds for the same cache_key.  Callers asking for the
+    same tree at the same time wait for a single walk.
+    Args:
+    cache_key - Hashable identifying the organization and credentials
+    org_client - boto3 Organizations client of the management account
+
+    Returns OrgTree
+    """
+    with _ORG_TREE_LOCK:
+        created, org_tree = _ORG_TREE_CACHE.get(cache_key, (0, None))
+        if time.monotonic() - created > ORG_TREE_TTL:
+            org_tree = OrgTree.walk(org_client)
+            _ORG_TREE_CACHE[cache_key] = (time.monotonic(), org_tree)
+
+    return org_tree
+
+
+def _overrides(input_dict):
+    """
+    Returns the region_overrides of a service config as a dictionary,
+    accepting the JSON string of Cloudformation parameters.
+    """
+    overrides = input_dict.get("region_overrides") or {}
+    if isinstance(overrides, str):
+        overrides = json.loads(overrides)
+    return overrides
+
+
+def _as_list(value):
+    """
+    Returns a list parameter as a list of stripped strings, accepting the
+    comma separated strings of Cloudformation parameters.
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [item.strip() for item in value if item.strip()]
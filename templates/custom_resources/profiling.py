@@ -0,0 +1,334 @@
+"""
+Module containing the profiling hooks of IR runs.  A run is profiled in one
+of the PROFILE_MODES, selected with --profile from the command line or the
+IR_PROFILE environment variable in Lambda:
+
+cpu - cProfile of the main thread and every thread started during the run,
+      merged into a single pstats dump
+memory - tracemalloc top allocations at every phase boundary
+wall - thread stacks sampled at a fixed interval, written as folded stacks
+
+The files are written with the output prefix and a summary of the top
+entries is logged, so the hotspots of a Lambda run are in its logs.
+"""
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+PROFILE_MODES = ["cpu", "memory", "wall"]
+DEFAULT_OUTPUT_PREFIX = "ir_profile"
+# Lambda functions can only write to /tmp
+DEFAULT_LAMBDA_OUTPUT_PREFIX = "/tmp/ir_profile"
+# Number of entries in the logged summaries and memory snapshots
+DEFAULT_TOP_COUNT = 25
+# Seconds between thread stack samples in wall mode
+DEFAULT_SAMPLE_INTERVAL = 0.01
+# Stack frames kept per allocation in memory mode
+MEMORY_FRAMES = 5
+
+_PROFILE_SETTINGS = {
+    "profiler": None
+}
+
+
+class CpuProfiler:
+    """
+    Profiles the CPU time of the main thread and of every thread started
+    while the profiler runs, e.g. the thread_map workers of the region and
+    account fan-out.
+    """
+    def __init__(self, output_prefix, top_count=DEFAULT_TOP_COUNT):
+        self.output_prefix = output_prefix
+        self.top_count = top_count
+        self.__profile_list = []
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts profiling the current thread and threads started from now on.
+
+        Returns None
+        """
+        threading.setprofile(self._start_thread)
+        self._start_thread()
+
+    def _start_thread(self, *args):
+        """
+        Enables a profile for the calling thread.  Set as the threading
+        profile function so it runs as each new thread starts, enabling the
+        profile replaces it for the thread.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active for the thread
+            sys.setprofile(None)
+            return
+
+        with self.__lock:
+            self.__profile_list.append(profile)
+
+    def phase(self, name):
+        """
+        Phases are not tracked by the CPU profile.
+        """
+
+    def stop(self):
+        """
+        Stops profiling and writes the merged pstats dump.
+
+        Returns list of filenames written
+        """
+        threading.setprofile(None)
+        with self.__lock:
+            profile_list = list(self.__profile_list)
+
+        # The main thread profile is first and has to be disabled from this thread
+        profile_list[0].disable()
+        stats = pstats.Stats(profile_list[0])
+        for profile in profile_list[1:]:
+            stats.add(profile)
+
+        filename = f"{self.output_prefix}-cpu.pstats"
+        stats.dump_stats(filename)
+
+        summary = io.StringIO()
+        pstats.Stats(filename, stream=summary).sort_stats("cumulative").print_stats(self.top_count)
+        logging.info("CPU profile of %d threads:\n%s", len(profile_list), summary.getvalue())
+        return [filename]
+
+
+class MemoryProfiler:
+    """
+    Traces memory allocations and takes a snapshot of the top allocations
+    at every phase boundary.
+    """
+    def __init__(self, output_prefix, top_count=DEFAULT_TOP_COUNT):
+        self.output_prefix = output_prefix
+        self.top_count = top_count
+        self.__report = io.StringIO()
+        self.__previous = None
+        self.__started = False
+
+    def start(self):
+        """
+        Starts tracing memory allocations.
+
+        Returns None
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_FRAMES)
+            self.__started = True
+        self.phase("start")
+
+    def phase(self, name):
+        """
+        Adds the top allocations and the top growth since the previous phase
+        to the report.
+        Args:
+        name - Name of the phase that starts
+
+        Returns None
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+        current, peak = tracemalloc.get_traced_memory()
+
+        self.__report.write(f"== {name}: current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n")
+        for statistic in snapshot.statistics("lineno")[:self.top_count]:
+            self.__report.write(f"{statistic}\n")
+
+        if self.__previous:
+            self.__report.write("-- growth since previous phase\n")
+            for statistic in snapshot.compare_to(self.__previous, "lineno")[:self.top_count]:
+                self.__report.write(f"{statistic}\n")
+
+        self.__report.write("\n")
+        self.__previous = snapshot
+
+    def stop(self):
+        """
+        Takes the final snapshot, stops tracing and writes the report.
+
+        Returns list of filenames written
+        """
+        self.phase("stop")
+        current, peak = tracemalloc.get_traced_memory()
+        if self.__started:
+            tracemalloc.stop()
+
+        filename = f"{self.output_prefix}-memory.txt"
+        with open(filename, "w", encoding="utf-8") as report_file:
+            report_file.write(self.__report.getvalue())
+
+        logging.info("Memory profile: current %.1f KiB, peak %.1f KiB, written to %s",
+                     current / 1024, peak / 1024, filename)
+        return [filename]
+
+
+class WallProfiler:
+    """
+    Samples the stacks of all threads at a fixed interval from a background
+    thread.  Threads waiting on network calls are sampled too, so the time
+    spent in each part of the fan-out is measured in wall clock time.
+    """
+    def __init__(self, output_prefix, top_count=DEFAULT_TOP_COUNT, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.output_prefix = output_prefix
+        self.top_count = top_count
+        self.interval = interval
+        self.__stack_counts = Counter()
+        self.__sample_count = 0
+        self.__phase = "start"
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        """
+        Starts the sampling thread.
+
+        Returns None
+        """
+        self.__thread = threading.Thread(target=self._sample, daemon=True)
+        self.__thread.start()
+
+    def _sample(self):
+        """
+        Records the stack of every other thread until the profiler is stopped.
+        """
+        sample_ident = threading.get_ident()
+        while not self.__stop_event.wait(self.interval):
+            self.__sample_count += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == sample_ident:
+                    continue
+
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                stack.append(self.__phase)
+                self.__stack_counts[";".join(reversed(stack))] += 1
+
+    def phase(self, name):
+        """
+        Sets the phase used as the root of the following samples.
+        Args:
+        name - Name of the phase that starts
+
+        Returns None
+        """
+        self.__phase = name
+
+    def stop(self):
+        """
+        Stops sampling and writes the folded stacks, which can be rendered
+        with flamegraph tools.
+
+        Returns list of filenames written
+        """
+        self.__stop_event.set()
+        self.__thread.join()
+
+        filename = f"{self.output_prefix}-wall.folded"
+        with open(filename, "w", encoding="utf-8") as report_file:
+            for stack, count in self.__stack_counts.most_common():
+                report_file.write(f"{stack} {count}\n")
+
+        # Samples in which each function was the innermost frame
+        leaf_counts = Counter()
+        for stack, count in self.__stack_counts.items():
+            leaf_counts[stack.rsplit(";", 1)[-1]] += count
+
+        logging.info("Wall profile of %d samples every %ss, top functions:\n%s", self.__sample_count,
+                     self.interval, "\n".join(f"{count:8d} {function}"
+                                              for function, count in leaf_counts.most_common(self.top_count)))
+        return [filename]
+
+
+PROFILER_CLASS_MAPPING = {
+    "cpu": CpuProfiler,
+    "memory": MemoryProfiler,
+    "wall": WallProfiler
+}
+
+
+def start_profile(mode=None, output_prefix=None):
+    """
+    Starts profiling the run.  Does nothing when no mode is requested.
+    Kargs:
+    mode - One of PROFILE_MODES (DEFAULT=IR_PROFILE environment variable)
+    output_prefix - Path prefix of the files written
+                    (DEFAULT=IR_PROFILE_PREFIX environment variable or
+                    DEFAULT_OUTPUT_PREFIX)
+
+    Returns None
+    """
+    mode = mode or os.environ.get("IR_PROFILE")
+    if not mode:
+        return
+
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unsupported profile mode {mode}")
+
+    stop_profile()
+    output_prefix = output_prefix or os.environ.get("IR_PROFILE_PREFIX", DEFAULT_OUTPUT_PREFIX)
+    _PROFILE_SETTINGS["profiler"] = PROFILER_CLASS_MAPPING[mode](output_prefix)
+    _PROFILE_SETTINGS["profiler"].start()
+    logging.info("Profiling run in %s mode", mode)
+
+
+def phase(name):
+    """
+    Marks the start of a phase of the run in the active profiler.
+    Args:
+    name - Name of the phase
+
+    Returns None
+    """
+    if _PROFILE_SETTINGS["profiler"]:
+        _PROFILE_SETTINGS["profiler"].phase(name)
+
+
+def stop_profile():
+    """
+    Stops the active profiler and writes its files.
+
+    Returns list of filenames written
+    """
+    profiler = _PROFILE_SETTINGS["profiler"]
+    _PROFILE_SETTINGS["profiler"] = None
+    if not profiler:
+        return []
+
+    start_time = time.monotonic()
+    filename_list = profiler.stop()
+    logging.info("Profile written to %s in %.3fs", ", ".join(filename_list), time.monotonic() - start_time)
+    return filename_list
+
+
+def profile_handler(function):
+    """
+    Decorator for Lambda handlers that profiles the invocation when the
+    IR_PROFILE environment variable is set.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start_profile(output_prefix=os.environ.get("IR_PROFILE_PREFIX", DEFAULT_LAMBDA_OUTPUT_PREFIX))
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stop_profile()
+
+    return wrapper
@@ -0,0 +1,369 @@
+"""
+Module that splits the member account work of an IR create into shards of
+(service, region, account range) and processes them through a work queue.
+The coordinator prepares each service, queues the shards and gathers the
+shard results so a single Cloudformation response can be sent for the run.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from uuid import uuid4
+
+import common
+
+
+DEFAULT_SHARD_SIZE = 500
+# Longest wait supported by SQS long polling
+MAX_RECEIVE_WAIT = 20
+# Seconds a long poll ends before the read timeout of the SQS client
+RECEIVE_READ_MARGIN = 2
+
+
+class LocalQueue:
+    """
+    In memory queue backend used when shards are processed by worker threads
+    in the same process.
+    """
+    def __init__(self):
+        self.__queue = queue.Queue()
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+    def send(self, message_list):
+        """
+        Adds messages to the queue.
+        Args:
+        message_list - list of json serializable dictionaries
+
+        Returns None
+        """
+        for message in message_list:
+            self.__queue.put(json.dumps(message))
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        """
+        Returns up to max_messages messages, waiting up to wait_seconds for the
+        first message to arrive.
+        Kargs:
+        max_messages - Maximum number of messages to return
+        wait_seconds - Seconds to wait when the queue is empty
+
+        Returns list of (receipt, message dictionary) tuples
+        """
+        return_list = []
+        try:
+            body = self.__queue.get(timeout=wait_seconds) if wait_seconds else self.__queue.get_nowait()
+            while True:
+                receipt = str(uuid4())
+                with self.__lock:
+                    self.__in_flight[receipt] = body
+                return_list.append((receipt, json.loads(body)))
+
+                if len(return_list) >= max_messages:
+                    break
+                body = self.__queue.get_nowait()
+
+        except queue.Empty:
+            pass
+
+        return return_list
+
+    def delete(self, receipt):
+        """
+        Removes a received message from the queue.
+        Args:
+        receipt - receipt returned with the message by receive
+
+        Returns None
+        """
+        with self.__lock:
+            self.__in_flight.pop(receipt, None)
+
+    def release(self, receipt):
+        """
+        Returns a received message to the queue so it can be received again.
+        Args:
+        receipt - receipt returned with the message by receive
+
+        Returns None
+        """
+        with self.__lock:
+            body = self.__in_flight.pop(receipt, None)
+        if body:
+            self.__queue.put(body)
+
+
+class SQSQueue:
+    """
+    Amazon SQS (or SQS compatible) queue backend used when shards are
+    processed by separate Lambda invocations.
+    """
+    # Maximum number of entries accepted by send_message_batch
+    SEND_BATCH_SIZE = 10
+
+    def __init__(self, queue_url, sqs_client=None):
+        self.queue_url = queue_url
+        self.sqs_client = sqs_client
+        if not self.sqs_client:
+            self.sqs_client = common.get_client("sqs")
+
+    def send(self, message_list):
+        """
+        Adds messages to the queue in batches of SEND_BATCH_SIZE.
+        Args:
+        message_list - list of json serializable dictionaries
+
+        Returns None
+        """
+        for index in range(0, len(message_list), self.SEND_BATCH_SIZE):
+            batch = message_list[index:index + self.SEND_BATCH_SIZE]
+            response = self.sqs_client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": str(entry_id), "MessageBody": json.dumps(message)}
+                         for entry_id, message in enumerate(batch)])
+
+            if response.get("Failed"):
+                raise ValueError(f"Unable to queue all messages {response['Failed']}")
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        """
+        Returns up to max_messages messages, long polling up to wait_seconds.
+        The wait is capped below the read timeout of the client, which is
+        shortened near the run deadline, so an empty poll is not ended by a
+        read timeout and retried.
+        Kargs:
+        max_messages - Maximum number of messages to return
+        wait_seconds - Seconds to wait when the queue is empty
+
+        Returns list of (receipt, message dictionary) tuples
+        """
+        read_timeout = self.sqs_client.meta.config.read_timeout
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, 10),
+            WaitTimeSeconds=max(min(int(wait_seconds), MAX_RECEIVE_WAIT,
+                                    int(read_timeout) - RECEIVE_READ_MARGIN), 0))
+
+        return [(message["ReceiptHandle"], json.loads(message["Body"]))
+                for message in response.get("Messages", [])]
+
+    def delete(self, receipt):
+        """
+        Removes a received message from the queue.
+        Args:
+        receipt - receipt handle returned with the message by receive
+
+        Returns None
+        """
+        self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+    def release(self, receipt):
+        """
+        Makes a received message immediately visible to other receivers.
+        Args:
+        receipt - receipt handle returned with the message by receive
+
+        Returns None
+        """
+        self.sqs_client.change_message_visibility(QueueUrl=self.queue_url,
+                                                  ReceiptHandle=receipt,
+                                                  VisibilityTimeout=0)
+
+
+class ShardWorker:
+    """
+    Processes shard messages by reconciling the members of a single service,
+    region and account range.
+    """
+    def __init__(self, service_factory, work_queue=None, result_queue=None):
+        """
+        Args:
+        service_factory - Callable that returns the service class instance to
+                          use for a shard message
+        Kargs:
+        work_queue - Queue the shards are received from when run is used
+        result_queue - Queue the shard results are sent to when run is used
+        """
+        self.service_factory = service_factory
+        self.work_queue = work_queue
+        self.result_queue = result_queue
+
+    def process(self, shard):
+        """
+        Processes a single shard.  Exceptions are captured in the result so a
+        failed shard is reported instead of being retried indefinitely.
+        Args:
+        shard - shard message dictionary
+
+        Returns shard result dictionary
+        """
+        start_time = time.monotonic()
+        result = {
+            "run_id": shard["run_id"],
+            "shard_id": shard["shard_id"],
+            "service": shard["service"],
+            "region": shard["region"],
+            "status": "SUCCEEDED",
+            "error": None
+        }
+
+        try:
+            service_object = self.service_factory(shard)
+            result.update(service_object.reconcile_members(shard["config"], shard["region"],
+                                                           shard["accounts"]))
+
+        except Exception as err:
+            logging.exception("Shard %s failed", shard["shard_id"])
+            result["status"] = "FAILED"
+            result["error"] = str(err)
+
+        result["duration"] = round(time.monotonic() - start_time, 3)
+        return result
+
+    def run(self, stop_event):
+        """
+        Receives and processes shards from the work queue until stop_event is set.
+        Args:
+        stop_event - threading.Event used to stop the worker
+
+        Returns None
+        """
+        while not stop_event.is_set():
+            for receipt, shard in self.work_queue.receive(max_messages=1, wait_seconds=1):
+                self.result_queue.send([self.process(shard)])
+                self.work_queue.delete(receipt)
+
+
+class ShardCoordinator:
+    """
+    Splits the member account work of an IR create into shards, queues them
+    and gathers their results.
+    """
+    def __init__(self, work_queue, result_queue, shard_size=None, result_queue_url=None):
+        """
+        Args:
+        work_queue - Queue the shards are sent to
+        result_queue - Queue the shard results are received from
+        Kargs:
+        shard_size - Number of accounts per shard (DEFAULT=DEFAULT_SHARD_SIZE)
+        result_queue_url - Url of the result queue included in each shard so
+                           remote workers know where to send results
+        """
+        self.work_queue = work_queue
+        self.result_queue = result_queue
+        self.shard_size = shard_size or DEFAULT_SHARD_SIZE
+        self.result_queue_url = result_queue_url
+
+    def plan_shards(self, run_id, config_dict, org_accounts, credentials):
+        """
+        Splits the organization accounts into shards for every service and
+        enabled region in the config_dict.  Accounts are sorted so the same
+        account ranges are produced for the same organization.
+        Args:
+        run_id - Identifier of the run
+        config_dict - IR configuration dictionary limited to the services to shard
+        org_accounts - dictionary of organization accounts from get_org_accounts
+        credentials - dictionary with the target_account, assume_role and
+                      external_id used by workers to create service objects
+
+        Returns list of shard message dictionaries
+        """
+        account_list = sorted(org_accounts)
+        shard_list = []
+        for service, input_dict in config_dict.items():
+            for region in input_dict["enable_regions"]:
+                region = region.strip()
+                for index in range(0, len(account_list), self.shard_size):
+                    shard_accounts = account_list[index:index + self.shard_size]
+                    shard = {
+                        "run_id": run_id,
+                        "shard_id": f"{service}:{region}:{index // self.shard_size}",
+                        "service": service,
+                        "region": region,
+                        "config": input_dict,
+                        "accounts": {account: org_accounts[account]["Email"]
+                                     for account in shard_accounts},
+                        "result_queue": self.result_queue_url
+                    }
+                    shard.update(credentials)
+                    shard_list.append(shard)
+
+        return shard_list
+
+    def run(self, shard_list, timeout=None, service_factory=None, local_workers=0):
+        """
+        Queues the shards and waits for a result for every shard.  When
+        local_workers is set the shards are processed by that many threads in
+        this process, otherwise remote workers are expected to consume the work
+        queue.
+        Args:
+        shard_list - list of shard messages from plan_shards
+        Kargs:
+        timeout - Seconds to wait for all shard results
+        service_factory - Callable used by local workers to get service objects
+        local_workers - Number of worker threads to run in this process
+
+        Returns dictionary of shard id to shard result
+        """
+        if not shard_list:
+            return {}
+
+        self.work_queue.send(shard_list)
+        logging.info("Queued %d shards for run %s", len(shard_list), shard_list[0]["run_id"])
+
+        stop_event = threading.Event()
+        thread_list = []
+        for _ in range(local_workers):
+            worker = ShardWorker(service_factory, self.work_queue, self.result_queue)
+            thread_list.append(threading.Thread(target=worker.run, args=(stop_event,), daemon=True))
+            thread_list[-1].start()
+
+        try:
+            return self.gather(shard_list[0]["run_id"], [shard["shard_id"] for shard in shard_list],
+                               timeout=timeout)
+        finally:
+            stop_event.set()
+
+    def gather(self, run_id, shard_id_list, timeout=None):
+        """
+        Receives shard results from the result queue until every shard in
+        shard_id_list has a result or the timeout is reached.  Shards without a
+        result are reported as failed.  Results that belong to other runs are
+        released back to the queue.
+        Args:
+        run_id - Identifier of the run
+        shard_id_list - list of shard ids to wait for
+        Kargs:
+        timeout - Seconds to wait for all shard results, None to wait until
+                  every shard has a result
+
+        Returns dictionary of shard id to shard result
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = set(shard_id_list)
+        return_dict = {}
+
+        while pending:
+            wait_seconds = MAX_RECEIVE_WAIT
+            if deadline is not None:
+                wait_seconds = min(wait_seconds, deadline - time.monotonic())
+                if wait_seconds <= 0:
+                    break
+
+            for receipt, result in self.result_queue.receive(wait_seconds=max(wait_seconds, 1)):
+                if result.get("run_id") != run_id:
+                    self.result_queue.release(receipt)
+                    continue
+
+                self.result_queue.delete(receipt)
+                if result["shard_id"] in pending:
+                    pending.discard(result["shard_id"])
+                    return_dict[result["shard_id"]] = result
+
+        for shard_id in pending:
+            return_dict[shard_id] = {"run_id": run_id, "shard_id": shard_id, "status": "FAILED",
+                                     "error": "No shard result received before the timeout"}
+
+        return return_dict
@@ -1,13 +1,25 @@
 """
-Helper module that creates the Incident Response Foundations solution
-Cloudformation stack in an Organizations' management account.
+Helper module that creates or updates the Incident Response Foundations
+solution Cloudformation stack in an Organizations' management account.
 """
 import argparse
+import ast
+import hashlib
+import importlib.util
 import os
-from zipfile import ZipFile
+import py_compile
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 
 
 import boto3
+import botocore.exceptions
 
 
 CR_DIRECTORY = "custom_resources"
@@ -20,12 +32,31 @@ CR_ZIP_FILE_LIST = [
     "ir_setup.py",
     "guardduty.py",
     "common.py",
+    "correlation.py",
+    "findings.py",
     "securityhub.py",
     "cfnresponse.py",
     "inspector.py",
+    "ledger.py",
+    "profiling.py",
+    "sharding.py",
     "org_accounts/__init__.py",
-    "org_accounts/manager.py"
+    "org_accounts/inventory.py",
+    "org_accounts/manager.py",
+    "org_accounts/targeting.py"
 ]
+# Module the Lambda handlers are imported from, every local module it imports
+# must be in CR_ZIP_FILE_LIST
+CR_ENTRY_MODULE = "ir_setup.py"
+# Fixed timestamp used for every zip entry so identical sources produce an
+# identical zip
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+HASH_METADATA_KEY = "sha256"
+# Seconds between polls of the change set and stack events
+POLL_INTERVAL = 5
+# Arguments required unless only running the benchmark
+REQUIRED_DEPLOY_ARGS = ["deladmin", "bucket", "shregions", "gdregions", "inregions"]
+BENCHMARK_RUNS = 5
 
 
 def main(args):
@@ -52,72 +83,471 @@ def main(args):
         cf_template = IR_TEMPLATE
 
 
-    if os.path.isfile(zip_filename):
-        print("Removing existing CR zip file %s" % zip_filename)
-        os.remove(zip_filename)
-
+    source_directory = os.path.join(base_directory, CR_ZIP_DIRECTORY)
     artifact_zip = os.path.join(base_directory, zip_filename)
-    with ZipFile(artifact_zip, 'w') as zip_object:
-        for file in CR_ZIP_FILE_LIST:
-            zip_object.write(os.path.join(base_directory, CR_ZIP_DIRECTORY, file),
-                             arcname=file)
+    artifact_hash = build_artifact(source_directory, CR_ZIP_FILE_LIST, artifact_zip,
+                                   include_bytecode=bytecode_supported(cf_template))
 
-    # Upload CR Zip
-    print("Uploading CR Zip to bucket %s" % bucket)
-    response = s3_client.upload_file(artifact_zip, bucket, zip_filename)
+    # The artifact key is versioned by content so the Lambda code is only
+    # redeployed when the source changes
+    zip_key = versioned_key(zip_filename, artifact_hash)
+    print("Uploading CR Zip to bucket %s as %s" % (bucket, zip_key))
+    upload_if_changed(s3_client, artifact_zip, bucket, zip_key, artifact_hash)
 
-    # Upload CF Template
     print("Uploading CF Template to bucket %s" % bucket)
+    template_key = os.path.basename(cf_template)
     cf_template = os.path.join(base_directory, cf_template)
-    response = s3_client.upload_file(cf_template, bucket, cf_template)
+    upload_if_changed(s3_client, cf_template, bucket, template_key, file_hash(cf_template))
 
     parameter_list = [
             {'ParameterKey': "LambdaZipBucket", 'ParameterValue': bucket},
+            {'ParameterKey': "LambdaZipKey", 'ParameterValue': zip_key},
             {'ParameterKey': "AdminAccountId", 'ParameterValue': delegated_account},
             {'ParameterKey': "SHEnableRegions", 'ParameterValue': sh_regions},
             {'ParameterKey': "GDEnableRegions", 'ParameterValue': gd_regions},
             {'ParameterKey': "INEnableRegions", 'ParameterValue': in_regions}
         ]
 
-    print("Creating solution Cloudformation stack")
     presigned_url = s3_client.generate_presigned_url(
         'get_object',
         Params={'Bucket': bucket,
-                'Key': cf_template}
+                'Key': template_key}
         )
 
-    response = cf_client.create_stack(
-        StackName=stack_name,
-        TemplateURL=presigned_url,
-        Parameters=parameter_list,
-        Capabilities=[
+    final_status = deploy_stack(cf_client, stack_name, presigned_url, parameter_list)
+    if final_status and (not final_status.endswith("_COMPLETE") or "ROLLBACK" in final_status):
+        raise SystemExit("Stack %s finished with status %s" % (stack_name, final_status))
+
+
+def deploy_stack(cf_client, stack_name, template_url, parameter_list):
+    """
+    Creates the stack or, when it already exists, updates it through a change
+    set so only the resources whose properties changed are updated.  Stack
+    events are streamed while the change set executes.
+    Args:
+    cf_client - boto3 cloudformation client
+    stack_name - Name of the stack
+    template_url - Url of the template in S3
+    parameter_list - list of Cloudformation parameter dictionaries
+
+    Returns the final stack status or None if there were no changes
+    """
+    stack_status = get_stack_status(cf_client, stack_name)
+    if stack_status and stack_status != "REVIEW_IN_PROGRESS":
+        change_set_type = "UPDATE"
+    else:
+        change_set_type = "CREATE"
+
+    change_set_name = "%s-%d" % (stack_name, int(time.time()))
+    print("Creating %s change set %s for stack %s" % (change_set_type, change_set_name, stack_name))
+    change_set_params = {
+        "StackName": stack_name,
+        "TemplateURL": template_url,
+        "Parameters": parameter_list,
+        "Capabilities": [
             'CAPABILITY_IAM',
             'CAPABILITY_NAMED_IAM',
         ],
-        OnFailure='DO_NOTHING'
-    )
+        "ChangeSetName": change_set_name,
+        "ChangeSetType": change_set_type
+    }
+    if change_set_type == "CREATE":
+        change_set_params["OnStackFailure"] = "DO_NOTHING"
+    cf_client.create_change_set(**change_set_params)
+
+    change_set = wait_for_change_set(cf_client, stack_name, change_set_name)
+    if change_set["Status"] == "FAILED":
+        if "didn't contain changes" in change_set.get("StatusReason", "") or \
+                "No updates are to be performed" in change_set.get("StatusReason", ""):
+            print("No changes to deploy for stack %s" % stack_name)
+            cf_client.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+            return None
+
+        raise SystemExit("Change set failed: %s" % change_set.get("StatusReason"))
+
+    for change in change_set["Changes"]:
+        resource_change = change["ResourceChange"]
+        print("  %-8s %-30s %s" % (resource_change["Action"], resource_change["LogicalResourceId"],
+                                   resource_change["ResourceType"]))
+
+    start_time = change_set["CreationTime"]
+    cf_client.execute_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+
+    print("Waiting for stack %s to complete" % change_set_type.lower())
+    return stream_stack_events(cf_client, stack_name, start_time)
+
+
+def get_stack_status(cf_client, stack_name):
+    """
+    Returns the status of the stack or None if it does not exist.
+    Args:
+    cf_client - boto3 cloudformation client
+    stack_name - Name of the stack
+    """
+    try:
+        return cf_client.describe_stacks(StackName=stack_name)["Stacks"][0]["StackStatus"]
+
+    except botocore.exceptions.ClientError as err:
+        if "does not exist" in err.response["Error"]["Message"]:
+            return None
+        raise err from None
+
+
+def wait_for_change_set(cf_client, stack_name, change_set_name):
+    """
+    Polls the change set until it has been created or has failed.  All pages
+    of changes are collected.
+    Args:
+    cf_client - boto3 cloudformation client
+    stack_name - Name of the stack
+    change_set_name - Name of the change set
+
+    Returns the describe_change_set response with all changes
+    """
+    while True:
+        response = cf_client.describe_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+        if response["Status"] not in ["CREATE_PENDING", "CREATE_IN_PROGRESS"]:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    change_list = response.get("Changes", [])
+    next_token = response.get("NextToken")
+    while next_token:
+        page = cf_client.describe_change_set(StackName=stack_name, ChangeSetName=change_set_name,
+                                             NextToken=next_token)
+        change_list.extend(page.get("Changes", []))
+        next_token = page.get("NextToken")
+
+    response["Changes"] = change_list
+    return response
+
+
+def stream_stack_events(cf_client, stack_name, start_time):
+    """
+    Prints new stack events as they arrive until the stack reaches a final
+    status, then prints the duration of each resource.  Only the events newer
+    than the last seen event are requested on each poll.
+    Args:
+    cf_client - boto3 cloudformation client
+    stack_name - Name of the stack
+    start_time - datetime, events before it are ignored
+
+    Returns the final stack status
+    """
+    seen_events = set()
+    resource_times = {}
+    paginator = cf_client.get_paginator("describe_stack_events")
+
+    while True:
+        new_events = []
+        for page in paginator.paginate(StackName=stack_name):
+            page_events = [event for event in page["StackEvents"]
+                           if event["Timestamp"] >= start_time and event["EventId"] not in seen_events]
+            new_events.extend(page_events)
+            # Events are returned newest first so stop at the first page with
+            # an event that was already seen or is too old
+            if len(page_events) < len(page["StackEvents"]):
+                break
+
+        for event in reversed(new_events):
+            seen_events.add(event["EventId"])
+            print("%s %-40s %-30s %s" % (event["Timestamp"].strftime("%H:%M:%S"),
+                                         event["ResourceStatus"], event["LogicalResourceId"],
+                                         event.get("ResourceStatusReason", "")))
+
+            times = resource_times.setdefault(event["LogicalResourceId"], [event["Timestamp"], None])
+            if not event["ResourceStatus"].endswith("_IN_PROGRESS"):
+                times[1] = event["Timestamp"]
+
+        stack_status = get_stack_status(cf_client, stack_name)
+        if stack_status and not stack_status.endswith("_IN_PROGRESS"):
+            break
+        time.sleep(POLL_INTERVAL)
+
+    print("Resource durations:")
+    duration_list = [(logical_id, (end - start).total_seconds())
+                     for logical_id, (start, end) in resource_times.items() if end]
+    for logical_id, duration in sorted(duration_list, key=lambda item: item[1], reverse=True):
+        print("  %-30s %8.1fs" % (logical_id, duration))
+
+    print("Stack %s finished with status %s" % (stack_name, stack_status))
+    return stack_status
+
+
+def build_artifact(source_directory, file_list, zip_filename, include_bytecode=False):
+    """
+    Builds a deterministic zip of the files in file_list.  Entries are sorted
+    and use a fixed timestamp and permissions so identical sources always
+    produce the same zip.  The content hash is stored as the zip comment and
+    an existing zip with the same hash is not rebuilt.
+    Args:
+    source_directory - Directory the files in file_list are relative to
+    file_list - list of filenames to include
+    zip_filename - Filename of the zip to build
+    Kargs:
+    include_bytecode - Add unchecked hash based .pyc files for the running
+                       interpreter in __pycache__ next to each module
+
+    Returns the sha256 content hash of the sources as a hex string
+    """
+    missing_list = missing_imports(source_directory, file_list)
+    if missing_list:
+        raise SystemExit("CR zip file list is missing the imported modules %s" % ", ".join(missing_list))
+
+    content_hash = hashlib.sha256()
+    content_dict = {}
+    for filename in sorted(file_list):
+        with open(os.path.join(source_directory, filename), "rb") as file_handle:
+            content_dict[filename] = file_handle.read()
+        content_hash.update(filename.encode("utf-8") + b"\0")
+        content_hash.update(hashlib.sha256(content_dict[filename]).digest())
+
+    if include_bytecode:
+        content_hash.update(sys.implementation.cache_tag.encode("utf-8"))
+        for filename in sorted(file_list):
+            if filename.endswith(".py"):
+                content_dict[importlib.util.cache_from_source(filename)] = \
+                    compile_bytecode(os.path.join(source_directory, filename), filename)
+    content_hash = content_hash.hexdigest()
+
+    if os.path.isfile(zip_filename):
+        with ZipFile(zip_filename) as zip_object:
+            if zip_object.comment.decode("utf-8", "replace") == content_hash:
+                print("CR zip file %s is up to date" % zip_filename)
+                return content_hash
+
+        print("Removing existing CR zip file %s" % zip_filename)
+        os.remove(zip_filename)
+
+    with ZipFile(zip_filename, 'w', ZIP_DEFLATED) as zip_object:
+        for filename, content in content_dict.items():
+            zip_info = ZipInfo(filename, date_time=ZIP_DATE_TIME)
+            zip_info.compress_type = ZIP_DEFLATED
+            zip_info.external_attr = 0o644 << 16
+            zip_object.writestr(zip_info, content)
+        zip_object.comment = content_hash.encode("utf-8")
+
+    return content_hash
+
+
+def missing_imports(source_directory, file_list, entry_module=CR_ENTRY_MODULE):
+    """
+    Finds the modules of source_directory imported by the entry module, or
+    by the modules it imports, that are not in file_list.  Imports of
+    modules that are not files of source_directory (the standard library,
+    boto3) are ignored.
+    Args:
+    source_directory - Directory the files in file_list are relative to
+    file_list - list of filenames to include
+    Kargs:
+    entry_module - Filename of the module the handlers are imported from
+
+    Returns sorted list of the missing filenames
+    """
+    def local_module(module_name):
+        for filename in [module_name.replace(".", "/") + ".py",
+                         module_name.replace(".", "/") + "/__init__.py"]:
+            if os.path.isfile(os.path.join(source_directory, filename)):
+                return filename
+        return None
+
+    seen_set = set()
+    pending_list = [entry_module]
+    while pending_list:
+        filename = pending_list.pop()
+        if filename in seen_set:
+            continue
+        seen_set.add(filename)
+
+        with open(os.path.join(source_directory, filename), "rb") as file_handle:
+            tree = ast.parse(file_handle.read(), filename)
+
+        module_list = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                module_list.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                module_list.append(node.module)
+                module_list.extend("%s.%s" % (node.module, alias.name) for alias in node.names)
+
+        for module_name in module_list:
+            # A package import also imports the __init__ of its parents
+            parts = module_name.split(".")
+            for depth in range(1, len(parts) + 1):
+                module_filename = local_module(".".join(parts[:depth]))
+                if module_filename:
+                    pending_list.append(module_filename)
+
+    return sorted(seen_set - set(file_list))
+
+
+def compile_bytecode(source_filename, archive_filename):
+    """
+    Compiles a module to bytecode.  Unchecked hash based pycs are used so the
+    runtime loads them without comparing them to the source, which has the
+    fixed zip timestamp.
+    Args:
+    source_filename - Filename of the module source
+    archive_filename - Filename of the module in the zip, used in tracebacks
+
+    Returns the pyc content as bytes
+    """
+    with tempfile.TemporaryDirectory() as temp_directory:
+        pyc_filename = os.path.join(temp_directory, "module.pyc")
+        py_compile.compile(source_filename, cfile=pyc_filename, dfile=archive_filename,
+                           doraise=True,
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        with open(pyc_filename, "rb") as file_handle:
+            return file_handle.read()
+
+
+def template_runtime(cf_template):
+    """
+    Returns the python version of the Lambda runtime declared in the template.
+    Args:
+    cf_template - CF template filename
+
+    Returns tuple of (major, minor) or None if no python runtime is found
+    """
+    with open(cf_template, "r", encoding="utf-8") as file_handle:
+        match = re.search(r"Runtime:\s*python(\d+)\.(\d+)", file_handle.read())
+
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def bytecode_supported(cf_template):
+    """
+    Returns True if bytecode compiled by the running interpreter can be loaded
+    by the Lambda runtime declared in the template.  Bytecode is only valid
+    for the python version that compiled it.
+    Args:
+    cf_template - CF template filename
+    """
+    runtime = template_runtime(cf_template)
+    if runtime != tuple(sys.version_info[:2]):
+        print("Skipping bytecode, python %d.%d does not match Lambda runtime %s" %
+              (sys.version_info[0], sys.version_info[1],
+               "python%d.%d" % runtime if runtime else "unknown"))
+        return False
+
+    return True
+
+
+def benchmark(cf_template, module="ir_setup"):
+    """
+    Prints a comparison of the time to import the custom resource entry
+    module from the zip contents with and without precompiled bytecode.  Each
+    variant is imported in a new interpreter BENCHMARK_RUNS times and the
+    median is reported.
+    Args:
+    cf_template - CF template filename
+    Kargs:
+    module - Module to import
+
+    Returns dictionary of variant name to median import seconds
+    """
+    source_directory = os.path.join(os.getcwd(), CR_ZIP_DIRECTORY)
+    include_bytecode = bytecode_supported(cf_template)
+    import_code = ("import time; start = time.perf_counter(); import %s; "
+                   "print(time.perf_counter() - start)" % module)
+
+    return_dict = {}
+    with tempfile.TemporaryDirectory() as temp_directory:
+        variant_list = [("source", False)]
+        if include_bytecode:
+            variant_list.append(("bytecode", True))
+
+        for variant, variant_bytecode in variant_list:
+            variant_zip = os.path.join(temp_directory, "%s.zip" % variant)
+            variant_directory = os.path.join(temp_directory, variant)
+            build_artifact(source_directory, CR_ZIP_FILE_LIST, variant_zip,
+                           include_bytecode=variant_bytecode)
+            with ZipFile(variant_zip) as zip_object:
+                zip_object.extractall(variant_directory)
+
+            timing_list = []
+            for _ in range(BENCHMARK_RUNS):
+                # Prevent the source variant from writing its own pycs
+                output = subprocess.run([sys.executable, "-c", import_code], cwd=variant_directory,
+                                        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+                                        capture_output=True, text=True, check=True)
+                timing_list.append(float(output.stdout.strip().splitlines()[-1]))
+            return_dict[variant] = statistics.median(timing_list)
+            shutil.rmtree(variant_directory)
+
+    print("Cold import of %s (median of %d runs):" % (module, BENCHMARK_RUNS))
+    for variant, seconds in return_dict.items():
+        print("  %-10s %8.1f ms" % (variant, seconds * 1000))
+    if "bytecode" in return_dict:
+        print("  %-10s %8.1f ms" % ("saved", (return_dict["source"] - return_dict["bytecode"]) * 1000))
+
+    return return_dict
+
+
+def file_hash(filename):
+    """
+    Returns the sha256 hash of a file as a hex string.
+    Args:
+    filename - File to hash
+    """
+    with open(filename, "rb") as file_handle:
+        return hashlib.sha256(file_handle.read()).hexdigest()
+
+
+def versioned_key(filename, content_hash):
+    """
+    Returns the S3 key for filename versioned by content hash, e.g.
+    ir_manager.zip becomes ir_manager-<hash>.zip.
+    Args:
+    filename - Base filename
+    content_hash - hex content hash
+    """
+    name, extension = os.path.splitext(os.path.basename(filename))
+    return "%s-%s%s" % (name, content_hash[:16], extension)
+
+
+def upload_if_changed(s3_client, filename, bucket, key, content_hash):
+    """
+    Uploads a file to S3 unless the object already in the bucket has the same
+    content hash in its metadata.
+    Args:
+    s3_client - boto3 s3 client
+    filename - File to upload
+    bucket - S3 bucket name
+    key - S3 object key
+    content_hash - hex content hash of the file
+
+    Returns True if the file was uploaded
+    """
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+        if response["Metadata"].get(HASH_METADATA_KEY) == content_hash:
+            print("s3://%s/%s is unchanged, skipping upload" % (bucket, key))
+            return False
+
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] not in ["404", "NoSuchKey", "NotFound"]:
+            raise err from None
+
+    s3_client.upload_file(filename, bucket, key,
+                          ExtraArgs={"Metadata": {HASH_METADATA_KEY: content_hash}})
+    return True
 
-    print("Waiting for stack create to complete")
-    waiter = cf_client.get_waiter("stack_create_complete")
-    waiter.wait(
-        StackName=response["StackId"]
-    )
 
 if __name__ == "__main__":
     arg_dict = {
-        "--deladmin" : {"help": "ID of the delegated admin account",
-                        "required": True},
-        "--bucket" : {"help": "S3 bucket for CR zip file",
-                        "required": True},
-        "--shregions" : {"help": "Security Hub enabled regions",
-                        "required": True},
-        "--gdregions" : {"help": "Guardduty enabled regions",
-                        "required": True},
-        "--inregions" : {"help": "Inspector enabled regions",
-                        "required": True},
+        "--deladmin" : {"help": "ID of the delegated admin account (required)"},
+        "--bucket" : {"help": "S3 bucket for CR zip file (required)"},
+        "--shregions" : {"help": "Security Hub enabled regions (required)"},
+        "--gdregions" : {"help": "Guardduty enabled regions (required)"},
+        "--inregions" : {"help": "Inspector enabled regions (required)"},
         "--crfilename" : {"help": "Filename to use for the CR zip"},
-        "--stackname" : {"help": "New CF stack name"},
-        "--cftemplate" : {"help": "CF template filename"}
+        "--stackname" : {"help": "CF stack name to create or update"},
+        "--cftemplate" : {"help": "CF template filename"},
+        "--benchmark" : {"help": "Only compare CR import time with and without bytecode",
+                         "action": "store_true"}
     }
 
     parser = argparse.ArgumentParser()
@@ -125,4 +555,10 @@ if __name__ == "__main__":
         parser.add_argument(arg, **arg_dict[arg])
 
     args = parser.parse_args()
-    main(args)
+    if args.benchmark:
+        benchmark(args.cftemplate or IR_TEMPLATE)
+    else:
+        missing_args = ["--%s" % arg for arg in REQUIRED_DEPLOY_ARGS if not getattr(args, arg)]
+        if missing_args:
+            parser.error("the following arguments are required: %s" % ", ".join(missing_args))
+        main(args)